@@ -8,6 +8,7 @@ import math
 import errno
 import json
 from array import array
+from multiprocessing import Pool
 
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
@@ -23,6 +24,22 @@ import CombineLimitsRunII.Plotter.tdrstyle as tdrstyle
 
 tdrstyle.setTDRStyle()
 
+# instance shared with the forked signal fit workers
+_FITINSTANCE = None
+
+def _fitSignalWorker(chain):
+    '''Run a chain of signal fits inside a worker process'''
+    return _FITINSTANCE.fitSignalChain(chain)
+
+# background workspace after the central fit, copied by the forked shift fit workers
+_BGWORKSPACE = None
+
+def _fitBackgroundWorker(args):
+    '''Run a single background shift fit on a private copy of the background workspace'''
+    region, shift, kwargs = args
+    workspace = ROOT.RooWorkspace(_BGWORKSPACE)
+    return shift, _FITINSTANCE.fitBackground(region=region,shift=shift,workspace=workspace,**kwargs)
+
 class HaaLimits2D(HaaLimits):
     '''
     Create the Haa Limits workspace
@@ -58,6 +75,7 @@ class HaaLimits2D(HaaLimits):
 
         self.plotDir = 'figures/HaaLimits2D{}'.format('_'+tag if tag else '')
         self.fitsDir = 'fitParams/HaaLimits2D{}'.format('_'+tag if tag else '')
+        self.signalFitInfo = {}
 
 
     ###########################
@@ -754,6 +772,7 @@ class HaaLimits2D(HaaLimits):
         yFitFunc = kwargs.get('yFitFunc','G')
         dobgsig = kwargs.get('doBackgroundSignal',False)
         results = kwargs.get('results',{})
+        seed = kwargs.get('seed',{})
         histMap = self.histMap[region][shift]
         tag = kwargs.get('tag','{}{}'.format(region,'_'+shift if shift else ''))
 
@@ -1112,25 +1131,61 @@ class HaaLimits2D(HaaLimits):
                 ws.var(param).setVal(results[param])
         hist = histMap[self.SIGNAME.format(h=h,a=a)]
         saveDir = '{}/{}'.format(self.plotDir,shift if shift else 'central')
-        results, errors = model.fit2D(ws, hist, name, saveDir=saveDir, save=True, doErrors=True, xRange=[0.9*aval,1.1*aval])
-        if self.binned:
-            integral = histMap[self.SIGNAME.format(h=h,a=a)].Integral() * scale
-            integralerr = getHistogram2DIntegralError(histMap[self.SIGNAME.format(h=h,a=a)]) * scale
+        prefitBins = self.getPrefitBins(self.XVAR,self.YVAR)
+        # shifted fits already start from the central result
+        # the seed is applied before the key is taken, so warm and cold starts are cached separately
+        initial = self.warmStartSignalFit(ws,seed) if seed and not results else {}
+        key = self.fitCacheKey(ws.pdf(name),hist,'fit2D',self.XRANGE,self.YRANGE,scale,*([prefitBins] if prefitBins else []))
+        cached = self.loadFitCache(key)
+        if cached:
+            results, errors = cached['vals'], cached['errs']
+            integral, integralerr = cached['integrals'], cached['integralerrs']
+            fitInfo = {'status': 0, 'migradCalls': 0, 'warmStart': bool(initial), 'cached': True}
         else:
-            integral = histMap[self.SIGNAME.format(h=h,a=a)].sumEntries('{0}>{2} && {0}<{3} && {1}>{4} && {1}<{5}'.format(self.XVAR,self.YVAR,*self.XRANGE+self.YRANGE)) * scale
-            integralerr = getDatasetIntegralError(histMap[self.SIGNAME.format(h=h,a=a)],'{0}>{2} && {0}<{3} && {1}>{4} && {1}<{5}'.format(self.XVAR,self.YVAR,*self.XRANGE+self.YRANGE)) * scale
-            if integral!=integral:
-                logging.error('Integral for spline is invalid: h{h} a{a} {region} {shift}'.format(h=h,a=a,region=region,shift=shift))
-                raise
+            results, errors = model.fit2D(ws, hist, name, saveDir=saveDir, save=True, doErrors=True, xRange=[0.9*aval,1.1*aval], prefitBins=prefitBins)
+            fitInfo = {'status': model.fitStatus, 'migradCalls': model.fitCalls, 'warmStart': bool(initial), 'cached': False}
+            if initial and model.fitStatus!=0:
+                logging.warning('Warm started signal fit failed (status {}), refitting from the initial values: h{} a{} {}'.format(model.fitStatus,h,a,tag))
+                for param in initial:
+                    ws.var(param).setVal(initial[param])
+                results, errors = model.fit2D(ws, hist, name, saveDir=saveDir, save=True, doErrors=True, xRange=[0.9*aval,1.1*aval], prefitBins=prefitBins)
+                fitInfo.update(status=model.fitStatus, migradCalls=fitInfo['migradCalls']+model.fitCalls, warmStart=False)
+            logging.debug('Signal fit h{} a{} {}: status {}, {} MIGRAD calls{}'.format(h,a,tag,fitInfo['status'],fitInfo['migradCalls'],' (warm start)' if fitInfo['warmStart'] else ''))
+            if self.binned:
+                integral = histMap[self.SIGNAME.format(h=h,a=a)].Integral() * scale
+                integralerr = getHistogram2DIntegralError(histMap[self.SIGNAME.format(h=h,a=a)]) * scale
+            else:
+                integral, integralerr = getDatasetIntegralAndError(histMap[self.SIGNAME.format(h=h,a=a)],{self.XVAR: self.XRANGE, self.YVAR: self.YRANGE})
+                integral *= scale
+                integralerr *= scale
+                if integral!=integral:
+                    logging.error('Integral for spline is invalid: h{h} a{a} {region} {shift}'.format(h=h,a=a,region=region,shift=shift))
+                    raise
+            self.dumpFitCache(key,{'vals': results, 'errs': errors, 'integrals': integral, 'integralerrs': integralerr})
     
         savedir = '{}/{}'.format(self.fitsDir,shift if shift else 'central')
         python_mkdir(savedir)
         savename = '{}/h{}_a{}_{}.json'.format(savedir,h,a,tag)
-        jsonData = {'vals': results, 'errs': errors, 'integrals': integral, 'integralerrs': integralerr}
+        jsonData = {'vals': results, 'errs': errors, 'integrals': integral, 'integralerrs': integralerr, 'fitInfo': fitInfo}
         self.dump(savename,jsonData)
+        self.signalFitInfo[(region,shift,h,a)] = fitInfo
 
         return results, errors, integral, integralerr
 
+    def warmStartSignalFit(self,ws,seed):
+        '''
+        Set the floating signal parameters to the converged values of a neighbouring a mass.
+        Values outside of the parameter range of this fit are skipped.
+        Returns the replaced initial values.
+        '''
+        initial = {}
+        for param, val in seed.iteritems():
+            var = ws.var(param)
+            if not var or var.isConstant() or not var.getMin()<=val<=var.getMax(): continue
+            initial[param] = var.getVal()
+            var.setVal(val)
+        return initial
+
 
     def fitSignals(self,region,shift='',**kwargs):
         '''
@@ -1145,6 +1200,9 @@ class HaaLimits2D(HaaLimits):
         skipFit = kwargs.get('skipFit',False)
         dobgsig = kwargs.get('doBackgroundSignal',False)
         tag = kwargs.get('tag','{}{}'.format(region,'_'+shift if shift else ''))
+        nCores = kwargs.get('nCores',1)
+        warmStart = kwargs.get('warmStart',False)
+        fitted = kwargs.pop('fitted',{})
 
         histMap = self.histMap[region][shift]
 
@@ -1161,6 +1219,7 @@ class HaaLimits2D(HaaLimits):
             integrals = {}
             integralerrs = {}
 
+            tasks = []
             for h in self.HMASSES:
                 results[h] = {}
                 errors[h] = {}
@@ -1171,10 +1230,15 @@ class HaaLimits2D(HaaLimits):
                 avals = [self.aToFloat(x) for x in amasses]
 
                 for a in amasses:
-                    if load or (shift and not skipFit):
-                        results[h][a], errors[h][a], integrals[h][a], integralerrs[h][a] = self.fitSignal(h,a,region,shift,results=cresults[h][a],**kwargs)
+                    if (region,shift,h,a) in fitted:
+                        results[h][a], errors[h][a], integrals[h][a], integralerrs[h][a] = fitted[(region,shift,h,a)]
+                    elif load or (shift and not skipFit):
+                        tasks += [(h,a,region,shift,dict(kwargs,results=cresults[h][a]))]
                     elif not skipFit:
-                        results[h][a], errors[h][a], integrals[h][a], integralerrs[h][a] = self.fitSignal(h,a,region,shift,**kwargs)
+                        tasks += [(h,a,region,shift,kwargs)]
+
+            for (r,s,h,a), fit in self.fitSignalPoints(tasks,nCores=nCores,warmStart=warmStart).iteritems():
+                results[h][a], errors[h][a], integrals[h][a], integralerrs[h][a] = fit
 
     
         savedir = '{}/{}'.format(self.fitsDir,shift if shift else 'central')
@@ -1187,6 +1251,87 @@ class HaaLimits2D(HaaLimits):
 
         return results, errors, integrals, integralerrs, fitFuncs
 
+    def fitSignalPoints(self,tasks,nCores=1,warmStart=False):
+        '''
+        Run fitSignal for a list of (h,a,region,shift,kwargs) tasks.
+        Each fit builds its own throwaway workspace, so with nCores>1 the
+        tasks are spread over a pool of forked worker processes.
+        With warmStart the tasks are run in chains of increasing a (see getSignalChains),
+        each fit seeded with the converged parameters of the previous one.
+        Returns {(region,shift,h,a): (results, errors, integral, integralerr)}.
+        '''
+        global _FITINSTANCE
+        chains = self.getSignalChains(tasks,nCores) if warmStart else [[task] for task in tasks]
+        if nCores<=1 or len(chains)<2:
+            results = [fit for chain in chains for fit in self.fitSignalChain(chain)]
+        else:
+            logging.info('Running {} signal fits in {} chains on {} cores'.format(len(tasks),len(chains),nCores))
+            _FITINSTANCE = self
+            pool = Pool(min(nCores,len(chains)))
+            try:
+                results = [fit for fits in pool.map(_fitSignalWorker,chains,chunksize=1) for fit in fits]
+            finally:
+                pool.close()
+                pool.join()
+                _FITINSTANCE = None
+
+        fits = {}
+        for key, fit, fitInfo in results:
+            fits[key] = fit
+            self.signalFitInfo[key] = fitInfo
+        if results:
+            logging.info('Signal fits: {} MIGRAD calls, {} warm started, {} not converged'.format(
+                sum([fitInfo['migradCalls'] for key, fit, fitInfo in results]),
+                len([key for key, fit, fitInfo in results if fitInfo['warmStart']]),
+                len([key for key, fit, fitInfo in results if fitInfo['status']!=0]),
+            ))
+        return fits
+
+    def getSignalChains(self,tasks,nCores=1):
+        '''
+        Group the tasks by (region,shift,h) in order of a and split the groups into
+        contiguous chains, so that there are at least nCores chains when possible.
+        '''
+        groups = {}
+        for task in tasks:
+            h, a, region, shift, kwargs = task
+            groups.setdefault((region,shift,h),[]).append(task)
+        if not groups: return []
+        nsplit = int(math.ceil(float(nCores)/len(groups)))
+        chains = []
+        for key in sorted(groups):
+            group = sorted(groups[key],key=lambda task: self.aToFloat(task[1]))
+            size = int(math.ceil(float(len(group))/nsplit))
+            chains += [group[i:i+size] for i in range(0,len(group),size)]
+        return chains
+
+    def fitSignalChain(self,chain):
+        '''
+        Fit the tasks of a chain in order, seeding each fit with the previous result if it converged.
+        Returns [((region,shift,h,a), fit, fitInfo)].
+        '''
+        fits = []
+        seed = {}
+        for h, a, region, shift, kwargs in chain:
+            fit = self.fitSignal(h,a,region,shift,**dict(kwargs,seed=seed))
+            fitInfo = self.signalFitInfo[(region,shift,h,a)]
+            seed = fit[0] if fitInfo['status']==0 else {}
+            fits += [((region,shift,h,a),fit,fitInfo)]
+        return fits
+
+    def fitSignalShifts(self,region,cresults,shifts,**kwargs):
+        '''
+        Fit all shifted signal models of a region at once, seeded by the central fits.
+        Returns the fits keyed by (region,shift,h,a) to be passed to fitSignals as fitted.
+        '''
+        tasks = []
+        for shift in shifts:
+            tag = kwargs.get('tag','{}{}'.format(region,'_'+shift if shift else ''))
+            for h in self.HMASSES:
+                for a in self.HAMAP[h]:
+                    tasks += [(h,a,region,shift,dict(kwargs,tag=tag,results=cresults[h][a]))]
+        return self.fitSignalPoints(tasks,nCores=kwargs.get('nCores',1))
+
     def getParams(self,yFitFunc):
         xparams = ['mean_sigx','width_sigx','sigma_sigx']
         if   yFitFunc == "V"   : yparams = ['mean_sigy','width_sigy','sigma_sigy']
@@ -1915,10 +2060,26 @@ class HaaLimits2D(HaaLimits):
             data = ROOT.RooDataHist(name,name,ROOT.RooArgList(workspace.var(xVar),workspace.var(yVar)),hist)
         else:
             data = hist.Clone(name)
-            integral = hist.sumEntries('{0}>{2} && {0}<{3} && {1}>{4} && {1}<{5}'.format(xVar,yVar,*self.XRANGE+self.YRANGE)) * scale
-            integralerr = getDatasetIntegralError(hist,'{0}>{2} && {0}<{3} && {1}>{4} && {1}<{5}'.format(xVar,yVar,*self.XRANGE+self.YRANGE)) * scale
-
-        fr = model.fitTo(data,ROOT.RooFit.Save(),ROOT.RooFit.SumW2Error(True), ROOT.RooFit.PrintLevel(-1))
+            integral, integralerr = getDatasetIntegralAndError(hist,{xVar: self.XRANGE, yVar: self.YRANGE})
+            integral *= scale
+            integralerr *= scale
+
+        prefitBins = self.getPrefitBins(xVar,yVar)
+        key = self.fitCacheKey(model,hist,'fitBackground2D',self.XRANGE,self.YRANGE,*([prefitBins] if prefitBins else []))
+        cached = self.loadFitCache(key)
+        if cached:
+            vals, errs = cached['vals'], cached['errs']
+            self.setFitValues(workspace,vals,errs)
+        else:
+            fr, status, ncalls = Models.fitModel(model,data,prefitBins=prefitBins)
+            logging.debug('Background fit {} {}: status {}, {} MIGRAD calls'.format(region,shift,status,ncalls))
+            pars = fr.floatParsFinal()
+            vals = {}
+            errs = {}
+            for p in range(pars.getSize()):
+                vals[pars.at(p).GetName()] = pars.at(p).getValV()
+                errs[pars.at(p).GetName()] = pars.at(p).getError()
+            self.dumpFitCache(key,{'vals':vals, 'errs':errs})
 
         workspace.var(xVar).setBins(self.XBINNING)
         workspace.var(yVar).setBins(self.YBINNING)
@@ -1930,13 +2091,6 @@ class HaaLimits2D(HaaLimits):
 
         self.plotModelY(workspace,yVar,data,model,region,shift,postfix='yproj')
 
-        pars = fr.floatParsFinal()
-        vals = {}
-        errs = {}
-        for p in range(pars.getSize()):
-            vals[pars.at(p).GetName()] = pars.at(p).getValV()
-            errs[pars.at(p).GetName()] = pars.at(p).getError()
-
         python_mkdir(self.fitsDir)
         jfile = '{}/background_{}{}.json'.format(self.fitsDir,region,'_'+shift if shift else '')
         results = {'vals':vals, 'errs':errs, 'integral':integral, 'integralerr':integralerr}
@@ -1944,6 +2098,42 @@ class HaaLimits2D(HaaLimits):
 
         return vals, errs, integral, integralerr
 
+    def getPrefitBins(self,xVar,yVar):
+        '''Binning of the binned prefit of unbinned datasets, empty if BINNEDPREFIT is off'''
+        if not self.BINNEDPREFIT: return {}
+        return {xVar: self.XBINNING, yVar: self.YBINNING}
+
+    def fitBackgroundShifts(self,region,shifts,workspace,nCores=1,**kwargs):
+        '''
+        Fit the shifted background models of a region, each starting from the (central) values in workspace.
+        With nCores>1 the fits run in a pool of forked worker processes, each on its own
+        copy of the workspace. Either way the workspace is left at the central values.
+        Returns {shift: (vals, errs, integral, integralerr)}.
+        '''
+        global _FITINSTANCE, _BGWORKSPACE
+        if nCores<=1 or len(shifts)<2:
+            snapshot = 'central_{}'.format(region)
+            workspace.saveSnapshot(snapshot,workspace.allVars())
+            fits = {}
+            for shift in shifts:
+                workspace.loadSnapshot(snapshot)
+                fits[shift] = self.fitBackground(region=region, shift=shift, workspace=workspace, **kwargs)
+            workspace.loadSnapshot(snapshot)
+            return fits
+
+        logging.info('Running {} background fits for {} on {} cores'.format(len(shifts),region,nCores))
+        _FITINSTANCE = self
+        _BGWORKSPACE = workspace
+        pool = Pool(min(nCores,len(shifts)))
+        try:
+            fits = dict(pool.map(_fitBackgroundWorker,[(region,shift,kwargs) for shift in shifts],chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+            _FITINSTANCE = None
+            _BGWORKSPACE = None
+        return fits
+
 
     ###############################
     ### Add things to workspace ###
@@ -1971,6 +2161,7 @@ class HaaLimits2D(HaaLimits):
         mh = kwargs.pop('h',125)
         ma = kwargs.pop('a',15)
         scale = kwargs.pop('scale',1)
+        reuseGenerated = kwargs.pop('reuseGenerated',False)
 
         workspace = self.workspace
 
@@ -2029,14 +2220,17 @@ class HaaLimits2D(HaaLimits):
 
             name = 'data_obs_{}'.format(region)
             hist = self.histMap[region]['']['data']
-            if blind:
+            generated = self.loadGenerated(name) if blind and reuseGenerated else None
+            if generated:
+                data_obs = generated
+            elif blind:
                 # generate a toy data observation from the model
                 model = workspace.pdf('bg_{}_xy'.format(region))
                 h = self.histMap[region]['']['dataNoSig']
                 if h.InheritsFrom('TH1'):
                     integral = h.Integral() * scale # 2D integral?
                 else:
-                    integral = h.sumEntries('{0}>{2} && {0}<{3} && {1}>{4} && {1}<{5}'.format(xVar,yVar,*self.XRANGE+self.YRANGE)) * scale
+                    integral = getDatasetIntegralAndError(h,{xVar: self.XRANGE, yVar: self.YRANGE})[0] * scale
                 if asimov:
                     data_obs = model.generateBinned(ROOT.RooArgSet(self.workspace.var(xVar),self.workspace.var(yVar)),integral,1)
                 else:
@@ -2056,6 +2250,7 @@ class HaaLimits2D(HaaLimits):
                         sig_obs = model.generate(ROOT.RooArgSet(self.workspace.var(xVar),self.workspace.var(yVar)),int(integral))
                         data_obs.append(sig_obs)
                 data_obs.SetName(name)
+                self.saveGenerated(data_obs)
             else:
                 # use the provided data
                 if hist.InheritsFrom('TH1'):
@@ -2111,6 +2306,7 @@ class HaaLimits2D(HaaLimits):
 
 
     def addBackgroundModels(self, fixAfterControl=False, fixAfterFP=False, load=False, skipFit=False, **kwargs):
+        nCores = kwargs.pop('nCores',1)
         workspace = self.buildWorkspace('bg')
         self.initializeWorkspace(workspace=workspace)
         super(HaaLimits2D, self).buildModel(region='control', workspace=workspace)
@@ -2132,31 +2328,24 @@ class HaaLimits2D(HaaLimits):
             self.buildModel(region=region, workspace=workspace)
             self.fixXLambda(workspace=workspace)
             self.fixCorrelation(workspace=self.workspace)
-            for shift in ['']+self.BACKGROUNDSHIFTS:
-                if shift=='':
-                    if load:
-                        v, e, i, ie = self.loadBackgroundFit(region, workspace=workspace)
-                    else:
-                        v, e, i, ie = self.fitBackground(region=region, workspace=workspace, **kwargs)
-                    vals[region][shift] = v
-                    errs[region][shift] = e
-                    integrals[region][shift] = i
-                    integralerrs[region][shift] = ie
-                else:
-                    if load:
-                        vUp, eUp, iUp, ieUp = self.loadBackgroundFit(region,shift+'Up', workspace=workspace)
-                        vDown, eDown, iDown, ieDown = self.loadBackgroundFit(region,shift+'Down', workspace=workspace)
-                    if not skipFit:
-                        vUp, eUp, iUp, ieUp = self.fitBackground(region=region, shift=shift+'Up', workspace=workspace, **kwargs)
-                        vDown, eDown, iDown, ieDown = self.fitBackground(region=region, shift=shift+'Down', workspace=workspace, **kwargs)
-                    vals[region][shift+'Up'] = vUp
-                    errs[region][shift+'Up'] = eUp
-                    integrals[region][shift+'Up'] = iUp
-                    integralerrs[region][shift+'Up'] = ieUp
-                    vals[region][shift+'Down'] = vDown
-                    errs[region][shift+'Down'] = eDown
-                    integrals[region][shift+'Down'] = iDown
-                    integralerrs[region][shift+'Down'] = ieDown
+            if load:
+                v, e, i, ie = self.loadBackgroundFit(region, workspace=workspace)
+            else:
+                v, e, i, ie = self.fitBackground(region=region, workspace=workspace, **kwargs)
+            vals[region][''] = v
+            errs[region][''] = e
+            integrals[region][''] = i
+            integralerrs[region][''] = ie
+
+            # the shift fits are independent of each other, run them together
+            shifts = [shift+ud for shift in self.BACKGROUNDSHIFTS for ud in ['Up','Down']]
+            fits = {}
+            if load:
+                fits = {shift: self.loadBackgroundFit(region,shift, workspace=workspace) for shift in shifts}
+            if not skipFit:
+                fits = self.fitBackgroundShifts(region,shifts,workspace,nCores=nCores,**kwargs)
+            for shift in shifts:
+                vals[region][shift], errs[region][shift], integrals[region][shift], integralerrs[region][shift] = fits[shift]
 
         for region in reversed(self.REGIONS):
             if load:
@@ -2176,6 +2365,7 @@ class HaaLimits2D(HaaLimits):
         self.background_params = allparams
 
     def addSignalModels(self,yFitFuncFP="V", yFitFuncPP="V",isKinFit=False,**kwargs):
+        nCores = kwargs.get('nCores',1)
         models = {}
         values = {}
         errors = {}
@@ -2191,6 +2381,7 @@ class HaaLimits2D(HaaLimits):
             fitFuncs[region] = {}
             if 'PP' in region:  yFitFunc=yFitFuncPP
             else: yFitFunc = yFitFuncFP
+            fitted = {}
             for shift in ['']+self.SIGNALSHIFTS+self.QCDSHIFTS:
                 if shift == '':
                     vals, errs, ints, interrs, fits = self.fitSignals(region=region,shift=shift,yFitFunc=yFitFunc,isKinFit=isKinFit,**kwargs)
@@ -2199,16 +2390,20 @@ class HaaLimits2D(HaaLimits):
                     integrals[region][shift] = ints
                     integralerrs[region][shift] = interrs
                     fitFuncs[region][shift] = fits
+                    # run all shifted fits of this region through a single pool
+                    if nCores>1 and not kwargs.get('load',False) and not kwargs.get('skipFit',False):
+                        shifts = [s+ud for s in self.SIGNALSHIFTS for ud in ['Up','Down']] + self.QCDSHIFTS
+                        fitted = self.fitSignalShifts(region,vals,shifts,yFitFunc=yFitFunc,isKinFit=isKinFit,**kwargs)
                 elif shift in self.QCDSHIFTS:
-                    vals, errs, ints, interrs, fits = self.fitSignals(region=region,shift=shift,yFitFunc=yFitFunc,isKinFit=isKinFit,**kwargs)
+                    vals, errs, ints, interrs, fits = self.fitSignals(region=region,shift=shift,yFitFunc=yFitFunc,isKinFit=isKinFit,fitted=fitted,**kwargs)
                     values[region][shift] = vals
                     errors[region][shift] = errs
                     integrals[region][shift] = ints
                     integralerrs[region][shift] = interrs
                     fitFuncs[region][shift] = fits
                 else:
-                    valsUp, errsUp, intsUp, interrsUp, fitsUp = self.fitSignals(region=region,shift=shift+'Up',yFitFunc=yFitFunc,isKinFit=isKinFit,**kwargs)
-                    valsDown, errsDown, intsDown, interrsDown, fitsDown = self.fitSignals(region=region,shift=shift+'Down',yFitFunc=yFitFunc,isKinFit=isKinFit,**kwargs)
+                    valsUp, errsUp, intsUp, interrsUp, fitsUp = self.fitSignals(region=region,shift=shift+'Up',yFitFunc=yFitFunc,isKinFit=isKinFit,fitted=fitted,**kwargs)
+                    valsDown, errsDown, intsDown, interrsDown, fitsDown = self.fitSignals(region=region,shift=shift+'Down',yFitFunc=yFitFunc,isKinFit=isKinFit,fitted=fitted,**kwargs)
                     values[region][shift+'Up'] = valsUp
                     errors[region][shift+'Up'] = errsUp
                     integrals[region][shift+'Up'] = intsUp
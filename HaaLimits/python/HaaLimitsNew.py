@@ -8,6 +8,7 @@ import math
 import errno
 import json
 import pickle
+import hashlib
 from array import array
 
 import ROOT
@@ -71,6 +72,11 @@ class HaaLimits(Limits):
 
     FIXFP = False
 
+    FITCACHE = True # skip fits whose dataset, model and initial values are unchanged
+    FITCACHEDIR = 'fitParams/cache'
+
+    BINNEDPREFIT = False # prefit unbinned datasets binned at XBINNING (and YBINNING), then polish unbinned
+
     COLORS = {
         125 : ROOT.kBlack,
         200 : ROOT.kMagenta,
@@ -146,6 +152,139 @@ class HaaLimits(Limits):
         avals = sorted([self.aToFloat(a) for a in As])
         return [self.aToStr(a) for a in avals]
 
+    #################
+    ### Fit cache ###
+    #################
+    def hashDataset(self,data):
+        '''Hash the content of a histogram or RooAbsData (entries, weights and ranges)'''
+        md5 = hashlib.md5()
+        md5.update(data.ClassName())
+        if data.InheritsFrom('TH1'):
+            for axis in [data.GetXaxis(),data.GetYaxis(),data.GetZaxis()]:
+                md5.update(repr((axis.GetNbins(),axis.GetXmin(),axis.GetXmax())))
+            for b in xrange(data.GetSize()):
+                md5.update(repr((data.GetBinContent(b),data.GetBinError(b))))
+        else:
+            args = ROOT.RooArgList(data.get())
+            names = sorted([args.at(i).GetName() for i in range(args.getSize())])
+            ranges = [(args.find(n).getMin(),args.find(n).getMax()) if args.find(n).InheritsFrom('RooRealVar') else () for n in names]
+            md5.update(repr((names,ranges,data.numEntries(),data.sumEntries())))
+            values, weights = getDatasetArrays(data)
+            for n in sorted(values):
+                md5.update(values[n].tostring())
+            md5.update(weights.tostring())
+        return md5.hexdigest()
+
+    def hashModel(self,model,data):
+        '''Hash a pdf definition: its components and the starting values and ranges of its parameters'''
+        md5 = hashlib.md5()
+        comps = ROOT.RooArgList(model.getComponents())
+        md5.update(repr(sorted([(comps.at(i).ClassName(),comps.at(i).GetName(),comps.at(i).GetTitle()) for i in range(comps.getSize())])))
+        if data.InheritsFrom('TH1'):
+            observables = [self.XVAR, getattr(self,'YVAR','')]
+        else:
+            args = ROOT.RooArgList(data.get())
+            observables = [args.at(i).GetName() for i in range(args.getSize())]
+        pars = ROOT.RooArgList(model.getVariables())
+        for i in range(pars.getSize()):
+            par = pars.at(i)
+            if par.GetName() in observables: continue
+            if par.InheritsFrom('RooRealVar'):
+                md5.update(repr((par.GetName(),par.getVal(),par.getMin(),par.getMax(),par.isConstant())))
+            else:
+                md5.update(repr((par.GetName(),par.getVal())))
+        return md5.hexdigest()
+
+    def fitCacheKey(self,model,data,*args):
+        '''Key for the fit cache built from the dataset, the model and any extra inputs'''
+        return hashlib.md5(repr((self.hashDataset(data),self.hashModel(model,data),args))).hexdigest()
+
+    def loadFitCache(self,key):
+        '''Return the cached fit results for a key or an empty dict'''
+        name = '{}/{}.json'.format(self.FITCACHEDIR,key)
+        if not self.FITCACHE or not os.path.exists(name.replace('.json','.pkl')): return {}
+        logging.debug('Loading cached fit {}'.format(key))
+        return self.load(name)
+
+    def dumpFitCache(self,key,results):
+        if not self.FITCACHE: return
+        python_mkdir(self.FITCACHEDIR)
+        self.dump('{}/{}.json'.format(self.FITCACHEDIR,key),results)
+
+    def setFitValues(self,workspace,vals,errs):
+        '''Put cached fit results back into the workspace as if the fit had run'''
+        for param in vals:
+            var = workspace.var(param)
+            if not var: continue
+            var.setVal(vals[param])
+            var.setError(errs.get(param,0.))
+
+    ####################
+    ### Build stages ###
+    ####################
+    def getStageKeys(self,config=()):
+        '''
+        Input hashes of the build stages (control, background, signal, data)
+        for incremental rebuilds. Each key covers the datasets the stage reads,
+        the class configuration, any extra config and the stages it depends on.
+        '''
+        classConfig = sorted([(k,getattr(self,k)) for k in dir(self) if k.isupper() and k!='SKIPPLOTS' and isinstance(getattr(self,k),(bool,int,float,basestring,list,dict))])
+        signame = self.SIGNAME.split('{')[0]
+        def datasets(regions,select):
+            return [self.histMap[r][s][p] for r in regions if r in self.histMap for s in sorted(self.histMap[r]) for p in sorted(self.histMap[r][s]) if select(p)]
+        keys = {}
+        keys['control']    = self.getStageKey('control',classConfig,config,*datasets(['control'],lambda p: True))
+        keys['background'] = self.getStageKey('background',keys['control'],classConfig,config,*datasets(self.REGIONS,lambda p: not p.startswith(signame) and p!='data'))
+        keys['signal']     = self.getStageKey('signal',classConfig,config,*datasets(self.REGIONS,lambda p: p.startswith(signame)))
+        keys['data']       = self.getStageKey('data',keys['background'],keys['signal'],classConfig,config,*datasets(self.REGIONS,lambda p: p=='data'))
+        return keys
+
+    def getStageKey(self,stage,*inputs):
+        md5 = hashlib.md5()
+        md5.update(stage)
+        for i in inputs:
+            if hasattr(i,'InheritsFrom') and (i.InheritsFrom('TH1') or i.InheritsFrom('RooAbsData')):
+                md5.update(self.hashDataset(i))
+            else:
+                md5.update(repr(i))
+        return md5.hexdigest()
+
+    def loadStages(self):
+        name = '{}/stages.json'.format(self.fitsDir)
+        if not os.path.exists(name.replace('.json','.pkl')): return {}
+        return self.load(name)
+
+    def stageChanged(self,stage,key):
+        '''Compare a stage key with the one recorded by the last completed build'''
+        changed = self.loadStages().get(stage)!=key
+        logging.info('Stage {}: {}'.format(stage,'inputs changed, rebuilding' if changed else 'inputs unchanged, reusing products'))
+        return changed
+
+    def markStages(self,keys):
+        '''Record the keys of the stages that completed'''
+        stages = self.loadStages()
+        stages.update(keys)
+        python_mkdir(self.fitsDir)
+        self.dump('{}/stages.json'.format(self.fitsDir),stages)
+
+    def loadGenerated(self,name):
+        '''Load a toy dataset saved by saveGenerated, None if there is none'''
+        fname = '{}/generated/{}.root'.format(self.fitsDir,name)
+        if not os.path.exists(fname): return None
+        tfile = ROOT.TFile.Open(fname)
+        data = tfile.Get(name)
+        ROOT.gROOT.cd()
+        if data: data = data.Clone(name)
+        tfile.Close()
+        return data
+
+    def saveGenerated(self,data):
+        python_mkdir('{}/generated'.format(self.fitsDir))
+        tfile = ROOT.TFile.Open('{}/generated/{}.root'.format(self.fitsDir,data.GetName()),'RECREATE')
+        data.Write(data.GetName())
+        tfile.Close()
+        ROOT.gROOT.cd()
+
     ###########################
     ### Workspace utilities ###
     ###########################
@@ -472,13 +611,21 @@ class HaaLimits(Limits):
                 ws.var(param+'_{}'.format(shift) if shift else param).setVal(results[param])
         hist = histMap[self.SIGNAME.format(h=h,a=a)]
         saveDir = '{}/{}'.format(self.plotDir,shift if shift else 'central')
-        results, errors = model.fit(ws, hist, name, saveDir=saveDir, save=True, doErrors=True, xRange=[0.9*aval,1.1*aval])
-        if self.binned:
-            integral = histMap[self.SIGNAME.format(h=h,a=a)].Integral() * scale
-            integralerr = getHistogramIntegralError(histMap[self.SIGNAME.format(h=h,a=a)]) * scale
+        key = self.fitCacheKey(ws.pdf(name),hist,'fit',self.XRANGE,scale)
+        cached = self.loadFitCache(key)
+        if cached:
+            results, errors = cached['vals'], cached['errs']
+            integral, integralerr = cached['integrals'], cached['integralerrs']
         else:
-            integral = histMap[self.SIGNAME.format(h=h,a=a)].sumEntries('{0}>{1} && {0}<{2}'.format(self.XVAR,*self.XRANGE)) * scale
-            integralerr = getDatasetIntegralError(histMap[self.SIGNAME.format(h=h,a=a)],'{0}>{1} && {0}<{2}'.format(self.XVAR,*self.XRANGE)) * scale
+            results, errors = model.fit(ws, hist, name, saveDir=saveDir, save=True, doErrors=True, xRange=[0.9*aval,1.1*aval])
+            if self.binned:
+                integral = histMap[self.SIGNAME.format(h=h,a=a)].Integral() * scale
+                integralerr = getHistogramIntegralError(histMap[self.SIGNAME.format(h=h,a=a)]) * scale
+            else:
+                integral, integralerr = getDatasetIntegralAndError(histMap[self.SIGNAME.format(h=h,a=a)],{self.XVAR: self.XRANGE})
+                integral *= scale
+                integralerr *= scale
+            self.dumpFitCache(key,{'vals': results, 'errs': errors, 'integrals': integral, 'integralerrs': integralerr})
 
         savedir = '{}/{}'.format(self.fitsDir,shift if shift else 'central')
         python_mkdir(savedir)
@@ -1033,12 +1180,26 @@ class HaaLimits(Limits):
             integralerr = getHistogramIntegralError(hist,hist.FindBin(self.XRANGE[0]),hist.FindBin(self.XRANGE[1])) * scale
             data = ROOT.RooDataHist(name,name,ROOT.RooArgList(workspace.var(xVar)),hist)
         else:
-            integral = hist.sumEntries('{0}>{1} && {0}<{2}'.format(xVar,*self.XRANGE)) * scale
-            integralerr = getDatasetIntegralError(hist,'{0}>{1} && {0}<{2}'.format(xVar,*self.XRANGE)) * scale
+            integral, integralerr = getDatasetIntegralAndError(hist,{xVar: self.XRANGE})
+            integral *= scale
+            integralerr *= scale
             # TODO add support for xVar
             data = hist.Clone(name)
 
-        fr = model.fitTo(data, ROOT.RooFit.Save(), ROOT.RooFit.SumW2Error(True), ROOT.RooFit.PrintLevel(-1))
+        key = self.fitCacheKey(model,hist,'fitBackground',self.XRANGE)
+        cached = self.loadFitCache(key)
+        if cached:
+            vals, errs = cached['vals'], cached['errs']
+            self.setFitValues(workspace,vals,errs)
+        else:
+            fr = model.fitTo(data, ROOT.RooFit.Save(), ROOT.RooFit.SumW2Error(True), ROOT.RooFit.PrintLevel(-1))
+            pars = fr.floatParsFinal()
+            vals = {}
+            errs = {}
+            for p in range(pars.getSize()):
+                vals[pars.at(p).GetName()] = pars.at(p).getValV()
+                errs[pars.at(p).GetName()] = pars.at(p).getError()
+            self.dumpFitCache(key,{'vals':vals, 'errs':errs})
 
         workspace.var(xVar).setBins(self.XBINNING)
 
@@ -1047,13 +1208,6 @@ class HaaLimits(Limits):
             self.plotModelX(workspace,xVar,data,model,region,shift,xRange=[2.5,5],postfix='jpsi')
             self.plotModelX(workspace,xVar,data,model,region,shift,xRange=[8,12],postfix='upsilon')
 
-        pars = fr.floatParsFinal()
-        vals = {}
-        errs = {}
-        for p in range(pars.getSize()):
-            vals[pars.at(p).GetName()] = pars.at(p).getValV()
-            errs[pars.at(p).GetName()] = pars.at(p).getError()
-
         python_mkdir(self.fitsDir)
         jfile = '{}/background_{}{}.json'.format(self.fitsDir,region,'_'+shift if shift else '')
         results = {'vals':vals, 'errs':errs, 'integral':integral, 'integralerr': integralerr}
@@ -1091,6 +1245,7 @@ class HaaLimits(Limits):
         mh = kwargs.pop('h',125)
         ma = kwargs.pop('a',15)
         scale = kwargs.pop('scale',1)
+        reuseGenerated = kwargs.pop('reuseGenerated',False)
 
         workspace = self.workspace
 
@@ -1148,7 +1303,10 @@ class HaaLimits(Limits):
 
             name = 'data_obs_{}'.format(region)
             hist = self.histMap[region]['']['data']
-            if blind:
+            generated = self.loadGenerated(name) if blind and reuseGenerated else None
+            if generated:
+                data_obs = generated
+            elif blind:
                 # generate a toy data observation from the model
                 model = workspace.pdf('bg_{}'.format(region))
                 h = self.histMap[region]['']['dataNoSig']
@@ -1157,7 +1315,7 @@ class HaaLimits(Limits):
                     integral = h.Integral(h.FindBin(self.XRANGE[0]),h.FindBin(self.XRANGE[1])) * scale
                     print "integral: " + str(integral)
                 else:
-                    integral = h.sumEntries('{0}>{1} && {0}<{2}'.format(xVar,*self.XRANGE)) * scale
+                    integral = getDatasetIntegralAndError(h,{xVar: self.XRANGE})[0] * scale
                 if asimov:
                     print "if asimov"
                     data_obs = model.generateBinned(ROOT.RooArgSet(self.workspace.var(xVar)),integral,1)
@@ -1185,6 +1343,7 @@ class HaaLimits(Limits):
                         print sig_obs
                         data_obs.append(sig_obs)
                 data_obs.SetName(name)
+                self.saveGenerated(data_obs)
             else:
                 # use the provided data
                 if hist.InheritsFrom('TH1'):
@@ -4,55 +4,152 @@ import sys
 import glob
 import json
 import pickle
+import errno
+import hashlib
+import collections
+import numpy as np
 
 
 import ROOT
 ROOT.gROOT.SetBatch(ROOT.kTRUE)
 ROOT.gROOT.ProcessLine("gErrorIgnoreLevel = 2001;")
+
+from CombineLimitsRunII.Limits.utilities import fillHistogram, fillDataset, getDatasetArrays
+
+###### File handle pool ########################
+MAXOPENFILES = 50
+MAXVIEWS = 200
+_openFiles = collections.OrderedDict() # file name -> (TFile, {object name: object})
+_views = collections.OrderedDict()
+
+def getFile(f):
+    '''Open a file, keeping at most MAXOPENFILES handles open (least recently used are closed first)'''
+    if f in _openFiles:
+        entry = _openFiles.pop(f)
+    else:
+        tfile = ROOT.TFile.Open(f)
+        if not tfile or tfile.IsZombie(): raise IOError('Could not open {}'.format(f))
+        while len(_openFiles)>=MAXOPENFILES:
+            oldf, (oldfile, oldobjs) = _openFiles.popitem(last=False)
+            oldobjs.clear()
+            oldfile.Close()
+        entry = (tfile, {})
+    _openFiles[f] = entry
+    return entry[0]
+
+def getObject(f,name='dataColl'):
+    '''Get an object from a pooled file, reading it only once'''
+    tfile = getFile(f)
+    objs = _openFiles[f][1]
+    if name not in objs:
+        objs[name] = tfile.Get(name)
+    return objs[name]
+
+def getFileArrays(f,name='dataColl'):
+    '''
+    numpy columns and weights of a pooled dataset, read in a single pass and kept
+    with the file handle. All range selections of the file are applied to these.
+    '''
+    getFile(f)
+    objs = _openFiles[f][1]
+    key = 'arrays:'+name
+    if key not in objs:
+        objs[key] = getDatasetArrays(getObject(f,name))
+    return objs[key]
+
+def clearViews():
+    _views.clear()
+
+def closeFiles():
+    '''Close all pooled files and forget the cached views, call once the inputs are loaded'''
+    while _openFiles:
+        f, (tfile, objs) = _openFiles.popitem()
+        objs.clear()
+        tfile.Close()
+    clearViews()
+
+def getView(kind,f,**kwargs):
+    '''
+    Memoized dataset or histogram view of a file, keeping the last MAXVIEWS views.
+    kind is one of the VIEWFUNCS keys ('dataset', 'fake', 'arrays', 'hist2D', 'columns', ...).
+    The same object is returned for identical requests, clone it before modifying.
+    '''
+    key = (kind,f,tuple(sorted([(k,repr(v)) for k,v in kwargs.items()])))
+    if key in _views:
+        view = _views.pop(key)
+    else:
+        view = VIEWFUNCS[kind](f,**kwargs)
+        while len(_views)>=MAXVIEWS:
+            _views.popitem(last=False)
+    _views[key] = view
+    return view
+
+def selectDataColl(ds,selection='1',weight='',xRange=[],yRange=[],xVar='invMassMuMu',yVar='visFourbodyMass'):
+    '''Copy the selected part of a dataColl, leaving the (pooled) original untouched'''
+    args=ds.get()
+    x = args.find('invMassMuMu')
+    y = args.find('visFourbodyMass')
+    saved = [(v,v.GetName(),v.getMin(),v.getMax()) for v in [x,y] if v]
+    if xRange: x.setRange(*xRange)
+    if yRange: y.setRange(*yRange)
+    if xVar!='invMassMuMu': x.SetName(xVar)
+    if yVar!='visFourbodyMass': y.SetName(yVar)
+    try:
+        ds = ROOT.RooDataSet(ds.GetName(),ds.GetTitle(),ds,args,selection,weight)
+    finally:
+        for v,name,vmin,vmax in saved:
+            v.SetName(name)
+            v.setRange(vmin,vmax)
+    return ds
+
 ###### Utility to get Roodatasets ########################
 def getRooDataset(f,selection='1',weight='',xRange=[],yRange=[],project='',xVar='invMassMuMu',yVar='visFourbodyMass'):
     '''Get a RooDataset'''
-    file=ROOT.TFile.Open(f)
-    ds=file.Get('dataColl')
-    args=ds.get()
-    if xRange: args.find('invMassMuMu').setRange(*xRange)
-    if yRange: args.find('visFourbodyMass').setRange(*yRange)
-    if xVar!='invMassMuMu': args.find('invMassMuMu').SetName(xVar)
-    if yVar!='visFourbodyMass':args.find('visFourbodyMass').SetName(yVar)
-    ds = ROOT.RooDataSet(ds.GetName(),ds.GetTitle(),ds,args,selection,weight)
+    ds=getObject(f,'dataColl')
+    ds = selectDataColl(ds,selection,weight,xRange,yRange,xVar,yVar)
     if project: ds = getattr(ds,'reduce')(ROOT.RooArgSet(ds.get().find(project)))
     return ds
 
 
 def getRooDatasetFake(f,selection='1',weight='fakeRateEfficiency',xRange=[],yRange=[],project='',xVar='invMassMuMu',yVar='visFourbodyMass'):
     '''Get a DataDriven RooDataset'''
-    file=ROOT.TFile.Open(f)
-    ds=file.Get('dataColl')
-    args=ds.get()
-    if xRange: args.find('invMassMuMu').setRange(*xRange)
-    if yRange: args.find('visFourbodyMass').setRange(*yRange)
-    if xVar!='invMassMuMu': args.find('invMassMuMu').SetName(xVar)
-    if yVar!='visFourbodyMass':args.find('visFourbodyMass').SetName(yVar)
-    ds = ROOT.RooDataSet(ds.GetName(),ds.GetTitle(),ds,args,selection,weight)
+    ds=getObject(f,'dataColl')
+    ds = selectDataColl(ds,selection,weight,xRange,yRange,xVar,yVar)
     if project: ds = getattr(ds,'reduce')(ROOT.RooArgSet(ds.get().find(project)))
     return ds
 
 
 
 ###### Utility to get Histos ########################  
-def getHist2D(f,selection='1',xVar='invMassMuMu',yVar='visFourbodyMass',xBinning='',yBinning=''):
-    '''Get a 2D Histogram from RooDataset'''
-    file=ROOT.TFile.Open(f)
-    ds=file.Get('dataColl')
-    hist=ROOT.TH2F()
-    hist=ds.createHistogram(ds.get().find(xVar),ds.get().find(yVar),int(xBinning),int(yBinning),selection,ds.GetName())
+def getHist2D(f,selection='1',xVar='invMassMuMu',yVar='visFourbodyMass',xBinning='',yBinning='',ranges={}):
+    '''
+    Get a 2D Histogram from RooDataset
+    If ranges = {var: [low,high]} is given instead of a selection string the
+    histogram is booked on those ranges and filled with numpy rather than
+    evaluating the selection per event.
+    '''
+    ds=getObject(f,'dataColl')
+    if ranges:
+        x = ds.get().find(xVar)
+        y = ds.get().find(yVar)
+        xlow, xhigh = ranges.get(xVar,[x.getMin(),x.getMax()])
+        ylow, yhigh = ranges.get(yVar,[y.getMin(),y.getMax()])
+        hist=ROOT.TH2F(ds.GetName(),ds.GetName(),int(xBinning) if xBinning else x.getBins(),xlow,xhigh,int(yBinning) if yBinning else y.getBins(),ylow,yhigh)
+        fillHistogram(hist,ds,xVar,yVar,ranges)
+    else:
+        hist=ROOT.TH2F()
+        hist=ds.createHistogram(ds.get().find(xVar),ds.get().find(yVar),int(xBinning),int(yBinning),selection,ds.GetName())
     hist.SetDirectory(ROOT.gROOT) 
     return hist
 
-def getHistControl(f,selection='1',xVar='invMassMuMu',Binning='1'):
+def getHistControl(f,selection='1',xVar='invMassMuMu',Binning='1',ranges={}):
     ''' Get a 1D Control Histogram from RooDataset'''
-    file=ROOT.TFile.Open(f)
-    ds=file.Get('dataColl')
+    ds=getObject(f,'dataColl')
+    if ranges:
+        hist=ROOT.TH1F(ds.GetName(),ds.GetName(),int(Binning[0]),float(Binning[1]),float(Binning[2]))
+        fillHistogram(hist,ds,xVar,ranges=ranges)
+        hist.SetDirectory(ROOT.gROOT)
+        return hist
     args=ds.get()
     ds = ROOT.RooDataSet(ds.GetName(),ds.GetTitle(),ds,args,selection)
     hist=ROOT.TH1F()
@@ -68,9 +165,113 @@ def getHisto(f,xVar='invMassMuMu',process=''):
         xVarnew=xVar+"3P1F1"
     else:
         xVarnew=xVar
-    file=ROOT.TFile.Open(f)
-    histo=file.Get(xVarnew)
+    histo=getFile(f).Get(xVarnew)
     histo.SetDirectory(ROOT.gROOT)
     #print hist
     return histo
+
+###### Columnar storage ########################
+COLUMNDIR = 'columns'
+COLUMNS = ['invMassMuMu','visFourbodyMass','eventWeight','fakeRateEfficiency']
+
+def getColumnDir(f):
+    '''Directory holding the exported columns of a dataColl file'''
+    name = os.path.splitext(os.path.basename(f))[0]
+    return os.path.join(COLUMNDIR,'{}_{}'.format(name,hashlib.md5(f).hexdigest()[:8]))
+
+def hasColumns(f):
+    return os.path.exists(os.path.join(getColumnDir(f),'columns.json'))
+
+def exportColumns(f,columns=COLUMNS):
+    '''
+    Export the dataColl of a file as one .npy array per column.
+    Columns missing from the dataset are skipped. The columns.json index is
+    written last so a partial export is never picked up.
+    '''
+    outdir = getColumnDir(f)
+    try:
+        os.makedirs(outdir)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST: raise
+    ds = getObject(f,'dataColl')
+    names = [c for c in columns if ds.get().find(c)]
+    n = ds.numEntries()
+    data, weights = getDatasetArrays(ds)
+    for c in names:
+        np.save(os.path.join(outdir,'{}.npy'.format(c)),np.ascontiguousarray(data[c]))
+    with open(os.path.join(outdir,'columns.json'),'w') as fj:
+        fj.write(json.dumps({'file': f, 'entries': n, 'columns': names}, indent=4, sort_keys=True))
+    return outdir
+
+def loadColumns(f):
+    '''Memory-map the exported columns of a file'''
+    coldir = getColumnDir(f)
+    with open(os.path.join(coldir,'columns.json')) as fj:
+        info = json.load(fj)
+    return dict([(c,np.load(os.path.join(coldir,'{}.npy'.format(c)),mmap_mode='r')) for c in info['columns']])
+
+def datasetFromColumns(cols,name,weight='',xRange=[],yRange=[],project='',xVar='invMassMuMu',yVar='visFourbodyMass'):
+    '''RooDataSet of the x/y range selection of columns {variable: array}'''
+    mask = selectColumns(cols,xRange,yRange)
+    values = {
+        xVar: np.asarray(cols['invMassMuMu'][mask]),
+        yVar: np.asarray(cols['visFourbodyMass'][mask]),
+    }
+    ranges = {
+        xVar: xRange if xRange else [values[xVar].min(),values[xVar].max()] if len(values[xVar]) else [0,1],
+        yVar: yRange if yRange else [values[yVar].min(),values[yVar].max()] if len(values[yVar]) else [0,1],
+    }
+    names = [project] if project else [xVar,yVar]
+    vars = [ROOT.RooRealVar(n,n,*ranges[n]) for n in names]
+    args = ROOT.RooArgSet()
+    for v in vars: args.add(v)
+    if weight:
+        weights = np.asarray(cols[weight][mask])
+        wvar = ROOT.RooRealVar(weight,weight,1.)
+        allargs = ROOT.RooArgSet(args)
+        allargs.add(wvar)
+        ds = ROOT.RooDataSet(name,name,allargs,ROOT.RooFit.WeightVar(wvar))
+    else:
+        ds = ROOT.RooDataSet(name,name,args)
+    return fillDataset(ds,vars,[values[n] for n in names],weights if weight else None)
+
+def getRooDatasetFromArrays(f,weight='',xRange=[],yRange=[],project='',xVar='invMassMuMu',yVar='visFourbodyMass'):
+    '''getRooDataset/getRooDatasetFake for range selections, from the single pass over the dataColl of the file'''
+    values, weights = getFileArrays(f)
+    return datasetFromColumns(values,getObject(f,'dataColl').GetName(),weight,xRange,yRange,project,xVar,yVar)
+
+def selectColumns(cols,xRange=[],yRange=[]):
+    '''Vectorized version of the x/y range selection strings'''
+    mask = np.ones(len(cols['invMassMuMu']),dtype=bool)
+    if xRange: mask &= (cols['invMassMuMu']>xRange[0]) & (cols['invMassMuMu']<xRange[1])
+    if yRange: mask &= (cols['visFourbodyMass']>yRange[0]) & (cols['visFourbodyMass']<yRange[1])
+    return mask
+
+def getRooDatasetFromColumns(f,weight='',xRange=[],yRange=[],project='',xVar='invMassMuMu',yVar='visFourbodyMass',name='dataColl'):
+    '''Build the equivalent of getRooDataset/getRooDatasetFake from the exported columns'''
+    return datasetFromColumns(loadColumns(f),name,weight,xRange,yRange,project,xVar,yVar)
+
+def getHist2DFromColumns(f,xRange,yRange,xBinning,yBinning,weight='',name='dataColl'):
+    '''Fill the equivalent of getHist2D from the exported columns with a single FillN'''
+    cols = loadColumns(f)
+    mask = selectColumns(cols,xRange,yRange)
+    xs = np.ascontiguousarray(cols['invMassMuMu'][mask],dtype=np.float64)
+    ys = np.ascontiguousarray(cols['visFourbodyMass'][mask],dtype=np.float64)
+    ws = np.ascontiguousarray(cols[weight][mask],dtype=np.float64) if weight else np.ones(len(xs))
+    hist = ROOT.TH2F(name,name,int(xBinning),xRange[0],xRange[1],int(yBinning),yRange[0],yRange[1])
+    hist.Sumw2()
+    if len(xs): hist.FillN(len(xs),xs,ys,ws)
+    hist.SetDirectory(ROOT.gROOT)
+    return hist
+
+VIEWFUNCS = {
+    'dataset'    : getRooDataset,
+    'fake'       : getRooDatasetFake,
+    'arrays'     : getRooDatasetFromArrays,
+    'hist2D'     : getHist2D,
+    'histControl': getHistControl,
+    'histo'      : getHisto,
+    'columns'    : getRooDatasetFromColumns,
+    'columnsHist2D': getHist2DFromColumns,
+}
     
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+'''
+Precomputed 2HDM+S B(a -> mumu) x B(a -> tautau) lookup table.
+
+The BR_{type}_{tanb}.dat text files are parsed once and stored as a single
+binary grid (model x tanb x m_a) in an npz file. The table is evaluated for
+many masses at once: linear in m_a like TGraph::Eval on the original graphs,
+and linear in tanb between the tabulated values.
+'''
+
+import os
+import sys
+import logging
+import argparse
+
+import numpy as np
+
+BRDIR = 'haa_br_data/BR'
+BRTABLEFILE = 'haa_br_data/BR/br_table.npz'
+MODELTYPES = [1,2,3,4]
+TANBS = [0.5,0.6,0.7,0.8,0.9,1.0,1.5,2.0,2.5,3.0,3.5,4.0,4.5,5.0,5.5,6.0,6.5,7.0,7.5,8.0,8.5,9.0,9.5,10.0]
+
+mtmap = {1:'I',2:'II',3:'III',4:'IV'}
+
+def getBRFileName(m,tb,brDir=BRDIR):
+    '''Type I does not depend on tanb'''
+    if m==1:
+        return '{}/BR_I.dat'.format(brDir)
+    return '{}/BR_{}_{:.1f}.dat'.format(brDir,mtmap[m],tb)
+
+def readBRFile(fname):
+    '''m_a and 2 B(a -> mumu) B(a -> tautau) from a BR file'''
+    data = np.loadtxt(fname,usecols=(1,5,6),ndmin=2)
+    ma, att, amm = data[:,0], data[:,1], data[:,2]
+    return ma, 2*amm*att
+
+def getLinearWeights(x,xout):
+    '''
+    Indices and weights of a linear interpolation on sorted x, extrapolating
+    from the outermost points: y(xout) = y[i0]*(1-t)+y[i1]*t.
+    '''
+    xout = np.asarray(xout,dtype=float)
+    if len(x)<2:
+        i = np.zeros(xout.shape,dtype=int)
+        return i, i, np.zeros(xout.shape)
+    i1 = np.clip(np.searchsorted(x,xout),1,len(x)-1)
+    i0 = i1-1
+    dx = x[i1]-x[i0]
+    t = np.where(dx!=0,(xout-x[i0])/np.where(dx!=0,dx,1.),0.)
+    return i0, i1, t
+
+#############
+### table ###
+#############
+def buildBRTable(**kwargs):
+    '''
+    Parse the BR files into {'models', 'tanbs', 'masses', 'br'} with br[model][tanb][m_a].
+    Files with a different m_a binning are interpolated to the union of all masses.
+    '''
+    brDir = kwargs.pop('brDir',BRDIR)
+    models = kwargs.pop('models',MODELTYPES)
+    tanbs = kwargs.pop('tanbs',TANBS)
+
+    curves = {}
+    for m in models:
+        for tb in tanbs:
+            fname = getBRFileName(m,tb,brDir)
+            if fname not in curves:
+                ma, br = readBRFile(fname)
+                order = np.argsort(ma,kind='mergesort')
+                curves[fname] = (ma[order], br[order])
+
+    masses = np.unique(np.concatenate([ma for ma, br in curves.values()]))
+    table = np.zeros((len(models),len(tanbs),len(masses)))
+    for i, m in enumerate(models):
+        for j, tb in enumerate(tanbs):
+            ma, br = curves[getBRFileName(m,tb,brDir)]
+            if np.array_equal(ma,masses):
+                table[i,j] = br
+            else:
+                i0, i1, t = getLinearWeights(ma,masses)
+                table[i,j] = br[i0]*(1-t)+br[i1]*t
+
+    return {'models': np.array(models), 'tanbs': np.array(tanbs,dtype=float), 'masses': masses, 'br': table}
+
+def dumpBRTable(table,fname=BRTABLEFILE):
+    np.savez_compressed(fname,**table)
+
+def loadBRTable(fname=BRTABLEFILE):
+    with np.load(fname) as data:
+        return dict([(key,data[key]) for key in data.files])
+
+def evalBR(table,model,tanb,ma):
+    '''
+    2 B(a -> mumu) B(a -> tautau) for one model, vectorized in tanb and m_a (broadcast together).
+    tanb is clamped to the tabulated range.
+    '''
+    i = list(table['models']).index(model)
+    tanbs = table['tanbs']
+    tanb = np.clip(np.asarray(tanb,dtype=float),tanbs[0],tanbs[-1])
+    ma = np.asarray(ma,dtype=float)
+    tanb, ma = np.broadcast_arrays(tanb,ma)
+    j0, j1, u = getLinearWeights(tanbs,tanb)
+    k0, k1, t = getLinearWeights(table['masses'],ma)
+    br = table['br'][i]
+    return (br[j0,k0]*(1-t)+br[j0,k1]*t)*(1-u) + (br[j1,k0]*(1-t)+br[j1,k1]*t)*u
+
+def getHistArrays(hist):
+    '''Bin edges and contents (including under- and overflow, content[x][y]) of a TH2'''
+    xaxis = hist.GetXaxis()
+    yaxis = hist.GetYaxis()
+    xedges = np.array([xaxis.GetBinLowEdge(b) for b in range(1,xaxis.GetNbins()+2)])
+    yedges = np.array([yaxis.GetBinLowEdge(b) for b in range(1,yaxis.GetNbins()+2)])
+    content = np.array([[hist.GetBinContent(bx,by) for by in range(len(yedges)+1)] for bx in range(len(xedges)+1)])
+    return xedges, yedges, content
+
+def getHistBinContents(hist,xs,ys,arrays=None):
+    '''Vectorized hist.GetBinContent(hist.FindBin(x,y)), pass arrays from getHistArrays to reuse them'''
+    xedges, yedges, content = arrays if arrays else getHistArrays(hist)
+    bx = np.searchsorted(xedges,np.asarray(xs,dtype=float),side='right')
+    by = np.searchsorted(yedges,np.asarray(ys,dtype=float),side='right')
+    return content[bx,by]
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Convert the 2HDM+S BR files into a binary lookup table')
+
+    parser.add_argument('--brDir', type=str, default=BRDIR, help='Directory with the BR_{type}_{tanb}.dat files')
+    parser.add_argument('--output', type=str, default=BRTABLEFILE, help='Output table')
+    parser.add_argument('--models', type=int, nargs='+', default=MODELTYPES, help='2HDM+S types')
+    parser.add_argument('--tanbs', type=float, nargs='+', default=TANBS, help='tan(beta) values')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    table = buildBRTable(brDir=args.brDir,models=args.models,tanbs=args.tanbs)
+    dumpBRTable(table,args.output)
+    logging.info('Wrote {} models x {} tanb x {} masses to {}'.format(len(table['models']),len(table['tanbs']),len(table['masses']),args.output))
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
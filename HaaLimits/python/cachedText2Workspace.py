@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+'''
+A wrapper of text2workspace.py that keeps one compiled workspace per datacard.
+
+The workspaces are stored under WORKSPACECACHEDIR keyed on a hash of the datacard,
+the shape files it references and the text2workspace options, and linked to
+the requested output. An unchanged card is only compiled once no matter how
+many a masses or submissions use it.
+'''
+
+import os
+import sys
+import json
+import errno
+import shutil
+import hashlib
+import logging
+import argparse
+import subprocess
+
+WORKSPACECACHEDIR = 'workspaces/cache'
+
+def python_mkdir(dir):
+    '''A function to make a unix directory as well as subdirectories'''
+    try:
+        os.makedirs(dir)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(dir):
+            pass
+        else: raise
+
+_fileHashes = {}
+
+def hashFile(fname):
+    '''Content hash of a file, memoized on path, size and modification time'''
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime)
+    if key not in _fileHashes:
+        md5 = hashlib.md5()
+        with open(fname,'rb') as f:
+            for chunk in iter(lambda: f.read(1<<20), b''):
+                md5.update(chunk)
+        _fileHashes[key] = md5.hexdigest()
+    return _fileHashes[key]
+
+def getShapeFiles(datacard):
+    '''Files referenced by the shapes lines of a datacard, relative to the current directory'''
+    cardDir = os.path.dirname(datacard)
+    files = []
+    with open(datacard) as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens)<4 or tokens[0]!='shapes': continue
+            fname = tokens[3]
+            if fname=='FAKE': continue
+            if not os.path.isabs(fname): fname = os.path.join(cardDir,fname)
+            if fname not in files: files += [fname]
+    return files
+
+def hashDatacard(datacard,options=''):
+    '''Hash of the datacard, its shape files and the text2workspace options'''
+    md5 = hashlib.md5()
+    md5.update(hashFile(datacard))
+    for fname in getShapeFiles(datacard):
+        md5.update(os.path.basename(fname))
+        md5.update(hashFile(fname) if os.path.exists(fname) else 'missing')
+    md5.update(' '.join(options.split()))
+    md5.update(os.environ.get('CMSSW_VERSION',''))
+    return md5.hexdigest()
+
+def linkWorkspace(source,output):
+    '''Hard link the cached workspace to the output, copy if on another filesystem'''
+    if os.path.abspath(source)==os.path.abspath(output): return
+    if os.path.lexists(output): os.remove(output)
+    outDir = os.path.dirname(output)
+    if outDir: python_mkdir(outDir)
+    try:
+        os.link(source,output)
+    except OSError:
+        shutil.copy2(source,output)
+
+def getCachedWorkspace(datacard,output,mass=None,options='',**kwargs):
+    '''
+    Produce the text2workspace.py output for a datacard, reusing a cached build if possible.
+    Returns the path to the output workspace.
+    '''
+    cacheDir = kwargs.pop('cacheDir',WORKSPACECACHEDIR)
+    force = kwargs.pop('force',False)
+    dryrun = kwargs.pop('dryrun',False)
+
+    if mass is not None: options = '-m {} {}'.format(mass,options)
+    key = hashDatacard(datacard,options)
+    cached = os.path.join(cacheDir,'{}.root'.format(key))
+
+    if force or not os.path.exists(cached):
+        python_mkdir(cacheDir)
+        tmp = os.path.join(cacheDir,'{}.{}.tmp.root'.format(key,os.getpid()))
+        command = 'text2workspace.py {datacard} {options} -o {tmp}'.format(datacard=datacard,options=options,tmp=tmp)
+        if dryrun:
+            logging.info(command)
+            return output
+        logging.info('Building workspace for {}'.format(datacard))
+        logging.debug(command)
+        status = subprocess.call(command,shell=True)
+        if status or not os.path.exists(tmp):
+            if os.path.exists(tmp): os.remove(tmp)
+            raise RuntimeError('text2workspace.py failed for {}'.format(datacard))
+        os.rename(tmp,cached)
+        with open(os.path.join(cacheDir,'{}.json'.format(key)),'w') as f:
+            json.dump({'datacard': datacard, 'options': options, 'shapes': getShapeFiles(datacard)},f,indent=4,sort_keys=True)
+    else:
+        logging.info('Reusing cached workspace for {}'.format(datacard))
+
+    linkWorkspace(cached,output)
+    return output
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Run text2workspace.py with a persistent workspace cache')
+
+    parser.add_argument('datacard', type=str, help='Datacard')
+    parser.add_argument('-o','--output', type=str, required=True, help='Output workspace')
+    parser.add_argument('-m','--mass', type=str, default=None, help='Mass passed to text2workspace.py')
+    parser.add_argument('--options', type=str, default='', help='Additional text2workspace.py options')
+    parser.add_argument('--cacheDir', type=str, default=WORKSPACECACHEDIR, help='Directory for the cached workspaces')
+    parser.add_argument('--force', action='store_true', help='Rebuild even if a cached workspace exists')
+    parser.add_argument('--dryrun', action='store_true', help='Only print the text2workspace.py command')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    getCachedWorkspace(args.datacard,args.output,mass=args.mass,options=args.options,cacheDir=args.cacheDir,force=args.force,dryrun=args.dryrun)
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
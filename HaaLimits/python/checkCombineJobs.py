@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+'''
+Find the missing and failed combine jobs of a scan and resubmit them together.
+
+The expected jobs come from the same arguments as runCombineLocal.py. Their
+outputs and logs are inspected on a process pool and every job is classified
+as done, missing (no output and no log) or failed (error markers in the log,
+empty or unreadable output). The jobs that are not done are written to a
+single resubmission list and, with --resubmit, run again in one batch.
+
+Replaces GetMissingFilesFromELSFile.py and GetMassPoints.sh.
+'''
+
+import os
+import sys
+import glob
+import logging
+import argparse
+from multiprocessing import Pool
+
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch()
+
+from runCombineLocal import addJobArguments, getJobsFromArgs, runJobs, FAILUREMARKERS
+
+OUTPUTPATTERN = '{outputDirectory}/{tag}/higgsCombine{name}.*.root'
+LOGPATTERN = '{outputDirectory}/logs/{name}.log'
+RESUBMITFILE = 'resubmit.txt'
+
+def isValidOutput(fname):
+    '''Non-empty file with a filled limit tree'''
+    if os.path.getsize(fname)==0: return False
+    tfile = ROOT.TFile.Open(fname)
+    if not tfile or tfile.IsZombie(): return False
+    tree = tfile.Get('limit')
+    valid = bool(tree) and tree.GetEntries()>0
+    tfile.Close()
+    return valid
+
+def checkJob(args):
+    '''Classify one job as done, missing or failed'''
+    job, outputGlob, log = args
+    outputs = sorted(glob.glob(outputGlob))
+    markers = []
+    if os.path.exists(log):
+        with open(log) as f:
+            text = f.read()
+        markers = [m for m in FAILUREMARKERS if m in text]
+    invalid = [o for o in outputs if not isValidOutput(o)]
+
+    if outputs and not invalid and not markers:
+        status = 'done'
+    elif outputs or os.path.exists(log):
+        status = 'failed'
+    else:
+        status = 'missing'
+    return job['name'], {'status': status, 'outputs': outputs, 'invalid': invalid, 'markers': markers, 'log': log}
+
+def checkJobs(jobs,outputDirectory,**kwargs):
+    '''Returns {name: result} for all jobs'''
+    outputPattern = kwargs.pop('outputPattern',OUTPUTPATTERN)
+    logPattern = kwargs.pop('logPattern',LOGPATTERN)
+    nCores = kwargs.pop('nCores',1)
+
+    tasks = []
+    for job in jobs:
+        fields = dict(job,outputDirectory=outputDirectory)
+        tasks += [(job,outputPattern.format(**fields),logPattern.format(**fields))]
+
+    if nCores>1 and len(tasks)>1:
+        pool = Pool(nCores)
+        results = pool.map(checkJob,tasks,chunksize=max(1,len(tasks)//(4*nCores)))
+        pool.close()
+        pool.join()
+    else:
+        results = [checkJob(task) for task in tasks]
+    return dict(results)
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Find missing and failed combine jobs and resubmit them')
+
+    addJobArguments(parser)
+    parser.add_argument('--outputPattern', type=str, default=OUTPUTPATTERN, help='Output glob, formatted with the job (name, tag) and outputDirectory')
+    parser.add_argument('--logPattern', type=str, default=LOGPATTERN, help='Log file, formatted with the job (name, tag) and outputDirectory')
+    parser.add_argument('--resubmitFile', type=str, default=RESUBMITFILE, help='File for the commands of the jobs to resubmit')
+    parser.add_argument('--resubmit', action='store_true', help='Run the missing and failed jobs on the local pool')
+    parser.add_argument('--retries', type=int, default=0, help='Number of retries when resubmitting')
+    parser.add_argument('-j', type=int, default=1, help='Number of cores')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    jobs = getJobsFromArgs(args)
+    if jobs is None: return 1
+
+    results = checkJobs(jobs,args.outputDirectory,outputPattern=args.outputPattern,logPattern=args.logPattern,nCores=args.j)
+
+    counts = {}
+    for name in sorted(results):
+        status = results[name]['status']
+        counts[status] = counts.get(status,0)+1
+        if status=='failed':
+            reason = ', '.join(results[name]['markers'] + ['invalid {}'.format(o) for o in results[name]['invalid']]) or 'no output'
+            logging.info('Failed: {} ({})'.format(name,reason))
+        elif status=='missing':
+            logging.debug('Missing: {}'.format(name))
+    logging.info('Jobs: {} done, {} missing, {} failed'.format(counts.get('done',0),counts.get('missing',0),counts.get('failed',0)))
+
+    toResubmit = [job for job in jobs if results[job['name']]['status']!='done']
+    with open(args.resubmitFile,'w') as f:
+        for job in toResubmit:
+            f.write(job['command']+'\n')
+    logging.info('Wrote {} commands to {}'.format(len(toResubmit),args.resubmitFile))
+
+    if args.resubmit and toResubmit:
+        failed = runJobs(toResubmit,args.outputDirectory,nCores=args.j,retries=args.retries,force=True)
+        return 1 if failed else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,62 @@
+import os
+import sys
+import logging
+import argparse
+from multiprocessing import Pool
+
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch()
+
+from RunIISampleMaps import *
+import RunIIDatasetUtils
+from RunIIDatasetUtils import exportColumns, hasColumns
+
+def exportWrapper(f):
+    logging.info('Exporting {}'.format(f))
+    return exportColumns(f)
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Export the dataColl RooDatasets to numpy column files')
+
+    parser.add_argument('files', type=str, nargs='*', default=[], help='Files to export (default: all unbinned samples in SampleMap2017)')
+    parser.add_argument('--outputDirectory', type=str, default=RunIIDatasetUtils.COLUMNDIR, help='Directory for the column files')
+    parser.add_argument('--force', action='store_true', help='Export again even if columns exist')
+    parser.add_argument('-j', type=int, default=1, help='Number of cores')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    RunIIDatasetUtils.COLUMNDIR = args.outputDirectory
+
+    files = args.files
+    if not files:
+        files = sorted(set([f for proc in SampleMap2017 for f in SampleMap2017[proc] if 'control' not in proc]))
+    if not args.force:
+        files = [f for f in files if not hasColumns(f)]
+
+    logging.info('Exporting {} files'.format(len(files)))
+    if args.j>1:
+        pool = Pool(args.j)
+        pool.map(exportWrapper,files,chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        for f in files:
+            exportWrapper(f)
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -179,6 +179,7 @@ rebinning = {
 
 project = False
 hCut = '1'
+useColumns = False # build datasets from the exported numpy columns when available (see exportRunIIColumns.py)
 
 #xsec splines
 smtfile  = ROOT.TFile.Open('/uscms_data/d3/rhabibul/CombineRunII/CMSSW_10_2_13/src/CombineLimitsRunII/Limits/data/Higgs_YR4_SM_13TeV.root')
@@ -232,25 +233,25 @@ def getDataset(File,channel,type):
             #    integral = dataset.sumEntries('{0}>{1} && {0}<{2}'.format(xVar,*thisxrange))
             #    print sample, plotname, integral
     if channel=="TauMuTauHad" or channel=="TauETauHad":
-        if project and 'datadriven' in type:
-            dataset =getRooDatasetFake(File,selection=' && '.join([selDatasets['invMassMuMu'],selDatasets['visFourbodyMass']]),xRange=thisxrange,weight='fakeRateEfficiency',yRange=thisyrange,project=xVar,xVar=xVar,yVar=yVar)  
-        elif not project and 'datadriven' in type:
-            dataset =getRooDatasetFake(File,selection=' && '.join([selDatasets['invMassMuMu'],selDatasets['visFourbodyMass']]),xRange=thisxrange,weight='fakeRateEfficiency',yRange=thisyrange,project='',xVar=xVar,yVar=yVar)
+        # all range selections of a file come from one pass over its dataColl (or its exported columns)
+        kind = 'columns' if useColumns and hasColumns(File) else 'arrays'
+        if 'datadriven' in type:
+            dataset = getView(kind,File,weight='fakeRateEfficiency',xRange=thisxrange,yRange=thisyrange,project=xVar if project else '',xVar=xVar,yVar=yVar)
         elif not project and 'data' in type:
-            dataset =getRooDataset(File,selection=' && '.join([selDatasets['invMassMuMu'],selDatasets['visFourbodyMass']]),xRange=thisxrange,weight='',yRange=thisyrange,project='',xVar=xVar,yVar=yVar)
+            dataset = getView(kind,File,weight='',xRange=thisxrange,yRange=thisyrange,xVar=xVar,yVar=yVar)
         else:
-            dataset =getRooDataset(File,selection=' && '.join([selDatasets['invMassMuMu'],selDatasets['visFourbodyMass']]),xRange=thisxrange,weight='eventWeight',yRange=thisyrange,project='',xVar=xVar,yVar=yVar)
+            dataset = getView(kind,File,weight='eventWeight',xRange=thisxrange,yRange=thisyrange,xVar=xVar,yVar=yVar)
     # else:
     #      dataset =getRooDataset(File,selection=selDatasets['invMassMuMu'],xRange=thisxrange,weight='w',xVar=xVar)  
     elif channel =="TauMuTauE":
         print File
         if 'datadriven' in type:
             print type
-            dataset=getHisto(File,process='datadriven')
+            dataset=getView('histo',File,process='datadriven')
         elif 'data' in type:
-            dataset= getHisto(File,process='data')
+            dataset= getView('histo',File,process='data')
         else:
-            dataset=getHisto(File,process='signal')
+            dataset=getView('histo',File,process='signal')
     else:
         raise ValueError('Channel Unknown in getDataset')
                 
@@ -266,6 +267,15 @@ selHists = {
     'visFourbodyMass' : '{0}>{1} && {0}<{2}'.format(yVar,*yRange),
     }
 
+def getHist2DView(f):
+    '''2D histogram of a file, filled from the exported columns when available'''
+    # both paths book the same binning, the histograms of all files are summed
+    xBinning = xBins[0]
+    yBinning = int(yRange[1]-yRange[0])
+    if useColumns and hasColumns(f):
+        return getView('columnsHist2D',f,xRange=xRange,yRange=yRange,xBinning=xBinning,yBinning=yBinning)
+    return getView('hist2D',f,ranges={xVar: xRange, yVar: yRange},xBinning=xBinning,yBinning=yBinning)
+
 
 def getControlHist(proc,**kwargs):
     wrappers = kwargs.pop('wrappers',{})
@@ -283,7 +293,7 @@ def getControlHist(proc,**kwargs):
 
     #else:
     # Takes far too long to do this unbinned
-    hists = [getHistControl(s,Binning=xBins) for s in SampleMap2017[proc]]
+    hists = [getView('histControl',s,Binning=xBins,ranges={xVar: xRange}) for s in SampleMap2017[proc]]
     if len(hists) >1:
         hist = sumHists(proc,*hists)
     else:
@@ -342,7 +352,7 @@ def getHist(proc,channel,**kwargs):
             if do2D:
                 #hists = [wrappers[s+shift].getHist2D(plotname) for s in sampleMap[proc]]
                 #hists = [getHist2D(s,selection=' && '.join([selHists['invMassMuMu'],selHists['visFourbodyMass']])) for s in SampleMap2017[proc] if '_'+region in s and channel[0] in s]
-                hists = [getHist2D(s,selection=' && '.join([selHists['invMassMuMu'],selHists['visFourbodyMass']])) for s in SampleMap2017[proc] if '_'+region in s and channel in s and '_'+ discriminators[6] in s]  
+                hists = [getHist2DView(s) for s in SampleMap2017[proc] if '_'+region in s and channel in s and '_'+ discriminators[6] in s]  
                 if len(hists)>1:
                     hist = sumHists(name,*hists)
                 else:
@@ -419,7 +429,7 @@ def getDatadrivenHist(proc,channel,**kwargs):
             #for plotname in plotnames:
             if do2D:
                 #hists = [getHist2D(s,selection=' && '.join([selHists['invMassMuMu'],selHists['visFourbodyMass']])) for s in SampleMap2017[proc] if '_'+region in s and channel[0] in s]
-                hists = [getHist2D(s,selection=' && '.join([selHists['invMassMuMu'],selHists['visFourbodyMass']])) for s in SampleMap2017[proc] if '_'+region in s and channel in s and '_'+discriminators[6] in s]
+                hists = [getHist2DView(s) for s in SampleMap2017[proc] if '_'+region in s and channel in s and '_'+discriminators[6] in s]
                 #hists += [wrappers[s+shift].getHist2D(plotname) for s in sampleMap['datadriven'] if '_'+region in s and channels[1] in s]
             else:
                 hists += [wrappers[s+shift].getHist(plotname) for s in sampleMap['datadriven'] if '_'+region in s and channels[3] in s] 
@@ -477,7 +487,8 @@ def tempPlot(name,dataset):
 ###############
 
 def create_datacard(args):
-    global j
+    global j, useColumns
+    useColumns = args.columns
     doMatrix = False
     doParametric = args.parametric
     doUnbinned = args.unbinned
@@ -682,6 +693,9 @@ def create_datacard(args):
             j+=1
             histMap[mode][shift]['dataNoSig'] = hist.Clone('hist'+str(j))
 
+    # everything is cloned into histMap, release the input files and views
+    closeFiles()
+
     # rescale signal
     scales = {}
     for proc in signals:
@@ -744,6 +758,7 @@ def create_datacard(args):
     haaLimits.XRANGE = xRange
     haaLimits.XBINNING = int((xRange[1]-xRange[0])/xBinWidth)
     haaLimits.XVAR = xVar
+    haaLimits.BINNEDPREFIT = args.binnedPrefit
     if do2D: 
         haaLimits.YVAR = yVar
         haaLimits.YRANGE = yRange
@@ -751,28 +766,40 @@ def create_datacard(args):
         haaLimits.DOUBLEEXPO = args.doubleExpo
     if 'tt' in var: haaLimits.YLABEL = 'm_{#tau_{#mu}#tau_{h}}'
     if 'h' in var or 'hkf' in var: haaLimits.YLABEL = 'm_{#mu#mu#tau_{#mu}#tau_{h}}'
+    if args.incremental:
+        # only redo the work of stages whose inputs changed since the last build
+        config = sorted([(k,v) for k,v in vars(args).items() if k not in ['j','incremental']])
+        stageKeys = haaLimits.getStageKeys(config=config)
+        changed = dict([(stage,haaLimits.stageChanged(stage,key)) for stage,key in stageKeys.items()])
+    else:
+        changed = {'control': True, 'background': True, 'signal': True, 'data': True}
     haaLimits.initializeWorkspace()
+    haaLimits.SKIPPLOTS = skipPlots or not changed['control']
     haaLimits.addControlModels()
-    haaLimits.addBackgroundModels(fixAfterControl=True)
+    haaLimits.SKIPPLOTS = skipPlots or not changed['background']
+    haaLimits.addBackgroundModels(fixAfterControl=True,nCores=args.j)
+    haaLimits.SKIPPLOTS = skipPlots
+    # reuse the saved signal fits if the signal inputs are unchanged
+    signalLoad = {} if changed['signal'] else {'load': True, 'skipFit': True}
     if not skipSignal:
         haaLimits.XRANGE = [0,30] # override for signal splines
         if project:
-            haaLimits.addSignalModels(scale=scales)
+            haaLimits.addSignalModels(scale=scales,nCores=args.j,warmStart=args.warmStart,**signalLoad)
         elif 'tt' in var:
             if args.yFitFunc:
-                haaLimits.addSignalModels(scale=scales,yFitFuncFP=args.yFitFunc,yFitFuncPP=args.yFitFunc)#,cutOffFP=0.0,cutOffPP=0.0)
+                haaLimits.addSignalModels(scale=scales,nCores=args.j,warmStart=args.warmStart,yFitFuncFP=args.yFitFunc,yFitFuncPP=args.yFitFunc,**signalLoad)#,cutOffFP=0.0,cutOffPP=0.0)
             else:
-                haaLimits.addSignalModels(scale=scales,yFitFuncFP='V',yFitFuncPP='L')#,cutOffFP=0.75,cutOffPP=0.75)
+                haaLimits.addSignalModels(scale=scales,nCores=args.j,warmStart=args.warmStart,yFitFuncFP='V',yFitFuncPP='L',**signalLoad)#,cutOffFP=0.75,cutOffPP=0.75)
         elif 'h' in var or 'hkf' in var:
             if args.yFitFunc:
-                haaLimits.addSignalModels(scale=scales,yFitFuncFP=args.yFitFunc,yFitFuncPP=args.yFitFunc)#,cutOffFP=0.0,cutOffPP=0.0)
+                haaLimits.addSignalModels(scale=scales,nCores=args.j,warmStart=args.warmStart,yFitFuncFP=args.yFitFunc,yFitFuncPP=args.yFitFunc,**signalLoad)#,cutOffFP=0.0,cutOffPP=0.0)
             else:
-                haaLimits.addSignalModels(scale=scales,yFitFuncFP='DV',yFitFuncPP='DV')#,cutOffFP=0.0,cutOffPP=0.0)
+                haaLimits.addSignalModels(scale=scales,nCores=args.j,warmStart=args.warmStart,yFitFuncFP='DV',yFitFuncPP='DV',**signalLoad)#,cutOffFP=0.0,cutOffPP=0.0)
         else:
-            haaLimits.addSignalModels(scale=scales)
+            haaLimits.addSignalModels(scale=scales,nCores=args.j,warmStart=args.warmStart,**signalLoad)
         haaLimits.XRANGE = xRange
     if args.addControl: haaLimits.addControlData()
-    haaLimits.addData(blind=blind,asimov=args.asimov,addSignal=args.addSignal,doBinned=not doUnbinned,**signalParams) # this will generate a dataset based on the fitted model
+    haaLimits.addData(blind=blind,asimov=args.asimov,addSignal=args.addSignal,doBinned=not doUnbinned,reuseGenerated=not changed['data'],**signalParams) # this will generate a dataset based on the fitted model
     haaLimits.setupDatacard(addControl=args.addControl,doBinned=not doUnbinned)
     haaLimits.addSystematics(addControl=args.addControl,doBinned=not doUnbinned)
     name = 'mmmt_{}_parametric'.format('_'.join(var))
@@ -780,6 +807,7 @@ def create_datacard(args):
     if args.tag: name += '_{}'.format(args.tag)
     if args.addSignal: name += '_wSig'
     haaLimits.save(name=name)
+    if args.incremental: haaLimits.markStages(stageKeys)
 
 
 def parse_command_line(argv):
@@ -807,6 +835,11 @@ def parse_command_line(argv):
     parser.add_argument('--chi2Mass', type=int, default=0)
     parser.add_argument('--selection', type=str, default='')
     parser.add_argument('--channel', type=str, default='TauMuTauHad', choices=['TauMuTauE','TauETauHad','TauMuTauHad','TauHadTauHad'])
+    parser.add_argument('--columns', action='store_true', help='Load datasets from the exported numpy columns when available')
+    parser.add_argument('--incremental', action='store_true', help='Only redo the stages whose inputs changed since the last build')
+    parser.add_argument('--binnedPrefit', action='store_true', help='Prefit unbinned datasets binned at the x and y bin widths before the unbinned fit')
+    parser.add_argument('--warmStart', action='store_true', help='Seed each signal fit with the result of the neighbouring a mass')
+    parser.add_argument('-j', type=int, default=1, help='Number of cores for the signal and background fits')
 
     return parser.parse_args(argv)
 
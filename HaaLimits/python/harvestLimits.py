@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+'''
+Harvest the combine limit trees into a single index.
+
+Scans an output directory once, reads every higgsCombine*.root limit tree on a
+process pool and writes a json table keyed by mode, h, a and quantile. Files
+that did not change since the previous harvest are not opened again.
+
+The mode, h and a of each file are taken from its path relative to the
+directory, using patterns such as '{m}/{h}/{a}/higgsCombineTest.HybridNew.mH{h}.root'.
+'''
+
+import os
+import re
+import sys
+import json
+import fnmatch
+import logging
+import argparse
+from multiprocessing import Pool
+
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch()
+
+INDEXFILE = 'limits_index.json'
+QUANTILES = ['0.025','0.160','0.500','0.840','0.975','obs']
+
+# merged grid outputs, then the AsymptoticLimits layouts of plot_limit_haa_multi.py
+# the single HybridNew jobs in the grid directories are not matched, their rows would overwrite obs
+PATTERNS = [
+    '{m}/{h}/{a}/higgsCombineTest.HybridNew.mH{h}.quant*.root',
+    '{m}/{h}/{a}/higgsCombineTest.HybridNew.mH{h}.root',
+    '{m}/{h}/{a}/higgsCombineHtoAAH{h}AX_mm_h_parametric_{m}With1DFits1ExpoDVmediumDeepVSjet.AsymptoticLimits.mH{h}.root',
+    '{m}/{h}/higgsCombineHToAAH{h}A{a}_{m}.AsymptoticLimits.mH{h}.root',
+]
+
+def patternToRegex(pattern):
+    '''Convert a path pattern with {m}, {h}, {a} fields and * wildcards to a regex'''
+    regex = ''
+    fields = set()
+    for part in re.split(r'(\{[mha]\}|\*)',pattern):
+        if part=='*':
+            regex += '[^/]*'
+        elif part in ['{m}','{h}','{a}']:
+            field = part[1]
+            if field in fields:
+                regex += '(?P={})'.format(field)
+            else:
+                regex += '(?P<{}>[^/]+?)'.format(field)
+                fields.add(field)
+        else:
+            regex += re.escape(part)
+    return re.compile('^'+regex+'$')
+
+def matchPath(relpath,regexes):
+    '''Return (mode, h, a) from the first pattern matching the path'''
+    for regex in regexes:
+        match = regex.match(relpath)
+        if match: return match.group('m'), match.group('h'), match.group('a')
+    return None
+
+def quantileKey(quantile):
+    return 'obs' if quantile<0 else '{:.3f}'.format(quantile)
+
+def scanFiles(directory,match='higgsCombine*.root'):
+    '''All files below directory matching the glob, with their size and modification time'''
+    files = {}
+    for root, dirs, fnames in os.walk(directory):
+        for f in fnmatch.filter(fnames,match):
+            fname = os.path.join(root,f)
+            stat = os.stat(fname)
+            files[fname] = [stat.st_size, stat.st_mtime]
+    return files
+
+def readLimitTree(fname):
+    '''[(quantile, limit, limitErr)] from a combine output'''
+    rows = []
+    tfile = ROOT.TFile.Open(fname)
+    if not tfile or tfile.IsZombie():
+        return fname, None
+    tree = tfile.Get('limit')
+    if tree:
+        for row in tree:
+            rows += [(quantileKey(row.quantileExpected), row.limit, row.limitErr)]
+    tfile.Close()
+    return fname, rows
+
+#############
+### index ###
+#############
+def loadIndex(fname=INDEXFILE):
+    if not os.path.exists(fname): return {'files': {}, 'limits': {}}
+    with open(fname) as f:
+        return json.load(f)
+
+def dumpIndex(index,fname=INDEXFILE):
+    tmp = fname+'.tmp'
+    with open(tmp,'w') as f:
+        json.dump(index,f,indent=1,sort_keys=True)
+    os.rename(tmp,fname)
+
+def harvest(directory,**kwargs):
+    '''
+    Update the index with the limit trees below directory.
+    index['limits'][mode][h][a][quantile] = [limit, limitErr]
+    index['files'][path] = [size, mtime]
+    '''
+    indexFile = kwargs.pop('indexFile',INDEXFILE)
+    patterns = kwargs.pop('patterns',PATTERNS)
+    nCores = kwargs.pop('nCores',1)
+    force = kwargs.pop('force',False)
+
+    index = {'files': {}, 'limits': {}} if force else loadIndex(indexFile)
+    regexes = [patternToRegex(p) for p in patterns]
+
+    files = scanFiles(directory)
+    keys = {}
+    for fname in files:
+        key = matchPath(os.path.relpath(fname,directory),regexes)
+        if key: keys[fname] = key
+    todo = [f for f in keys if index['files'].get(f)!=files[f]]
+    logging.info('Reading {} of {} limit files'.format(len(todo),len(keys)))
+
+    if nCores>1 and len(todo)>1:
+        pool = Pool(nCores)
+        results = pool.map(readLimitTree,todo,chunksize=max(1,len(todo)//(4*nCores)))
+        pool.close()
+        pool.join()
+    else:
+        results = [readLimitTree(f) for f in todo]
+
+    for fname, rows in results:
+        if rows is None:
+            logging.warning('Failed to read {}'.format(fname))
+            continue
+        m, h, a = keys[fname]
+        limits = index['limits'].setdefault(m,{}).setdefault(h,{}).setdefault(a,{})
+        for q, limit, err in rows:
+            limits[q] = [limit, err]
+        index['files'][fname] = files[fname]
+
+    dumpIndex(index,indexFile)
+    return index
+
+def getLimits(index,m,h,a):
+    '''Limits in QUANTILES order for a point, None for the quantiles that were not harvested'''
+    limits = index['limits'].get(m,{}).get(str(h),{}).get('{}'.format(a),{})
+    return [limits[q][0] if q in limits else None for q in QUANTILES]
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Harvest combine limit trees into an index')
+
+    parser.add_argument('directory', type=str, help='Directory with the combine outputs')
+    parser.add_argument('--indexFile', type=str, default=INDEXFILE, help='Output index')
+    parser.add_argument('--patterns', type=str, nargs='+', default=PATTERNS, help='Relative path patterns with {m}, {h} and {a}')
+    parser.add_argument('--force', action='store_true', help='Read all files again')
+    parser.add_argument('-j', type=int, default=1, help='Number of cores')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    harvest(args.directory,indexFile=args.indexFile,patterns=args.patterns,nCores=args.j,force=args.force)
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''
+Incremental index of the HybridNew toy grids.
+
+Scans the grid directories ({m}/{h}/{a}/*.root by default) and records, per
+file, the r values in the toys directory with their number of results and
+toys and the number of jobs in the limit tree. Only new or changed files are
+opened, so the index can be refreshed cheaply while a campaign runs and
+queried for the points with an insufficient grid.
+
+Within a point, merged.root is used together with the job outputs that are
+newer than it (not merged yet).
+'''
+
+import os
+import sys
+import json
+import logging
+import argparse
+from multiprocessing import Pool
+
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch()
+
+from harvestLimits import patternToRegex, matchPath, scanFiles
+
+GRIDINDEXFILE = 'grid_index.json'
+MERGED = 'merged.root'
+PATTERNS = ['{m}/{h}/{a}/*.root']
+
+# same thresholds as readQs in plot_limit_haa_multi.py
+MINJOBS = 10
+MINPOINTS = 5
+
+def readToys(args):
+    '''r coverage of a HybridNew output: {r: [results, toys]} and the number of jobs'''
+    fname, countToys = args
+    tfile = ROOT.TFile.Open(fname)
+    if not tfile or tfile.IsZombie():
+        return fname, None
+    info = {'rs': {}, 'njobs': 0}
+    toys = tfile.Get('toys')
+    if toys:
+        for key in toys.GetListOfKeys():
+            rs = [r for r in key.GetName().split('_') if r.startswith('r')]
+            if not rs: continue
+            r = rs[0][1:]
+            entry = info['rs'].setdefault(r,[0,0])
+            entry[0] += 1
+            if countToys:
+                hr = key.ReadObj()
+                if hr.InheritsFrom('RooStats::HypoTestResult') and hr.GetAltDistribution():
+                    entry[1] += hr.GetAltDistribution().GetSize()
+        tree = tfile.Get('limit')
+        if tree: info['njobs'] = tree.GetEntries()
+    tfile.Close()
+    return fname, info
+
+#############
+### index ###
+#############
+def loadGridIndex(fname=GRIDINDEXFILE):
+    if not os.path.exists(fname): return {'files': {}}
+    with open(fname) as f:
+        return json.load(f)
+
+def dumpGridIndex(index,fname=GRIDINDEXFILE):
+    tmp = fname+'.tmp'
+    with open(tmp,'w') as f:
+        json.dump(index,f,indent=1,sort_keys=True)
+    os.rename(tmp,fname)
+
+def updateGridIndex(directory,**kwargs):
+    '''
+    Update the index with the toy files below directory.
+    index['files'][path] = {'key': [m,h,a], 'stat': [size,mtime], 'rs': {r: [results,toys]}, 'njobs': n}
+    '''
+    indexFile = kwargs.pop('indexFile',GRIDINDEXFILE)
+    patterns = kwargs.pop('patterns',PATTERNS)
+    nCores = kwargs.pop('nCores',1)
+    countToys = kwargs.pop('countToys',False)
+    force = kwargs.pop('force',False)
+
+    index = {'files': {}} if force else loadGridIndex(indexFile)
+    regexes = [patternToRegex(p) for p in patterns]
+
+    files = scanFiles(directory,'*.root')
+    keys = {}
+    for fname in files:
+        key = matchPath(os.path.relpath(fname,directory),regexes)
+        if key: keys[fname] = key
+
+    # forget removed files
+    for fname in index['files'].keys():
+        if fname.startswith(directory) and fname not in files:
+            index['files'].pop(fname)
+
+    todo = [f for f in keys if index['files'].get(f,{}).get('stat')!=files[f]]
+    logging.info('Reading {} of {} grid files'.format(len(todo),len(keys)))
+
+    if nCores>1 and len(todo)>1:
+        pool = Pool(nCores)
+        results = pool.map(readToys,[(f,countToys) for f in todo],chunksize=max(1,len(todo)//(4*nCores)))
+        pool.close()
+        pool.join()
+    else:
+        results = [readToys((f,countToys)) for f in todo]
+
+    for fname, info in results:
+        if info is None:
+            logging.warning('Failed to read {}'.format(fname))
+            continue
+        info['key'] = list(keys[fname])
+        info['stat'] = files[fname]
+        index['files'][fname] = info
+
+    dumpGridIndex(index,indexFile)
+    return index
+
+def getGridPoints(index):
+    '''
+    Combine the files of each point.
+    Returns {(m,h,a): {'rs': {r: [results,toys]}, 'njobs': n}}
+    '''
+    byPoint = {}
+    for fname, info in index['files'].iteritems():
+        if not info.get('rs'): continue
+        byPoint.setdefault(tuple(info['key']),[]).append((fname,info))
+
+    points = {}
+    for key, finfos in byPoint.iteritems():
+        merged = [(f,i) for f,i in finfos if os.path.basename(f)==MERGED]
+        if merged:
+            mtime = merged[0][1]['stat'][1]
+            finfos = merged + [(f,i) for f,i in finfos if os.path.basename(f)!=MERGED and i['stat'][1]>mtime]
+        point = {'rs': {}, 'njobs': 0}
+        for fname, info in finfos:
+            point['njobs'] += info['njobs']
+            for r, (nres, ntoys) in info['rs'].iteritems():
+                entry = point['rs'].setdefault(r,[0,0])
+                entry[0] += nres
+                entry[1] += ntoys
+        points[key] = point
+    return points
+
+def isSufficient(point,minJobs=MINJOBS,minPoints=MINPOINTS):
+    return point['njobs']>=minJobs and len(point['rs'])>=minPoints
+
+def getInsufficient(index,minJobs=MINJOBS,minPoints=MINPOINTS):
+    '''Sorted (m,h,a) of the points with too few jobs or r values'''
+    points = getGridPoints(index)
+    return sorted([key for key, point in points.iteritems() if not isSufficient(point,minJobs,minPoints)])
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Incrementally index HybridNew toy grids')
+
+    parser.add_argument('directory', type=str, help='Directory with the grid outputs')
+    parser.add_argument('--indexFile', type=str, default=GRIDINDEXFILE, help='Output index')
+    parser.add_argument('--patterns', type=str, nargs='+', default=PATTERNS, help='Relative path patterns with {m}, {h} and {a}')
+    parser.add_argument('--countToys', action='store_true', help='Also count the toys of each result (reads the objects)')
+    parser.add_argument('--insufficient', action='store_true', help='Print the points with an insufficient grid')
+    parser.add_argument('--summary', action='store_true', help='Print the r coverage of every point')
+    parser.add_argument('--minJobs', type=int, default=MINJOBS, help='Minimum number of jobs per point')
+    parser.add_argument('--minPoints', type=int, default=MINPOINTS, help='Minimum number of r values per point')
+    parser.add_argument('--noUpdate', action='store_true', help='Only query the existing index')
+    parser.add_argument('--force', action='store_true', help='Read all files again')
+    parser.add_argument('-j', type=int, default=1, help='Number of cores')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    if args.noUpdate:
+        index = loadGridIndex(args.indexFile)
+    else:
+        index = updateGridIndex(args.directory,indexFile=args.indexFile,patterns=args.patterns,nCores=args.j,countToys=args.countToys,force=args.force)
+
+    if args.summary:
+        points = getGridPoints(index)
+        for key in sorted(points):
+            point = points[key]
+            rs = sorted(point['rs'],key=float)
+            print '{} {} {}: {} jobs, {} r values [{}, {}]'.format(key[0],key[1],key[2],point['njobs'],len(rs),rs[0] if rs else '',rs[-1] if rs else '')
+
+    if args.insufficient:
+        for m, h, a in getInsufficient(index,args.minJobs,args.minPoints):
+            print m, h, a
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
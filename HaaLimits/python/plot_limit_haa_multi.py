@@ -3,6 +3,9 @@ from array import array
 import ROOT
 
 from CombineLimitsRunII.Plotter.LimitPlotter import LimitPlotter
+from harvestLimits import loadIndex, getLimits
+from indexGrids import loadGridIndex, getGridPoints, isSufficient
+from brTable import getBRFileName, readBRFile, loadBRTable, evalBR, getHistArrays, getHistBinContents
 
 ROOT.gROOT.SetBatch()
 
@@ -18,6 +21,9 @@ doDM0and1 = False
 autoSkip = False
 strictChecking = False
 isprelim = False
+limitIndex = '' # index written by harvestLimits.py, used instead of opening the combine outputs if set
+gridIndex = '' # index written by indexGrids.py, used instead of opening merged.root to check the grid if set
+brTableFile = '' # table written by brTable.py, used instead of parsing the BR text files if set
 amasses = [5,7,9,11,13,15,17,19,21]
 hmasses = [125] #[125,300,750]
 
@@ -238,33 +244,17 @@ def getModelsAlt(scale=1):
     for m in modeltypes:
         models[m] = {}
         hist = models2D[m]
+        arrays = getHistArrays(hist)
         for t in alltanbs:
             xs = allmasses
-            ys = []
-            for ma in xs:
-                ys += [hist.GetBinContent(hist.FindBin(ma,t))*scale]
+            ys = getHistBinContents(hist,xs,[t]*len(xs),arrays)*scale
             graph = ROOT.TGraph(len(xs),array('d',xs),array('d',ys))
             models[m][t] = graph
     return models
 
 # Load the "BR" one with the fixed quarkonia content
-mtmap = {1:'I',2:'II',3:'III',4:'IV'}
 def load_br_graph(m,tb):
-    if m==1:
-        fname = 'haa_br_data/BR/BR_I.dat'
-    else:
-        fname = 'haa_br_data/BR/BR_{}_{:.1f}.dat'.format(mtmap[m],tb)
-    xs = []
-    ys = []
-    with open(fname) as f:
-        for line in f.readlines():
-            vals = line.split()
-            ma = float(vals[1])
-            amm = float(vals[6])
-            att = float(vals[5])
-            aammtt = 2*amm*att
-            xs += [ma]
-            ys += [aammtt]
+    xs, ys = readBRFile(getBRFileName(m,tb))
     return ROOT.TGraph(len(xs),array('d',xs),array('d',ys))
 
 tanbsq = [0.5,0.6,0.7,0.8,0.9,1.0,1.5,2.0,2.5,3.0,3.5,4.0,4.5,5.0,5.5,6.0,6.5,7.0,7.5,8.0,8.5,9.0,9.5,10.0]
@@ -290,7 +280,11 @@ labelbr = '#frac{#sigma_{H}}{#sigma_{SM}}B(H #rightarrow aa #rightarrow #mu#mu#t
 labelbrbsm = '#frac{#sigma_{H}}{#sigma_{SM}}B(H #rightarrow aa #rightarrow #mu#mu#tau#tau)'
 
 
+brTable = loadBRTable(brTableFile) if brTableFile else None
+
 def get_model_br(a,model,tanb):
+    if brTable is not None:
+        return float(evalBR(brTable,model,tanb,a))
     #graph = models[model][tanb]
     #graph = modelsAlt[model][tanb]
     graph = modelsQ[model][tanb]
@@ -301,6 +295,10 @@ def get_model_scale(a,model,tanb):
     return br/y if y else 0
 
 def get_tanb_graph(a,model):
+    if brTable is not None:
+        ys = evalBR(brTable,model,tanbsq,a)
+        scales = [br/y if y else 0 for y in ys]
+        return ROOT.TGraph(len(scales),array('d',tanbsq),array('d',scales))
     scales = []
     #for t in tanbs:
     #for t in alltanbs:
@@ -317,6 +315,24 @@ hs_amasses = [3.6,3.8,4.0,4.5,5.0,5.5,6.0,6.5,7.0,7.5,8.0,8.5,
               8.0,8.2,8.4,8.6,8.8,9.0,9.2,9.4,9.6,9.8,10.0,10.2,10.4,10.6,10.8,11.0,11.2,11.4,
               11.0,11.5,12.0,13.0,14.0,15.0,16.0,17.0,18.0,19.0,20.0,21.0]
 
+limitsIndex = loadIndex(limitIndex) if limitIndex else None
+gridPoints = getGridPoints(loadGridIndex(gridIndex)) if gridIndex else None
+
+def getGridGood(qs):
+    good = []
+    for i,q in enumerate(qs):
+        if i in [2,5]: # say expected and observed always good for now
+            good += [True]
+        #elif i in [0,1,3,4] and h==750: # always use high stat sigma bands
+        #    good += [a in hs_amasses]
+        elif i<2:
+            good += [q<qs[i+1]]
+        elif i>2:
+            good += [q>qs[i-1]]
+        else:
+            good += [False]
+    return good
+
 def readQs(mode,h,a):
     if a % 1 < 1e-10: astr = '{0:.0f}'.format(a)
     elif (10*a) % 1 < 1e-10: astr = '{0:.1f}'.format(a)
@@ -332,21 +348,34 @@ def readQs(mode,h,a):
         this_grid_dir = grid_dir
 
         # check if grid is populated
-        tfile = ROOT.TFile.Open('{working}/{m}/{h}/{a}/merged.root'.format(working=this_grid_dir,h=h,a=a,m=mode))
-        try:
-            keys = tfile.Get('toys').GetListOfKeys()
-            rs = [[r for r  in key.GetName().split('_') if r.startswith('r')] for key  in keys]
-            rs = [r[0] for r in rs if r]
-            rs = set(rs)
-            njobs = tfile.Get('limit').GetEntries()
-            if njobs<10 or len(rs)<5:
+        if gridPoints is not None:
+            point = gridPoints.get((mode,str(h),'{}'.format(a)))
+            if not point or not isSufficient(point):
                 logging.warning('Insufficient grid {} {} {}'.format(mode,h,a))
                 return [], []
-        except:
-            logging.warning('Failed to get grid {} {} {}'.format(mode,h,a))
+        else:
+            tfile = ROOT.TFile.Open('{working}/{m}/{h}/{a}/merged.root'.format(working=this_grid_dir,h=h,a=a,m=mode))
+            try:
+                keys = tfile.Get('toys').GetListOfKeys()
+                rs = [[r for r  in key.GetName().split('_') if r.startswith('r')] for key  in keys]
+                rs = [r[0] for r in rs if r]
+                rs = set(rs)
+                njobs = tfile.Get('limit').GetEntries()
+                if njobs<10 or len(rs)<5:
+                    logging.warning('Insufficient grid {} {} {}'.format(mode,h,a))
+                    return [], []
+            except:
+                logging.warning('Failed to get grid {} {} {}'.format(mode,h,a))
 
 
 
+        if limitsIndex:
+            qs = getLimits(limitsIndex,mode,h,a)
+            if None in qs:
+                logging.error('Missing limits in index {} {} {}'.format(mode,h,a))
+                return [], []
+            return qs, getGridGood(qs)
+
         qs = []
         for q in ['0.025','0.160','0.500','0.840','0.975','']:
             if q:
@@ -368,20 +397,20 @@ def readQs(mode,h,a):
                 qs += [row.limit]
 
 
-        for i,q in enumerate(qs):
-            if i in [2,5]: # say expected and observed always good for now
-                good += [True]
-            #elif i in [0,1,3,4] and h==750: # always use high stat sigma bands
-            #    good += [a in hs_amasses]
-            elif i<2:
-                good += [q<qs[i+1]]
-            elif i>2:
-                good += [q>qs[i-1]]
-            else:
-                good += [False]
+        good = getGridGood(qs)
 
     else:
 
+        if limitsIndex:
+            m = mode.split('_')[-1].split('W')[0] if 'parametric' in mode else mode
+            qs = getLimits(limitsIndex,m,h,a)
+            if None in qs[:5]:
+                logging.error('Missing limits in index {} {} {}'.format(mode,h,a))
+                return [], []
+            # blinded outputs have no observed limit
+            if qs[5] is None: qs = qs[:5]
+            return qs, [True]*len(qs)
+
         if 'parametric' in mode:
             #tfile = ROOT.TFile.Open('{hdfs}/{m}/{h}/higgsCombineHToAAH{h}A{a:.1f}_{m}.AsymptoticLimits.mH{h}.root'.format(hdfs=hdfs_dir,h=h,a=a,m=mode,astr=astr))
             #/eos/uscms/store/user/rhabibul/HtoAA/HtoAA2017/Limits/TauMuTauHad/highmass/125/
@@ -23,6 +23,55 @@ def python_mkdir(dir):
 def runCommand(command):
     return subprocess.Popen(command,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT).communicate()[0]
 
+def readAsymptoticLimits(fname):
+    '''Read the AsymptoticLimits limit tree: [-2s, -1s, exp, +1s, +2s, obs]'''
+    tfile = ROOT.TFile.Open(fname)
+    if not tfile or tfile.IsZombie(): return []
+    tree = tfile.Get('limit')
+    if not tree:
+        tfile.Close()
+        return []
+    qs = [row.limit for row in tree]
+    tfile.Close()
+    return qs
+
+def planRValues(quartiles,rmin=None,rmax=None,**kwargs):
+    '''
+    Adaptive r grid for HybridNew from the asymptotic limits.
+    Points of a geometric grid with relative step denseStep are kept within denseWidth
+    of each expected/observed crossing, overlapping windows share the same points.
+    sparsePoints evenly spaced points over [rmin,rmax] anchor the CLs curve elsewhere.
+    Only positive limits are used, a non-positive rmin is replaced by half the smallest of them
+    and no points are returned without any.
+    '''
+    denseWidth = kwargs.pop('denseWidth',0.3)
+    denseStep = kwargs.pop('denseStep',0.05)
+    sparsePoints = kwargs.pop('sparsePoints',5)
+    digits = kwargs.pop('digits',3)
+
+    crossings = [q for q in quartiles if q>0]
+    if not crossings: return []
+    if rmin is None or rmin<=0: rmin = 0.5*min(crossings)
+    if rmax is None: rmax = 1.2*max(crossings)
+
+    rvalues = []
+    r = rmin
+    while r<=rmax:
+        if any([abs(r-q)<=denseWidth*q for q in crossings]): rvalues += [r]
+        r *= 1+denseStep
+    if sparsePoints>1:
+        sparse = [rmin + i*(rmax-rmin)/(sparsePoints-1) for i in range(sparsePoints)]
+        # skip sparse points that fall inside a dense window
+        rvalues += [r for r in sparse if not any([abs(r-q)<=denseWidth*q for q in crossings])]
+    return sorted(set([float('{:.{}g}'.format(r,digits)) for r in rvalues]))
+
+def writeRValues(fname,rvalues,jobs_per_point):
+    '''Per point job list, one line {r}_{job} per job'''
+    with open(fname,'w') as file:
+        for r in rvalues:
+            for i in range(jobs_per_point):
+                file.write('{}_{}\n'.format(r,i))
+
 
 logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -35,10 +84,16 @@ parser.add_argument('--hmasses',type=int,default=[125,300,750],nargs='+',help='H
 parser.add_argument('--moderanges',type=str,default=['lowmass','upsilon','highmass'],choices=['lowmass','upsilon','highmass'],nargs='+',help='A mass ranges to run')
 parser.add_argument('--toys',type=int,default=2000,help='Number of toys')
 parser.add_argument('--toysPerJob',type=int,default=100,help='Number of toys per job')
+parser.add_argument('--tasksPerJob',type=int,default=1,help='Pack this many (r, toy chunk) tasks into one job, toy chunks at the same r run as iterations of one combine call')
 parser.add_argument('--testing',action='store_true',help='Test does one point per mode')
 parser.add_argument('--verbose',action='store_true',help='Run combine with verbose')
 parser.add_argument('--convert',action='store_true',help='Only convert')
 parser.add_argument('--reduced',action='store_true',help='Reduced h/a grid for large statistics')
+parser.add_argument('--adaptive',action='store_true',help='Plan the r grid from the AsymptoticLimits results')
+parser.add_argument('--asymptotic',type=str,default='{hdfs}/{m}/{h}/higgsCombineHToAAH{h}A{a:.1f}_{m}.AsymptoticLimits.mH{h}.root',help='AsymptoticLimits output for the adaptive grid')
+parser.add_argument('--denseWidth',type=float,default=0.3,help='Relative half width of the dense region around each crossing')
+parser.add_argument('--denseStep',type=float,default=0.05,help='Relative r step in the dense region')
+parser.add_argument('--sparsePoints',type=int,default=5,help='Number of evenly spaced points over the full r range')
 
 args = parser.parse_args()
 
@@ -51,6 +106,7 @@ testing = args.testing
 convertOnly = args.convert
 reduced = args.reduced
 verbose = args.verbose
+adaptive = args.adaptive
 
 jobname = args.jobname
 if doCrab:
@@ -143,6 +199,13 @@ def submit_condor(ws,quartiles,mode,h,a):
     dr = drMap[h] if a<8 else altDRMap[h]
     num_points = int((rmax-rmin)/dr)
     points_per_job = 1
+    tasks_per_job = args.tasksPerJob
+    rlist = []
+    if quartiles and adaptive:
+        rlist = planRValues(quartiles,rmin,rmax,denseWidth=args.denseWidth,denseStep=args.denseStep,sparsePoints=args.sparsePoints)
+        if not rlist: logging.warning('No positive limit for {} {} {}, using the regular r grid'.format(mode,h,a))
+    if not rlist:
+        rlist = [r*(rmax-rmin)/num_points + rmin for r in range(int(num_points/points_per_job))]
     toys_per_job = args.toysPerJob
     jobs_per_point = int(toys/toys_per_job)
     if jobs_per_point<1: jobs_per_point = 1
@@ -156,22 +219,24 @@ def submit_condor(ws,quartiles,mode,h,a):
     output_dir = '/store/user/{}/{}/{}/{}/{}'.format(user, jobname, mode, h, a)
 
     # create file list
-    rlist = [r*(rmax-rmin)/num_points + rmin for r in range(int(num_points/points_per_job))]
     input_name = '{}/rvalues.txt'.format(dag_dir+'inputs')
-    with open(input_name,'w') as file:
-        for r in rlist:
-            for i in range(jobs_per_point):
-                file.write('{}_{}\n'.format(r,i))
+    writeRValues(input_name,rlist,jobs_per_point)
 
     # create bash script
     bash_name = '{}/{}.sh'.format(dag_dir+'inputs', jobname)
     bashScript = '#!/bin/bash\n'
     #bashScript += 'printenv\n'
-    bashScript += 'read -d "_" -r RVAL < $INPUT\n'
-    for i in range(points_per_job):
-        dr = i*(rmax-rmin)/points_per_job
-        bashScript += 'combine -M HybridNew -v {verbosity} -d $CMSSW_BASE/{ws} -m {h} --setParameters MA={a} --freezeParameters=MA --LHCmode LHC-limits --singlePoint $(bc -l <<< "$RVAL+{points}") --rMax 30 --saveToys --saveHybridResult -T {toys} -s -1 --clsAcc 0\n'.format(ws=drel,h=h,a=a,points=dr,toys=toys_per_job,jobname=jobname,verbosity=2 if verbose else -1)
-    if points_per_job>1:
+    if tasks_per_job>1:
+        # one combine call per distinct r in this job, the toy chunks become iterations so the workspace is loaded once per r
+        bashScript += 'cut -d "_" -f 1 $INPUT | sort | uniq -c | while read NITER RVAL; do\n'
+        bashScript += '  combine -M HybridNew -v {verbosity} -d $CMSSW_BASE/{ws} -m {h} --setParameters MA={a} --freezeParameters=MA --LHCmode LHC-limits --singlePoint $RVAL --rMax 30 --saveToys --saveHybridResult -T {toys} -i $NITER -s -1 --clsAcc 0\n'.format(ws=drel,h=h,a=a,toys=toys_per_job,verbosity=2 if verbose else -1)
+        bashScript += 'done\n'
+    else:
+        bashScript += 'read -d "_" -r RVAL < $INPUT\n'
+        for i in range(points_per_job):
+            dr = i*(rmax-rmin)/points_per_job
+            bashScript += 'combine -M HybridNew -v {verbosity} -d $CMSSW_BASE/{ws} -m {h} --setParameters MA={a} --freezeParameters=MA --LHCmode LHC-limits --singlePoint $(bc -l <<< "$RVAL+{points}") --rMax 30 --saveToys --saveHybridResult -T {toys} -s -1 --clsAcc 0\n'.format(ws=drel,h=h,a=a,points=dr,toys=toys_per_job,jobname=jobname,verbosity=2 if verbose else -1)
+    if points_per_job>1 or tasks_per_job>1:
         bashScript += 'hadd $OUTPUT higgsCombine*HybridNew.mH{}*.root\n'.format(h)
         bashScript += 'rm higgsCombine*.root\n'.format(h)
     else:
@@ -182,6 +247,8 @@ def submit_condor(ws,quartiles,mode,h,a):
 
     # create farmout command
     farmoutString = 'farmoutAnalysisJobs --infer-cmssw-path --fwklite --input-file-list={} --assume-input-files-exist'.format(input_name)
+    if tasks_per_job>1:
+        farmoutString += ' --input-files-per-job={}'.format(tasks_per_job)
     farmoutString += ' --submit-dir={} --output-dag-file={} --output-dir={}'.format(submit_dir, dag_dir, output_dir)
     farmoutString += ' --extra-usercode-files="{}" {} {}'.format(dreldir, jobname, bash_name)
 
@@ -201,8 +268,15 @@ def submit_crab(ws,quartiles,mode,h,a):
     jobs_per_point = int(toys/toys_per_job)
     if jobs_per_point<1: jobs_per_point = 1
 
-    # this will do multiple r values in a regular grid
+    # this will do multiple r values in a regular grid, or the planned points
     pointsString = '{:.3}:{:.3}:{:.3}'.format(rmin,rmax,dr)
+    if quartiles and adaptive:
+        rlist = planRValues(quartiles[:6],rmin,rmax,denseWidth=args.denseWidth,denseStep=args.denseStep,sparsePoints=args.sparsePoints)
+        if rlist:
+            pointsString = ','.join(['{:g}'.format(r) for r in rlist])
+            writeRValues('temp_HybridNew_{h}/rvalues_{mode}_{h}_{a}.txt'.format(mode=mode,h=h,a=a),rlist,jobs_per_point)
+        else:
+            logging.warning('No positive limit for {} {} {}, using the regular r grid'.format(mode,h,a))
 
     crab = 'custom_crab_{mode}_{h}_{a}.py'.format(mode=mode,h=h,a=a)
 
@@ -225,6 +299,8 @@ def custom_crab(config):
         f.write(crabString)
 
     command = 'combineTool.py -M HybridNew -v {verbosity} -d {ws} -m {h} --setParameters MA={a} --freezeParameters=MA --LHCmode LHC-limits --singlePoint {points} --rMax 30 --saveToys --saveHybridResult -T {toys} -s {seeds} --clsAcc 0 --job-mode crab3 --task-name {jobname} --custom-crab {crab}'.format(ws=ws,h=h,a=a,points=pointsString,toys=toys_per_job,jobname=jobname,seeds=seeds,crab=crab,verbosity=2 if verbose else -1)
+    # run several combine calls in each crab job
+    if args.tasksPerJob>1: command += ' --merge {}'.format(args.tasksPerJob)
     #command += ' --fullBToys'
     #command += ' --dry-run'
     print command
@@ -239,7 +315,7 @@ for moderange in moderanges:
         ws = '{mode}_{h}.root'.format(mode=thismode,h=h)
         temp = 'temp_HybridNew_{h}'.format(h=h)
         python_mkdir(temp)
-        print 'text2workspace.py {datacard} -m {h} -o {temp}/{ws}'.format(datacard=datacard,h=h,temp=temp,ws=ws)
+        print 'python cachedText2Workspace.py {datacard} -m {h} -o {temp}/{ws}'.format(datacard=datacard,h=h,temp=temp,ws=ws)
         if doCrab: print 'pushd {temp}'.format(temp=temp)
         prev_qs = []
         thisamasses = amasses
@@ -259,29 +335,26 @@ for moderange in moderanges:
             else: astr = 'HELP'
 
             qs = []
-            # turn off for now
-            #tfile = ROOT.TFile.Open('{hdfs}/{m}/{h}/higgsCombineHToAAH{h}A{a:.1f}_{m}.AsymptoticLimits.mH{h}.root'.format(hdfs=hdfs,h=h,a=a,m=thismode,astr=astr))
-            #try:
-            #    tree = tfile.Get("limit")
-            #except:
-            #    logging.error('Failed to open {} {} {}'.format(thismode,h,a))
-            #    continue
-            #for i, row in enumerate(tree):
-            #    qs += [row.limit]
-            #outline = ' '.join([str(x) for x in qs])
-            #logging.info('{0}:{1}: Limits: {2}'.format(h,a,outline))
-
-            #if not prev_qs: prev_qs = qs
-
-            #if abs(qs[2]-prev_qs[2])/qs[2]>0.3:
-            #    logging.info('{}:{}: Large jump in AsymptoticLimit, will use previous a mass limits for bounds'.format(h,a))
-            #    qs = prev_qs
-
-            #prev_qs = qs
-
-            #if len(qs)<6:
-            #    logging.info('{}:{}: Too few limits, will not sumbit'.format(h,a))
-            #    continue
+            if adaptive:
+                qs = readAsymptoticLimits(args.asymptotic.format(hdfs=hdfs,h=h,a=a,m=thismode,astr=astr))
+                if not qs:
+                    logging.error('Failed to open {} {} {}'.format(thismode,h,a))
+                    continue
+                outline = ' '.join([str(x) for x in qs])
+                logging.info('{0}:{1}: Limits: {2}'.format(h,a,outline))
+
+                if len(qs)<6:
+                    logging.info('{}:{}: Too few limits, will not sumbit'.format(h,a))
+                    continue
+
+                if not prev_qs: prev_qs = qs
+
+                # a non-positive median is a failed fit, treat it as a jump
+                if qs[2]<=0 or abs(qs[2]-prev_qs[2])/qs[2]>0.3:
+                    logging.info('{}:{}: Large jump in AsymptoticLimit, will use previous a mass limits for bounds'.format(h,a))
+                    qs = prev_qs
+
+                prev_qs = qs
 
             if doCrab:
                 submit_crab(ws,qs,thismode,h,a)
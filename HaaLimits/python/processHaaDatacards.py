@@ -16,10 +16,13 @@ import signal
 import logging
 import math
 import ROOT
+import random
 import subprocess
 from multiprocessing import Pool
 from socket import gethostname
 
+from cachedText2Workspace import getCachedWorkspace
+
 #scratchDir = 'data' if 'uwlogin' in gethostname() else 'nfs_scratch'
 scratchDir='/uscms_data/d3/rhabibul/CombineRun2_v2/CMSSW_8_1_0/src/CombineLimits/HaaLimits/python'
 UNAME = os.environ['USER']
@@ -77,6 +80,11 @@ def submitLimit(tag,h,amasses,**kwargs):
     a = '${A}'
 
     datacard = 'datacards_shape/MuMuTauTau/mmmt_{}_HToAAH{}A{}.txt'.format(tag,h,'X' if parametric else '${A}')
+    if parametric:
+        # the parametric card is the same for every a mass, compile it once and ship the workspace
+        workspace = datacard.replace('.txt','_workspace.root')
+        getCachedWorkspace(datacard,workspace,mass=h,dryrun=dryrun)
+        datacard = workspace
 
     combineCommands = getCommands(**kwargs)
 
@@ -138,6 +146,11 @@ def submitLimitCrab(tag,h,amasses,**kwargs):
     a = '${A}'
 
     datacard = 'datacards_shape/MuMuTauTau/mmmt_{}_HToAAH{}A{}.txt'.format(tag,h,'X' if parametric else '${A}')
+    if parametric:
+        # the parametric card is the same for every a mass, compile it once and ship the workspace
+        workspace = datacard.replace('.txt','_workspace.root')
+        getCachedWorkspace(datacard,workspace,mass=h,dryrun=dryrun)
+        datacard = workspace
 
     combineCommands = getCommands(**kwargs)
 
@@ -259,8 +272,8 @@ def submitGridCrab(tag,h,amasses,**kwargs):
         workspace = '{}/workspace.root'.format(sample_dir)
 
         # create workspace
-        command = 'text2workspace.py {datacard} -m {a} -o {workspace}'.format(datacard=datacard,a=a,workspace=workspace)
-        os.system(command)
+        # the parametric card only differs in MA, which combine sets with -m, so one build serves all a masses
+        getCachedWorkspace(datacard,workspace,mass=h if parametric else a,dryrun=dryrun)
 
         # setup crab customization
         custom = '{}/custom_crab.py'.format(sample_dir)
@@ -285,6 +298,174 @@ def submitGridCrab(tag,h,amasses,**kwargs):
 
 
 
+####################
+### CLs refining ###
+####################
+QUANTILES = [0.025,0.160,0.500,0.840,0.975]
+
+def harvestGrid(gridDir,merged):
+    '''hadd the HybridNew outputs below gridDir into merged if any of them is newer'''
+    files = []
+    for root, dirs, fnames in os.walk(gridDir):
+        files += [os.path.join(root,f) for f in fnames if f.startswith('higgsCombine') and f.endswith('.root')]
+    if not files: return False
+    if os.path.exists(merged) and os.path.getmtime(merged)>max([os.path.getmtime(f) for f in files]):
+        return True
+    tmp = merged+'.tmp.root'
+    out = runCommand('hadd -f {} {}'.format(tmp,' '.join(files)))
+    if not os.path.exists(tmp):
+        logging.error('Failed to merge {}: {}'.format(gridDir,out))
+        return False
+    os.rename(tmp,merged)
+    return True
+
+def readGrid(merged):
+    '''Merge the HypoTestResults in the toys directory per r value'''
+    results = {}
+    tfile = ROOT.TFile.Open(merged)
+    if not tfile or tfile.IsZombie(): return results
+    toys = tfile.Get('toys')
+    if not toys: return results
+    for key in toys.GetListOfKeys():
+        rs = [r for r in key.GetName().split('_') if r.startswith('r')]
+        if not rs: continue
+        try:
+            r = float(rs[0][1:])
+        except ValueError:
+            continue
+        hr = key.ReadObj()
+        if not hr.InheritsFrom('RooStats::HypoTestResult'): continue
+        if r in results:
+            results[r].Append(hr)
+        else:
+            results[r] = hr.Clone()
+    tfile.Close()
+    return results
+
+def getCLs(hr,quantile=None):
+    '''CLs and its error, for an expected quantile the test statistic is taken from the b-only toys as in combine'''
+    if quantile is not None:
+        btoys = sorted(hr.GetAltDistribution().GetSamplingDistribution())
+        if not btoys: return 0., 0.
+        i = min(int(math.floor((1.-quantile)*len(btoys)+0.5)),len(btoys)-1)
+        hr = hr.Clone()
+        hr.SetTestStatisticData(btoys[i])
+    return hr.CLs(), hr.CLsError()
+
+def findCrossing(points,cl=0.05):
+    '''
+    Interpolate log(CLs) between the first pair of (r, CLs, error) points bracketing cl.
+    Returns (r, error on r, r below, r above) or None if not bracketed.
+    '''
+    for (r1,c1,e1), (r2,c2,e2) in zip(points[:-1],points[1:]):
+        if not (c1>=cl and c2<cl): continue
+        if c1>0 and c2>0:
+            t = (math.log(c1)-math.log(cl))/(math.log(c1)-math.log(c2))
+        else:
+            t = (c1-cl)/(c1-c2)
+        rx = r1+t*(r2-r1)
+        slope = (c2-c1)/(r2-r1)
+        err = (1-t)*e1+t*e2
+        return rx, abs(err/slope) if slope else float('inf'), r1, r2
+    return None
+
+def refineGridCrab(tag,h,amasses,**kwargs):
+    '''
+    One round of the iterative HybridNew refinement.
+    Harvest the toys, estimate the crossing of each quantile and submit
+    more toys only at the r values bracketing crossings that are not yet precise enough.
+    '''
+    dryrun = kwargs.get('dryrun',False)
+    jobName = kwargs.get('jobName',None)
+    gridDir = kwargs.get('gridDir','/hdfs/store/user/{user}/{jobName}/{tag}/{h}/{a}')
+    precision = kwargs.get('precision',0.02)
+    toysPerJob = kwargs.get('toysPerJob',500)
+    maxToys = kwargs.get('maxToys',5000)
+    observed = kwargs.get('observed',False)
+    user = pwd.getpwuid(os.getuid())[0]
+
+    quantiles = QUANTILES + ([None] if observed else [])
+
+    for a in amasses:
+        sample_dir = '/{}/{}/crab_projects/{}/{}/{}/{}'.format(scratchDir,user, jobName, tag, h, a)
+        workspace = '{}/workspace.root'.format(sample_dir)
+        if not os.path.exists(workspace):
+            logging.warning('No grid submitted for {} {} {} {}'.format(jobName,tag,h,a))
+            continue
+
+        merged = '{}/merged.root'.format(sample_dir)
+        if not harvestGrid(gridDir.format(user=user,jobName=jobName,tag=tag,h=h,a=a),merged):
+            logging.warning('No toys yet for {} {} {} {}'.format(jobName,tag,h,a))
+            continue
+        results = readGrid(merged)
+        rs = sorted(results)
+
+        points = {}
+        for q in quantiles:
+            values = [(r,)+getCLs(results[r],q) for r in rs]
+            crossing = findCrossing(values)
+            if crossing is None:
+                # not bracketed, extend the grid on the side where CLs is still above/below
+                if values and values[-1][1]>=0.05:
+                    newr = float('{:.3g}'.format(rs[-1]*1.5))
+                else:
+                    newr = float('{:.3g}'.format(rs[0]/1.5)) if rs else 0.
+                logging.info('{}:{}: quantile {} not bracketed, adding r={}'.format(h,a,q,newr))
+                if newr>0: points[newr] = max(points.get(newr,0),toysPerJob)
+                continue
+            rx, drx, r1, r2 = crossing
+            logging.info('{}:{}: quantile {} crossing r={:.4g} +/- {:.2g}'.format(h,a,q,rx,drx))
+            if drx<=precision*rx: continue
+            # toy error scales as 1/sqrt(N)
+            for r in [r1,r2]:
+                ntoys = results[r].GetAltDistribution().GetSize()
+                extra = int(math.ceil(ntoys*((drx/(precision*rx))**2-1)))
+                extra = min(max(extra,toysPerJob),maxToys)
+                points[r] = max(points.get(r,0),extra)
+
+        if not points:
+            logging.info('{}:{}: all crossings within {:.1%}'.format(h,a,precision))
+            continue
+
+        # one crab work area per round
+        rounds = len(glob.glob('{}/crab_round*'.format(sample_dir)))
+        submit_dir = '{}/crab_round{}'.format(sample_dir,rounds+1)
+
+        custom = '{}/custom_crab_round{}.py'.format(sample_dir,rounds+1)
+        customString = ''
+        customString += "def custom_crab(config):\n"
+        customString += "    print 'Customizing crab config'\n"
+        customString += "    config.General.workArea = '{}'\n".format(submit_dir)
+        customString += "    config.Data.outLFNDirBase = '/store/user/{}/{}/{}/{}/{}'\n".format(user, jobName, tag, h, a)
+        customString += "    config.Site.storageSite = 'T2_US_Wisconsin'\n"
+        with open(custom,'w') as f:
+            f.write(customString)
+
+        # the number of jobs is shared by all points of a task, group the points needing the same number
+        groups = {}
+        for r, toys in points.iteritems():
+            njobs = int(math.ceil(float(toys)/toysPerJob))
+            groups.setdefault(njobs,[]).append(r)
+
+        for njobs in sorted(groups):
+            seed = random.randint(1,123456)
+            seeds = '{}:{}:1'.format(seed,seed+njobs-1) if njobs>1 else str(seed)
+            pointsString = ','.join(['{:g}'.format(r) for r in sorted(groups[njobs])])
+            taskName = '{}_round{}'.format(jobName,rounds+1)
+            if len(groups)>1: taskName += '_{}jobs'.format(njobs)
+            logging.info('{}:{}: round {} adding {} toys at r={}'.format(h,a,rounds+1,njobs*toysPerJob,pointsString))
+
+            command = 'combineTool.py -d {workspace} -M HybridNew'\
+                      +' --freq --LHCmode LHC-limits --clsAcc 0 -T {toys} -s {seeds}'\
+                      +' --singlePoint {points} --saveToys --fullBToys --saveHybridResult'\
+                      +' -m {a} --job-mode crab3 --task-name {taskName} --custom-crab {custom}'
+            command = command.format(workspace=workspace,toys=toysPerJob,seeds=seeds,points=pointsString,a=a,taskName=taskName,custom=custom)
+            if dryrun:
+                print command
+            else:
+                os.system(command)
+
+
 def parse_command_line(argv):
     parser = argparse.ArgumentParser(description='Process limits')
 
@@ -300,6 +481,12 @@ def parse_command_line(argv):
     parser.add_argument('--crab',action='store_true',help='Submit using crab')
     parser.add_argument('--grid',action='store_true',help='Submit using crab')
     parser.add_argument('--pointsPerJob', nargs='?',type=int,default=10,help='Number of mass points per job')
+    parser.add_argument('--refine',action='store_true',help='Run one round of CLs refinement on submitted grids')
+    parser.add_argument('--gridDir', type=str, default='/hdfs/store/user/{user}/{jobName}/{tag}/{h}/{a}',help='Location of the grid outputs for refinement')
+    parser.add_argument('--precision', type=float, default=0.02,help='Requested relative precision on each crossing')
+    parser.add_argument('--toysPerJob', type=int, default=500,help='Toys per job for refinement')
+    parser.add_argument('--maxToys', type=int, default=5000,help='Maximum toys per point and round for refinement')
+    parser.add_argument('--observed',action='store_true',help='Also refine the observed crossing')
     # logging
     parser.add_argument('-j',type=int,default=1,help='Number of cores')
     parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
@@ -323,6 +510,9 @@ def main(argv=None):
         command = submitLimitCrab if args.crab else submitLimit
         if args.grid: command = submitGridCrab
         command(args.tag,args.mh,amasses,dryrun=args.dryrun,jobName=args.jobName,parametric=args.parametric,pointsPerJob=args.pointsPerJob)
+    elif args.refine:
+        amasses = [x*0.1 for x in range(36,211,1)] if args.parametric else range(5,23,2)
+        refineGridCrab(args.tag,args.mh,amasses,dryrun=args.dryrun,jobName=args.jobName,gridDir=args.gridDir,precision=args.precision,toysPerJob=args.toysPerJob,maxToys=args.maxToys,observed=args.observed)
     else:
         runLimit(args.tag,args.mh,args.ma,dryrun=args.dryrun,parametric=args.parametric)
 
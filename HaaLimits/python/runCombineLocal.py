@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+'''
+Run the combine limit scans on a local process pool.
+
+Replaces the LSF submission scripts in HaaLimits/scripts (submitrValue*.sh with
+rValuesCalc*.sh): one combine job per (datacard, a mass[, r value]), run with a
+configurable number of concurrent processes. Every job runs in its own work
+directory and its outputs are recorded in a manifest, so an interrupted or
+partially failed scan can be resumed by running the same command again.
+'''
+
+import os
+import sys
+import glob
+import json
+import errno
+import shutil
+import logging
+import argparse
+import subprocess
+from multiprocessing import Pool
+
+MANIFEST = 'manifest.json'
+FAILUREMARKERS = ['SysError','LandS']
+
+def python_mkdir(dir):
+    '''A function to make a unix directory as well as subdirectories'''
+    try:
+        os.makedirs(dir)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(dir):
+            pass
+        else: raise
+
+def formatMass(a):
+    '''Mass as combine writes it in the output name'''
+    return '{:g}'.format(round(a,4))
+
+def getMasses(start,end,step):
+    masses = []
+    a = start
+    while a<end+step/2.:
+        masses += [round(a,4)]
+        a += step
+    return masses
+
+############
+### jobs ###
+############
+def getJobs(datacards,masses,**kwargs):
+    '''
+    Build the list of jobs.
+    Each job is a dict with a unique name, the combine command and the datacard directory tag.
+    '''
+    method = kwargs.pop('method','AsymptoticLimits')
+    h = kwargs.pop('h',125)
+    addon = kwargs.pop('addon','')
+    rValues = kwargs.pop('rValues',[])
+    toys = kwargs.pop('toys',1000)
+    seed = kwargs.pop('seed',-1)
+    options = kwargs.pop('options','')
+
+    jobs = []
+    for datacard in datacards:
+        datacard = os.path.abspath(datacard)
+        tag = os.path.basename(os.path.dirname(datacard))
+        for a in masses:
+            astr = formatMass(a)
+            name = 'HToAAH{h}A{a}_{tag}{addon}'.format(h=h,a=astr,tag=tag,addon=addon)
+            if method=='HybridNew':
+                for r in rValues:
+                    rname = '{}_r{:g}'.format(name,r)
+                    command = 'combine -M HybridNew -m {a} {datacard} -n "{name}" --LHCmode LHC-limits --singlePoint {r} --saveToys --saveHybridResult -T {toys} -s {seed} --clsAcc 0 {options}'
+                    command = command.format(a=astr,datacard=datacard,name=rname,r=r,toys=toys,seed=seed,options=options)
+                    jobs += [{'name': rname, 'tag': tag, 'command': command.strip()}]
+            else:
+                command = 'combine -M {method} -m {a} {datacard} -n "{name}" {options}'
+                command = command.format(method=method,a=astr,datacard=datacard,name=name,options=options)
+                jobs += [{'name': name, 'tag': tag, 'command': command.strip()}]
+    return jobs
+
+def runJob(args):
+    '''Run one job in its own work directory and move the combine outputs to the tag output directory'''
+    job, outputDirectory = args
+    name = job['name']
+    workDir = os.path.join(outputDirectory,'work',name)
+    logDir = os.path.join(outputDirectory,'logs')
+    outDir = os.path.join(outputDirectory,job['tag'])
+    for d in [logDir,outDir]: python_mkdir(d)
+    if os.path.exists(workDir): shutil.rmtree(workDir)
+    python_mkdir(workDir)
+
+    log = os.path.join(logDir,'{}.log'.format(name))
+    with open(log,'w') as f:
+        returncode = subprocess.call(job['command'],shell=True,cwd=workDir,stdout=f,stderr=subprocess.STDOUT)
+
+    with open(log) as f:
+        text = f.read()
+    markers = [m for m in FAILUREMARKERS if m in text]
+
+    outputs = []
+    for fname in sorted(glob.glob(os.path.join(workDir,'higgsCombine*.root'))):
+        dest = os.path.join(outDir,os.path.basename(fname))
+        shutil.move(fname,dest)
+        outputs += [dest]
+    shutil.rmtree(workDir,ignore_errors=True)
+
+    ok = returncode==0 and not markers and outputs and all([os.path.getsize(o)>0 for o in outputs])
+    return name, {
+        'command': job['command'],
+        'status': 'done' if ok else 'failed',
+        'returncode': returncode,
+        'markers': markers,
+        'outputs': outputs,
+        'log': log,
+    }
+
+################
+### manifest ###
+################
+def loadManifest(outputDirectory):
+    fname = os.path.join(outputDirectory,MANIFEST)
+    if not os.path.exists(fname): return {}
+    with open(fname) as f:
+        return json.load(f)
+
+def dumpManifest(outputDirectory,manifest):
+    '''Write to a temporary file and rename so an interrupted run never leaves a truncated manifest'''
+    fname = os.path.join(outputDirectory,MANIFEST)
+    tmp = fname+'.tmp'
+    with open(tmp,'w') as f:
+        json.dump(manifest,f,indent=4,sort_keys=True)
+    os.rename(tmp,fname)
+
+def isDone(entry):
+    return entry.get('status')=='done' and all([os.path.exists(o) for o in entry.get('outputs',[])])
+
+def runJobs(jobs,outputDirectory,**kwargs):
+    '''
+    Run the jobs that are not yet done according to the manifest.
+    Failed jobs are retried up to retries times.
+    Returns the names of the jobs that still failed.
+    '''
+    nCores = kwargs.pop('nCores',1)
+    retries = kwargs.pop('retries',0)
+    force = kwargs.pop('force',False)
+    dryrun = kwargs.pop('dryrun',False)
+
+    python_mkdir(outputDirectory)
+    manifest = loadManifest(outputDirectory)
+
+    todo = [job for job in jobs if force or not isDone(manifest.get(job['name'],{}))]
+    logging.info('{} of {} jobs to run'.format(len(todo),len(jobs)))
+    if dryrun:
+        for job in todo: print job['command']
+        return []
+
+    attempt = 0
+    while todo and attempt<=retries:
+        if attempt: logging.info('Retrying {} failed jobs'.format(len(todo)))
+        pool = Pool(nCores)
+        failed = []
+        try:
+            for i, (name, result) in enumerate(pool.imap_unordered(runJob,[(job,outputDirectory) for job in todo])):
+                result['attempts'] = manifest.get(name,{}).get('attempts',0)+1
+                manifest[name] = result
+                dumpManifest(outputDirectory,manifest)
+                if result['status']!='done': failed += [name]
+                logging.info('{}/{} {}: {}'.format(i+1,len(todo),name,result['status']))
+            pool.close()
+        except:
+            # any error (including KeyboardInterrupt) leaves the pool open, stop the workers before joining
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        todo = [job for job in todo if job['name'] in failed]
+        attempt += 1
+
+    for job in todo:
+        logging.warning('Failed: {} (see {})'.format(job['name'],manifest[job['name']]['log']))
+    return [job['name'] for job in todo]
+
+
+def addJobArguments(parser):
+    '''Arguments defining the set of jobs, shared with checkCombineJobs.py'''
+    parser.add_argument('datacards', type=str, nargs='*', default=[], help='Datacards (default: the parametric card in each datacards_shape/MuMuTauTau directory)')
+    parser.add_argument('--card', type=str, default='mmmt_mm_parametric_HToAAH{h}AX.txt', help='Card name in each datacard directory')
+    parser.add_argument('--mh', type=int, default=125, help='Higgs mass')
+    parser.add_argument('--masses', type=float, nargs='*', default=[], help='Pseudoscalar masses (overrides the range)')
+    parser.add_argument('--amin', type=float, default=3.6, help='First pseudoscalar mass')
+    parser.add_argument('--amax', type=float, default=21., help='Last pseudoscalar mass')
+    parser.add_argument('--astep', type=float, default=0.1, help='Pseudoscalar mass step')
+    parser.add_argument('-M','--method', type=str, default='AsymptoticLimits', choices=['AsymptoticLimits','HybridNew'], help='Combine method')
+    parser.add_argument('--rValues', type=float, nargs='*', default=[], help='Signal strengths for HybridNew --singlePoint')
+    parser.add_argument('--toys', type=int, default=1000, help='Number of toys for HybridNew')
+    parser.add_argument('--seed', type=int, default=-1, help='Seed for HybridNew')
+    parser.add_argument('--options', type=str, default='', help='Additional combine options')
+    parser.add_argument('--addon', type=str, default='', help='Name addon for the outputs')
+    parser.add_argument('--outputDirectory', type=str, default='rValues', help='Directory for the outputs, logs and manifest')
+
+def getJobsFromArgs(args):
+    '''The jobs for the parsed job arguments, None if they are inconsistent'''
+    datacards = args.datacards
+    if not datacards:
+        datacards = sorted(glob.glob('datacards_shape/MuMuTauTau/*/{}'.format(args.card.format(h=args.mh))))
+    if not datacards:
+        logging.error('No datacards found')
+        return None
+
+    if args.method=='HybridNew' and not args.rValues:
+        logging.error('HybridNew needs --rValues')
+        return None
+
+    masses = args.masses if args.masses else getMasses(args.amin,args.amax,args.astep)
+
+    return getJobs(datacards,masses,method=args.method,h=args.mh,addon=args.addon,rValues=args.rValues,toys=args.toys,seed=args.seed,options=args.options)
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Run combine limits on a local process pool')
+
+    addJobArguments(parser)
+    parser.add_argument('--retries', type=int, default=1, help='Number of retries for failed jobs')
+    parser.add_argument('--force', action='store_true', help='Rerun jobs that are already done')
+    parser.add_argument('--dryrun', action='store_true', help='Only print the commands that would be run')
+    parser.add_argument('-j', type=int, default=1, help='Number of concurrent jobs')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    jobs = getJobsFromArgs(args)
+    if jobs is None: return 1
+
+    failed = runJobs(jobs,args.outputDirectory,nCores=args.j,retries=args.retries,force=args.force,dryrun=args.dryrun)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -28,6 +28,9 @@ public:
   virtual TObject* clone(const char* newname) const { return new DoubleCrystalBall(*this,newname); }
   inline virtual ~DoubleCrystalBall() { }
 
+  Int_t getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* rangeName=0) const;
+  Double_t analyticalIntegral(Int_t code, const char* rangeName=0) const;
+
 protected:
 
   RooRealProxy x ;
@@ -42,6 +42,9 @@ public:
   virtual TObject* clone(const char* newname) const { return new DoubleSidedGaussian(*this,newname); }
   inline virtual ~DoubleSidedGaussian() { }
 
+  Int_t getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* rangeName=0) const;
+  Double_t analyticalIntegral(Int_t code, const char* rangeName=0) const;
+
 protected:
 
   RooRealProxy x ;
@@ -5,6 +5,57 @@ from array import array
 import ROOT
 from CombineLimitsRunII.Limits.utilities import *
 
+def binDataset(model,data,bins):
+    '''RooDataHist of an unbinned dataset in the observables of model, with bins = {observable: nbins}'''
+    obs = model.getObservables(data).snapshot()
+    for name, nbins in bins.iteritems():
+        var = obs.find(name)
+        if var: var.setBins(nbins)
+    name = '{}_binned'.format(data.GetName())
+    return ROOT.RooDataHist(name, name, ROOT.RooArgList(obs), data)
+
+def fitModel(model,data,prefitBins={}):
+    '''
+    Fit like model.fitTo(data,Save(),SumW2Error(True),PrintLevel(-1)), driving the
+    RooMinimizer directly to also return the MIGRAD status and number of NLL calls.
+    With prefitBins = {observable: nbins}, an unbinned dataset is first fitted binned
+    and the unbinned MIGRAD (strategy 0) only polishes the binned optimum.
+    '''
+    ncalls = 0
+    strategy = 1
+    if prefitBins and not data.InheritsFrom('RooDataHist'):
+        binned = binDataset(model,data,prefitBins)
+        nll = model.createNLL(binned)
+        minim = ROOT.RooMinimizer(nll)
+        minim.setPrintLevel(-1)
+        minim.optimizeConst(2)
+        minim.zeroEvalCount()
+        if minim.migrad()==0: strategy = 0
+        ncalls += minim.evalCounter()
+        logging.debug('Binned prefit of {}: {} calls'.format(model.GetName(),minim.evalCounter()))
+
+    nll = model.createNLL(data)
+    minim = ROOT.RooMinimizer(nll)
+    minim.setPrintLevel(-1)
+    minim.setStrategy(strategy)
+    minim.optimizeConst(2)
+    minim.zeroEvalCount()
+    status = minim.migrad()
+    ncalls += minim.evalCounter()
+    minim.hesse()
+    if data.isWeighted():
+        # covariance correction for weighted data as in RooAbsPdf::fitTo: V C^-1 V
+        fr = minim.save()
+        nll.applyWeightSquared(True)
+        minim.hesse()
+        frw2 = minim.save()
+        nll.applyWeightSquared(False)
+        cov = ROOT.TMatrixDSym(frw2.covarianceMatrix())
+        cov.Invert()
+        cov.Similarity(fr.covarianceMatrix())
+        minim.applyCovarianceMatrix(cov)
+    return minim.save(), status, ncalls
+
 class Model(object):
 
     def __init__(self,name,**kwargs):
@@ -135,8 +186,8 @@ class Model(object):
             return vals, errs
         return vals
 
-    def fit2D(self,ws,hist,name,save=False,doErrors=False,saveDir='', xFitRange=[0,30], yFitRange=[0,30], logy=False, xRange=[], yRange=[]):
-        '''Fit the model to a histogram and return the fit values'''
+    def fit2D(self,ws,hist,name,save=False,doErrors=False,saveDir='', xFitRange=[0,30], yFitRange=[0,30], logy=False, xRange=[], yRange=[], prefitBins={}):
+        '''Fit the model to a histogram and return the fit values, prefitBins enables a binned prefit of unbinned data'''
 
         if isinstance(hist,ROOT.TH1):
             dhname = 'dh_{0}'.format(name)
@@ -146,7 +197,7 @@ class Model(object):
         #ws.var('x').setRange('xRange', xFitRange[0], xFitRange[1])
         #ws.var('y').setRange('yRange', yFitRange[0], yFitRange[1])
         #print ("X_FIT_RANGE=", xFitRange, "\tY_FIT_RANGE=", yFitRange)
-        fr = model.fitTo(hist,ROOT.RooFit.Save(),ROOT.RooFit.SumW2Error(True),ROOT.RooFit.PrintLevel(-1))
+        fr, self.fitStatus, self.fitCalls = fitModel(model,hist,prefitBins=prefitBins)
         #fr = model.fitTo(hist,ROOT.RooFit.Save(),ROOT.RooFit.SumW2Error(True),ROOT.RooFit.Minos(True))
         pars = fr.floatParsFinal()
         vals = {}
@@ -393,6 +444,35 @@ def buildSpline(ws,label,MH,masses,values):
 
     return spline
 
+_splineCache = {}
+
+def getSpline(ws,label,MH,masses,values):
+    '''
+    Import a spline into the workspace, or return an identical one imported before under another name.
+    Only for splines used as servers of other functions, never looked up by their own name.
+    '''
+    if not isinstance(values, list):
+        spline = buildSpline(ws,label,MH,masses,values)
+        getattr(ws, "import")(spline, ROOT.RooFit.RecycleConflictNodes())
+        return ws.function(label)
+    key = (
+        ROOT.AddressOf(ws)[0], ws.GetName(),
+        tuple(MH) if isinstance(MH, list) else MH,
+        tuple([tuple(m) if isinstance(m, list) else m for m in masses]),
+        tuple(values),
+    )
+    name = _splineCache.get(key)
+    if name and ws.function(name):
+        logging.debug('Reusing {} for {}'.format(name,label))
+        return ws.function(name)
+    spline = buildSpline(ws,label,MH,masses,values)
+    getattr(ws, "import")(spline, ROOT.RooFit.RecycleConflictNodes())
+    _splineCache[key] = label
+    return ws.function(label)
+
+def clearSplineCache():
+    _splineCache.clear()
+
 class ModelSpline(Model):
 
     def __init__(self,name,**kwargs):
@@ -463,11 +543,19 @@ class Spline(object):
         splineName = label
         if shifts:
             if isinstance(values,list):
+                # identical splines are imported once and shifts below the uncertainty get no spline
                 args = ROOT.TList()
+                argIndices = {}
+                def addArg(arg):
+                    if arg.GetName() not in argIndices:
+                        argIndices[arg.GetName()] = len(args)
+                        args.Add(arg)
+                    return argIndices[arg.GetName()]
+                def isShifted(deltas):
+                    return any([abs(d/v)>uncertainty if v else d for d,v in zip(deltas,values)])
                 centralName = '{0}_central'.format(label)
-                splineCentral = buildSpline(ws,centralName,self.mh,masses,values)
-                shiftFormula = '@0'
-                args.Add(splineCentral)
+                splineCentral = getSpline(ws,centralName,self.mh,masses,values)
+                shiftFormula = '@{}'.format(addArg(splineCentral))
                 for shift in shifts:
                     up = [u-c for u,c in zip(shifts[shift]['up'],values)]
                     down = [c-d for d,c in zip(shifts[shift]['down'],values)]
@@ -475,14 +563,17 @@ class Spline(object):
                     downName = '{0}_{1}Down'.format(splineName,shift)
                     if any([ v == 0 for v in values]):
                         logging.warning('Zero value for {}: {}'.format(splineName, ' '.join(['{}'.format(v) for v in values])))
-                    if any([abs(u/v)>uncertainty if v else u for u,v in zip(up,values)]) or any([abs(d/v)>uncertainty if v else d for d,v in zip(down,values)]):
-                        ws.factory('{}[0,-10,10]'.format(shift))
-                        splineUp   = buildSpline(ws,upName,  self.mh,masses,up)
-                        splineDown = buildSpline(ws,downName,self.mh,masses,down)
-                        shiftFormula += ' + TMath::Max(0,@{shift})*@{up} + TMath::Min(0,@{shift})*@{down}'.format(shift=len(args),up=len(args)+1,down=len(args)+2)
-                        args.Add(ws.var(shift))
-                        args.Add(splineUp)
-                        args.Add(splineDown)
+                    shiftUp = isShifted(up)
+                    shiftDown = isShifted(down)
+                    if not (shiftUp or shiftDown): continue
+                    ws.factory('{}[0,-10,10]'.format(shift))
+                    s = addArg(ws.var(shift))
+                    if shiftUp:
+                        splineUp = getSpline(ws,upName,self.mh,masses,up)
+                        shiftFormula += ' + TMath::Max(0,@{shift})*@{up}'.format(shift=s,up=addArg(splineUp))
+                    if shiftDown:
+                        splineDown = getSpline(ws,downName,self.mh,masses,down)
+                        shiftFormula += ' + TMath::Min(0,@{shift})*@{down}'.format(shift=s,down=addArg(splineDown))
                 arglist = ROOT.RooArgList(args)
                 spline = ROOT.RooFormulaVar(splineName, splineName, shiftFormula, arglist)
             else:
@@ -8,6 +8,9 @@ import math
 import json
 import pickle
 import glob
+import collections
+
+import numpy as np
 
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
@@ -66,24 +69,6 @@ def sumHists(name,*hists):
     hist.Merge(histlist)
     return hist
 
-def getDatasetIntegralError(dataset, cutSpec=''):
-    
-    select = ROOT.RooFormula()
-    if cutSpec:
-        select = ROOT.RooFormula("select",cutSpec,ROOT.RooArgList(dataset.get()))
-    
-    if not cutSpec and not dataset.isWeighted():
-        return dataset.numEntries()**0.5
-    
-    sumw2 = 0
-    for i in xrange(dataset.numEntries()):
-        dataset.get(i)
-        if (cutSpec and select.eval()==0.): continue
-        sumw2 += dataset.weight()**2
-    
-    return sumw2**0.5
-
-
 def getHistogramIntegralError(hist,binlow=1,binhigh=-1):
     if binhigh<0: binhigh = hist.GetNbinsX()
     integralerr = ROOT.Double(0)
@@ -96,3 +81,141 @@ def getHistogram2DIntegralError(hist,binxlow=1,binxhigh=-1,binylow=1,binyhigh=-1
     integralerr = ROOT.Double(0)
     hist.IntegralAndError(binxlow,binxhigh,binylow,binyhigh,integralerr,"")
     return float(integralerr)
+
+MAXDATASETARRAYS = 20
+_datasetArrays = collections.OrderedDict()
+
+# copy between RooAbsData and numpy tables in single compiled loops
+_datasetArraysCode = '''
+#include "RooAbsData.h"
+#include "RooAbsReal.h"
+#include "RooRealVar.h"
+#include "RooDataSet.h"
+#include "RooArgList.h"
+#include <vector>
+void fillDatasetArrays(RooAbsData& data, const RooArgList& vars, double* values, double* weights) {
+  const RooArgSet* row = data.get();
+  std::vector<RooAbsReal*> reals;
+  for (int j=0; j<vars.getSize(); ++j) reals.push_back(static_cast<RooAbsReal*>(row->find(vars.at(j)->GetName())));
+  int nvar = reals.size();
+  for (int i=0; i<data.numEntries(); ++i) {
+    data.get(i);
+    for (int j=0; j<nvar; ++j) values[i*nvar+j] = reals[j]->getVal();
+    weights[i] = data.weight();
+  }
+}
+void fillDatasetFromArrays(RooDataSet& data, const RooArgList& vars, const double* values, const double* weights, int n) {
+  RooArgSet row(vars);
+  std::vector<RooRealVar*> reals;
+  for (int j=0; j<vars.getSize(); ++j) reals.push_back(static_cast<RooRealVar*>(vars.at(j)));
+  int nvar = reals.size();
+  for (int i=0; i<n; ++i) {
+    for (int j=0; j<nvar; ++j) reals[j]->setVal(values[i*nvar+j]);
+    data.add(row,weights[i]);
+  }
+}
+'''
+
+def _declareDatasetCode():
+    if not hasattr(ROOT,'fillDatasetArrays'):
+        ROOT.gInterpreter.Declare(_datasetArraysCode)
+
+def getDatasetArrays(dataset):
+    '''
+    Copy the real valued variables and the weights of a RooAbsData into numpy arrays.
+    The arrays of the last MAXDATASETARRAYS datasets are kept, so repeated integrals
+    and hashes scan a dataset only once. The entry holds a reference to the dataset
+    and is only reused for that same object, never for a new one at a recycled address.
+    '''
+    key = (ROOT.AddressOf(dataset)[0], dataset.GetName(), dataset.numEntries(), dataset.sumEntries())
+    entry = _datasetArrays.pop(key,None)
+    if entry is None or entry[0] is not dataset:
+        entry = (dataset, _readDatasetArrays(dataset))
+        while len(_datasetArrays)>=MAXDATASETARRAYS:
+            _datasetArrays.popitem(last=False)
+    _datasetArrays[key] = entry
+    return entry[1]
+
+def clearDatasetArrays():
+    _datasetArrays.clear()
+
+def _readDatasetArrays(dataset):
+    _declareDatasetCode()
+    args = ROOT.RooArgList(dataset.get())
+    reals = ROOT.RooArgList()
+    for i in range(args.getSize()):
+        if args.at(i).InheritsFrom('RooAbsReal'): reals.add(args.at(i))
+    names = [reals.at(i).GetName() for i in range(reals.getSize())]
+    n = dataset.numEntries()
+    table = np.zeros((n,len(names)))
+    weights = np.zeros(n)
+    if n: ROOT.fillDatasetArrays(dataset,reals,table,weights)
+    values = dict([(name,table[:,j]) for j,name in enumerate(names)])
+    return values, weights
+
+def fillDataset(dataset, variables, columns, weights=None):
+    '''
+    Add the rows of numpy columns to a RooDataSet in one call.
+    variables are the RooRealVars of the columns, weights default to 1.
+    '''
+    _declareDatasetCode()
+    vars = ROOT.RooArgList()
+    for v in variables: vars.add(v)
+    n = len(columns[0]) if columns else 0
+    table = np.ascontiguousarray(np.column_stack(columns) if columns else np.zeros((0,0)),dtype=np.float64)
+    weights = np.ascontiguousarray(weights if weights is not None else np.ones(n),dtype=np.float64)
+    if n: ROOT.fillDatasetFromArrays(dataset,vars,table,weights,n)
+    return dataset
+
+def getRangeMask(values,weights,ranges={}):
+    '''
+    Vectorized version of a '{var}>{low} && {var}<{high}' cut string.
+    ranges = {var: [low,high]}, all ranges must be satisfied.
+    '''
+    mask = np.ones(len(weights),dtype=bool)
+    for var,(low,high) in ranges.items():
+        mask &= (values[var]>low) & (values[var]<high)
+    return mask
+
+def getDatasetIntegralAndError(dataset, ranges={}):
+    '''Sum of weights and its error inside rectangular ranges, from the memoized dataset arrays'''
+    values, weights = getDatasetArrays(dataset)
+    w = weights[getRangeMask(values,weights,ranges)]
+    return float(w.sum()), float((w**2).sum())**0.5
+
+def getAxisEdges(axis):
+    return np.array([axis.GetBinLowEdge(b) for b in range(1,axis.GetNbins()+2)])
+
+def fillHistogram(hist, dataset, xVar, yVar='', ranges={}):
+    '''
+    Fill a TH1 (xVar) or TH2 (xVar, yVar) from a RooAbsData with numpy,
+    applying the range selection. The histogram content is replaced.
+    '''
+    values, weights = getDatasetArrays(dataset)
+    mask = getRangeMask(values,weights,ranges)
+    w = weights[mask]
+    xedges = getAxisEdges(hist.GetXaxis())
+    if yVar:
+        yedges = getAxisEdges(hist.GetYaxis())
+        sumw,  _, _ = np.histogram2d(values[xVar][mask],values[yVar][mask],bins=[xedges,yedges],weights=w)
+        sumw2, _, _ = np.histogram2d(values[xVar][mask],values[yVar][mask],bins=[xedges,yedges],weights=w**2)
+        # root global bin = ix + (nx+2)*iy, including under/overflow
+        content = np.zeros((len(yedges)+1,len(xedges)+1))
+        errors2 = np.zeros((len(yedges)+1,len(xedges)+1))
+        content[1:-1,1:-1] = sumw.T
+        errors2[1:-1,1:-1] = sumw2.T
+    else:
+        sumw,  _ = np.histogram(values[xVar][mask],bins=xedges,weights=w)
+        sumw2, _ = np.histogram(values[xVar][mask],bins=xedges,weights=w**2)
+        content = np.zeros(len(xedges)+1)
+        errors2 = np.zeros(len(xedges)+1)
+        content[1:-1] = sumw
+        errors2[1:-1] = sumw2
+    content = np.ascontiguousarray(content.ravel())
+    errors2 = np.ascontiguousarray(errors2.ravel())
+    hist.Reset()
+    hist.Sumw2()
+    hist.SetContent(content)
+    hist.GetSumw2().Set(len(errors2),errors2)
+    hist.SetEntries(int(mask.sum()))
+    return hist
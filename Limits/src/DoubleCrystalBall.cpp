@@ -63,5 +63,52 @@ Double_t DoubleCrystalBall::evaluate() const
  	return result;
 } 
 
+Int_t DoubleCrystalBall::getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* /*rangeName*/) const
+{
+  if (matchArgs(allVars,analVars,x)) return 1 ;
+  return 0 ;
+}
 
+Double_t DoubleCrystalBall::analyticalIntegral(Int_t code, const char* rangeName) const
+{
+  assert(code==1);
 
+  double umin = (x.min(rangeName)-mean)/sig;
+  double umax = (x.max(rangeName)-mean)/sig;
+  double A1  = TMath::Power(n1/TMath::Abs(a1),n1)*TMath::Exp(-a1*a1/2);
+  double A2  = TMath::Power(n2/TMath::Abs(a2),n2)*TMath::Exp(-a2*a2/2);
+  double B1  = n1/TMath::Abs(a1) - TMath::Abs(a1);
+  double B2  = n2/TMath::Abs(a2) - TMath::Abs(a2);
+  double sqrtPiOver2 = TMath::Sqrt(0.5*TMath::Pi());
+
+  double result = 0;
+
+  // left tail, u < -a1
+  double lo = umin, hi = TMath::Min(umax,-a1);
+  if (hi>lo) {
+    if (TMath::Abs(n1-1)<1e-5)
+      result += A1 * (TMath::Log(B1-lo) - TMath::Log(B1-hi));
+    else
+      result += A1 / (n1-1) * (TMath::Power(B1-hi,1-n1) - TMath::Power(B1-lo,1-n1));
+  }
+
+  // gaussian core, -a1 < u < a2
+  lo = TMath::Max(umin,-a1);
+  hi = TMath::Min(umax,a2);
+  if (hi>lo) {
+    result += sqrtPiOver2 * (TMath::Erf(hi/TMath::Sqrt(2.)) - TMath::Erf(lo/TMath::Sqrt(2.)));
+  }
+
+  // right tail, u > a2
+  lo = TMath::Max(umin,a2);
+  hi = umax;
+  if (hi>lo) {
+    if (TMath::Abs(n2-1)<1e-5)
+      result += A2 * (TMath::Log(B2+hi) - TMath::Log(B2+lo));
+    else
+      result += A2 / (1-n2) * (TMath::Power(B2+hi,1-n2) - TMath::Power(B2+lo,1-n2));
+  }
+
+  // du = dx/sig
+  return result*sig;
+}
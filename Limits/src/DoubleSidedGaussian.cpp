@@ -72,3 +72,33 @@ Double_t DoubleSidedGaussian::evaluate() const
 //  return result;
 } 
 
+Int_t DoubleSidedGaussian::getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* /*rangeName*/) const
+{
+  if (matchArgs(allVars,analVars,x)) return 1 ;
+  return 0 ;
+}
+
+Double_t DoubleSidedGaussian::analyticalIntegral(Int_t code, const char* rangeName) const
+{
+  assert(code==1);
+
+  double xmin = x.min(rangeName);
+  double xmax = x.max(rangeName);
+  double sqrt2pi = TMath::Power( 2 * TMath::Pi(), 0.5); 
+  double mode = mean - 2 / sqrt2pi * (sig2 - sig1);
+  double scaleFactor = sig2 / sig1;
+  double total_integral = 0.5 * (1 + scaleFactor);
+  double sqrt2 = TMath::Sqrt(2.);
+
+  // each side is a normalized gaussian about the mode
+  double result = 0;
+  double lo = xmin, hi = TMath::Min(xmax,mode);
+  if (hi>lo)
+    result += 0.5 * (TMath::Erf((hi-mode)/(sqrt2*sig1)) - TMath::Erf((lo-mode)/(sqrt2*sig1)));
+  lo = TMath::Max(xmin,mode);
+  hi = xmax;
+  if (hi>lo)
+    result += 0.5 * (TMath::Erf((hi-mode)/(sqrt2*sig2)) - TMath::Erf((lo-mode)/(sqrt2*sig2))) * scaleFactor;
+
+  return result / total_integral;
+}
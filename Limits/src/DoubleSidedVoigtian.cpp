@@ -17,6 +17,48 @@
 
 ClassImp(DoubleSidedVoigtian) 
 
+namespace {
+  // 10 point Gauss-Legendre abscissas and weights on [-1,1], symmetric half
+  const double glNodes[5]   = {0.1488743389816312, 0.4333953941292472, 0.6794095682990244, 0.8650633666889845, 0.9739065285171717};
+  const double glWeights[5] = {0.2955242247147529, 0.2692667193099963, 0.2190863625159820, 0.1494513491505806, 0.0666713443086881};
+
+  // Left of the mean 0.5*C1*Re[w(Z1)]/sqrt(pi)/T, right of it 0.5*C2*Re[w(Z2)]/sqrt(pi)*s/T,
+  // with Z = C*(x-mean) + i*A, s = Re[w(Z1)]/Re[w(Z2)]*sig2/sig1 and T = (1+s)/2 all taken at x.
+  inline double doubleSidedVoigtianShape(double x, double mean, double C1, double A1, double C2, double A2, double sig1, double sig2)
+  {
+    double v1 = RooMath::faddeeva_fast(std::complex<Double_t>(C1*(x-mean),A1)).real();
+    double v2 = RooMath::faddeeva_fast(std::complex<Double_t>(C2*(x-mean),A2)).real();
+    double scale_factor = (v1 / v2) * (sig2/sig1);
+    double total_integral = .5 * (1+scale_factor);
+    if ( x < mean)
+      return 0.5 * C1 * v1 / TMath::Power(TMath::Pi(), 0.5) / total_integral;
+    else
+      return 0.5 * C2 * v2 / TMath::Power(TMath::Pi(), 0.5) * scale_factor / total_integral;
+  }
+
+  // Integral of the shape from lo to hi.
+  // There is no closed form, so use composite Gauss-Legendre
+  // with panels about as wide as the voigt peak.
+  double shapeIntegral(double lo, double hi, double width, double mean, double C1, double A1, double C2, double A2, double sig1, double sig2)
+  {
+    if (hi<=lo) return 0;
+    int nPanels = (width>0) ? (int)TMath::Ceil((hi-lo)/width) : 1;
+    if (nPanels<1)   nPanels = 1;
+    if (nPanels>200) nPanels = 200;
+    double half = 0.5*(hi-lo)/nPanels;
+    double result = 0;
+    for (int p=0; p<nPanels; ++p) {
+      double center = lo + (2*p+1)*half;
+      for (int k=0; k<5; ++k) {
+        double dx = half*glNodes[k];
+        result += glWeights[k] * (doubleSidedVoigtianShape(center-dx, mean, C1, A1, C2, A2, sig1, sig2)
+                                + doubleSidedVoigtianShape(center+dx, mean, C1, A1, C2, A2, sig1, sig2));
+      }
+    }
+    return result*half;
+  }
+}
+
 DoubleSidedVoigtian::DoubleSidedVoigtian(const char *name, const char *title, 
                        RooAbsReal& _x,
                        RooAbsReal& _mean,
@@ -53,40 +95,37 @@ DoubleSidedVoigtian::DoubleSidedVoigtian(const DoubleSidedVoigtian& other, const
 
 Double_t DoubleSidedVoigtian::evaluate() const 
 { 
+  double C1 = 1 / (TMath::Sqrt(2.0)*sig1); 
+  double C2 = 1 / (TMath::Sqrt(2.0)*sig2);
+  Double_t A1 = 0.5*C1*wid1;
+  Double_t A2 = 0.5*C2*wid2;
+  return doubleSidedVoigtianShape(x, mean, C1, A1, C2, A2, sig1, sig2);
+} 
+
+Int_t DoubleSidedVoigtian::getAnalyticalIntegral(RooArgSet& allVars, RooArgSet& analVars, const char* /*rangeName*/) const
+{
+  if (matchArgs(allVars,analVars,x)) return 1 ;
+  return 0 ;
+}
+
+Double_t DoubleSidedVoigtian::analyticalIntegral(Int_t code, const char* rangeName) const
+{
+  assert(code==1);
+
+  double xmin = x.min(rangeName);
+  double xmax = x.max(rangeName);
   double sqrttwologtwo = TMath::Power( 2*TMath::Log(2), 0.5);
   double gau1_width = sig1*sqrttwologtwo, gau2_width = sig2*sqrttwologtwo;
   double voigt1_width = 0.5346*wid1 + TMath::Power(.2166*wid1*wid1+gau1_width*gau1_width, 0.5);
   double voigt2_width = 0.5346*wid2 + TMath::Power(.2166*wid2*wid2+gau2_width*gau2_width, 0.5);
-  double mode = mean - TMath::Power(2/TMath::Pi(), 0.5) * (voigt2_width - voigt1_width);
-  if (mode > yMax)
-    mode = yMax;
   double C1 = 1 / (TMath::Sqrt(2.0)*sig1); 
   double C2 = 1 / (TMath::Sqrt(2.0)*sig2);
   Double_t A1 = 0.5*C1*wid1;
   Double_t A2 = 0.5*C2*wid2;
-  Double_t U1 = C1*(x-mean);
-  Double_t U2 = C2*(x-mean);
-  std::complex<Double_t> Z1(U1,A1) ;
-  std::complex<Double_t> Z2(U2,A2) ;
-  std::complex<Double_t> voigt(0.) ;
-  std::complex<Double_t> Z1_at_mean(0,A1) ;
-  std::complex<Double_t> Z2_at_mean(0,A2) ;
-  std::complex<Double_t> voigt1_at_mean = RooMath::faddeeva_fast(Z1);
-  std::complex<Double_t> voigt2_at_mean = RooMath::faddeeva_fast(Z2);
-  double scale_factor = (voigt1_at_mean.real() / voigt2_at_mean.real()) * (sig2/sig1);
-  double total_integral = .5 * (1+scale_factor);
-  if ( x < mean)
-  {
-    voigt = RooMath::faddeeva_fast(Z1);
-    return 0.5 * C1 * voigt.real() / TMath::Power(TMath::Pi(), 0.5) / total_integral;
-  }//if
-  else
-  {
-    voigt = RooMath::faddeeva_fast(Z2);
-    return 0.5 * C2 * voigt.real() / TMath::Power(TMath::Pi(), 0.5) * scale_factor / total_integral;
-  }//else
-
-} 
-
 
+  double result = 0;
+  result += shapeIntegral(xmin, TMath::Min(xmax,(double)mean), voigt1_width, mean, C1, A1, C2, A2, sig1, sig2);
+  result += shapeIntegral(TMath::Max(xmin,(double)mean), xmax, voigt2_width, mean, C1, A1, C2, A2, sig1, sig2);
 
+  return result;
+}
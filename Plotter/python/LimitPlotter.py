@@ -5,6 +5,8 @@ import math
 from array import array
 from collections import OrderedDict
 
+import numpy as np
+
 import ROOT
 
 
@@ -41,6 +43,248 @@ ROOT.gStyle.SetPalette(nb)
 
 ROOT.gStyle.SetNumberContours(255)
 
+# resonance windows left unsmoothed
+SMOOTHINGVETOES = [(3,4),(8.5,11.5)] # jpsi, upsilon
+
+def smoothKern(x,y,bandwidth,xout=None):
+    '''
+    Vectorized TGraphSmooth::SmoothKern with the normal kernel, evaluated at xout (default x).
+    y can have one column per curve, all curves share the kernel weights.
+    '''
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    xout = x if xout is None else np.asarray(xout,dtype=float)
+    # same convention as ROOT: quartiles of the kernel at +-0.25*bandwidth, cut off at 4 sigma
+    bw = 0.3706506*bandwidth
+    d = (x[np.newaxis,:]-xout[:,np.newaxis])/bw
+    weights = np.where(np.abs(d)<=4,np.exp(-0.5*d**2),0.)
+    num = weights.dot(y)
+    den = weights.sum(axis=1)
+    if num.ndim>1: den = den[:,np.newaxis]
+    return np.where(den>0,num/np.where(den>0,den,1.),0.)
+
+def getLimitBands(xvals,limits,**kwargs):
+    '''
+    Limits for all x at once.
+    Returns x, an (n,6) array of the 0.025, 0.16, 0.5, 0.84, 0.975 and observed limits
+    and the mask of the points with all limits.
+    '''
+    smooth = kwargs.pop('smooth',False)
+
+    x = np.array(xvals,dtype=float)
+    q = np.zeros((len(xvals),6))
+    valid = np.zeros(len(xvals),dtype=bool)
+    for i, xv in enumerate(xvals):
+        if len(limits[xv])<6 or not all(limits[xv]):
+            print i, xv, limits[xv]
+            continue
+        q[i] = limits[xv][:6]
+        valid[i] = True
+
+    if smooth: q = smoothLimitBands(x,q,valid,**kwargs)
+
+    return x, q, valid
+
+def smoothLimitBands(x,q,valid,**kwargs):
+    '''Kernel smooth the inner points of the expected quantiles outside of the vetoed windows'''
+    smoothlog = kwargs.pop('smoothlog',False)
+    bandwidth = kwargs.pop('bandwidth',0.5 if smoothlog else 1.3) # originally 0.3, increased to smooth out highmass
+    vetoes = kwargs.pop('vetoes',SMOOTHINGVETOES)
+
+    q = q.copy()
+    if valid.sum()<3: return q
+    inner = valid.copy()
+    inner[[0,-1]] = False
+    for low, high in vetoes:
+        inner &= ~((x>low) & (x<high))
+    # smooth log, good for exponentially changing
+    ys = np.log(q[valid,:5]) if smoothlog else q[valid,:5]
+    smoothed = smoothKern(x[valid],ys,bandwidth,x[inner])
+    q[inner,:5] = np.exp(smoothed) if smoothlog else smoothed
+    return q
+
+def getArrayGraph(x,y):
+    '''TGraph from arrays in one call'''
+    x = np.ascontiguousarray(x,dtype=float)
+    y = np.ascontiguousarray(y,dtype=float)
+    return ROOT.TGraph(len(x),x,y)
+
+def getGraphArrays(graph):
+    '''x and y of a TGraph as numpy arrays, sorted in x'''
+    n = graph.GetN()
+    if not n: return np.zeros(0), np.zeros(0)
+    x = np.frombuffer(graph.GetX(),count=n).copy()
+    y = np.frombuffer(graph.GetY(),count=n).copy()
+    order = np.argsort(x,kind='mergesort')
+    return x[order], y[order]
+
+def getLinearWeights(x,xout):
+    '''
+    Indices and weights of the TGraph::Eval linear interpolation on sorted x,
+    extrapolating from the outermost points: y(xout) = y[i0]*(1-t)+y[i1]*t.
+    '''
+    xout = np.asarray(xout,dtype=float)
+    if len(x)<2:
+        i = np.zeros(xout.shape,dtype=int)
+        return i, i, np.zeros(xout.shape)
+    i1 = np.clip(np.searchsorted(x,xout),1,len(x)-1)
+    i0 = i1-1
+    dx = x[i1]-x[i0]
+    t = np.where(dx!=0,(xout-x[i0])/np.where(dx!=0,dx,1.),0.)
+    return i0, i1, t
+
+def evalGraph(graph,xout):
+    '''Vectorized TGraph::Eval'''
+    x, y = getGraphArrays(graph)
+    if not len(x): return np.zeros(np.shape(xout))
+    i0, i1, t = getLinearWeights(x,xout)
+    return y[i0]*(1-t)+y[i1]*t
+
+def getLimitGrid(xvals,limits,xout,yout,**kwargs):
+    '''
+    Limits on the whole (y,x) grid at once, as an array of shape (len(yout),len(xout),6)
+    with the quantiles of getLimitBands.
+    The expected and observed limits at each x value are scaled by scales[x][modelkey], a graph versus y,
+    the +-1 and 2 sigma quantiles only with scaleBands. All are interpolated in x like TGraph::Eval.
+    '''
+    smooth = kwargs.pop('smooth',False)
+    scales = kwargs.pop('scales',None)
+    modelkey = kwargs.pop('modelkey',None)
+    scaleBands = kwargs.pop('scaleBands',False)
+
+    yout = np.atleast_1d(np.asarray(yout,dtype=float))
+    x, q, valid = getLimitBands(xvals,limits,smooth=smooth)
+    x = x[valid]
+    q = q[valid]
+    if not len(x): return np.zeros((len(yout),len(xout),6))
+
+    if scales and modelkey:
+        scale = np.array([evalGraph(scales[xv][modelkey],yout) for xv, v in zip(xvals,valid) if v]).T
+        scale[scale<=0] = 1e-10
+    else:
+        scale = np.ones((len(yout),len(x)))
+    grid = np.repeat(q[np.newaxis,:,:],len(yout),axis=0)
+    grid[:,:,range(6) if scaleBands else [2,5]] *= scale[:,:,np.newaxis]
+
+    i0, i1, t = getLinearWeights(x,xout)
+    t = t[np.newaxis,:,np.newaxis]
+    return grid[:,i0,:]*(1-t)+grid[:,i1,:]*t
+
+def getLimitGridMulti(xvalsMulti,limitsMulti,xout,yout,**kwargs):
+    '''
+    getLimitGrid for limits split in ranges of x, each x column is taken from the first range containing it
+    and from the last range if none does.
+    '''
+    smooth = kwargs.pop('smooth',False)
+    scalesMulti = kwargs.pop('scales',None)
+    modelkey = kwargs.pop('modelkey',None)
+    scaleBands = kwargs.pop('scaleBands',False)
+
+    xout = np.asarray(xout,dtype=float)
+    yout = np.atleast_1d(np.asarray(yout,dtype=float))
+    choice = np.full(len(xout),len(xvalsMulti)-1,dtype=int)
+    for ilim in reversed(range(len(xvalsMulti))):
+        xvals = xvalsMulti[ilim]
+        choice[(xout>=xvals[0]) & (xout<=xvals[-1])] = ilim
+
+    grid = np.zeros((len(yout),len(xout),6))
+    for ilim, (xvals, limits) in enumerate(zip(xvalsMulti,limitsMulti)):
+        cols = choice==ilim
+        if not cols.any(): continue
+        scales = scalesMulti[ilim] if scalesMulti else None
+        grid[:,cols,:] = getLimitGrid(xvals,limits,xout[cols],yout,smooth=smooth,scales=scales,modelkey=modelkey,scaleBands=scaleBands)
+    return grid
+
+def setHistContent(hist,z):
+    '''Replace the content of a TH1 (z[x]) or TH2 (z[y][x]) in one call, under- and overflow empty'''
+    z = np.asarray(z,dtype=float)
+    content = np.zeros([n+2 for n in z.shape])
+    content[tuple([slice(1,-1)]*z.ndim)] = z
+    hist.SetContent(np.ascontiguousarray(content.ravel()))
+
+# line segments of each marching squares case between the bottom, right, top and left cell edges
+# corners: 1 bottom left, 2 bottom right, 4 top right, 8 top left above the level
+# saddles (5, 10) are resolved with the cell center in getContours
+CONTOURSEGMENTS = {
+    1: ['BL'], 2: ['BR'], 3: ['LR'], 4: ['RT'], 6: ['BT'], 7: ['LT'],
+    8: ['LT'], 9: ['BT'], 11: ['RT'], 12: ['LR'], 13: ['BR'], 14: ['BL'],
+}
+
+def getContours(xout,yout,z,level):
+    '''
+    Contour lines of z[y][x] at level using marching squares on all cells at once.
+    Returns a list of (x,y) arrays, one per connected line, closed lines end on their first point.
+    '''
+    xs = np.asarray(xout,dtype=float)
+    ys = np.asarray(yout,dtype=float)
+    z = np.asarray(z,dtype=float)
+    ny, nx = z.shape
+    if nx<2 or ny<2: return []
+
+    def frac(z0,z1):
+        dz = z1-z0
+        return np.where(dz!=0,(level-z0)/np.where(dz!=0,dz,1.),0.5)
+
+    # crossing point on every horizontal (ny,nx-1) and vertical (ny-1,nx) edge
+    hx = xs[np.newaxis,:-1]+frac(z[:,:-1],z[:,1:])*np.diff(xs)[np.newaxis,:]
+    hy = np.repeat(ys[:,np.newaxis],nx-1,axis=1)
+    vx = np.repeat(xs[np.newaxis,:],ny-1,axis=0)
+    vy = ys[:-1,np.newaxis]+frac(z[:-1,:],z[1:,:])*np.diff(ys)[:,np.newaxis]
+    px = np.concatenate([hx.ravel(),vx.ravel()])
+    py = np.concatenate([hy.ravel(),vy.ravel()])
+
+    nh = ny*(nx-1)
+    ci, cj = np.mgrid[0:ny-1,0:nx-1]
+    edges = {
+        'B': ci*(nx-1)+cj,
+        'T': (ci+1)*(nx-1)+cj,
+        'L': nh+ci*nx+cj,
+        'R': nh+ci*nx+cj+1,
+    }
+    above = z>level
+    case = above[:-1,:-1]*1 + above[:-1,1:]*2 + above[1:,1:]*4 + above[1:,:-1]*8
+    center = 0.25*(z[:-1,:-1]+z[:-1,1:]+z[1:,1:]+z[1:,:-1])>level
+
+    masks = [(case==c,pairs) for c,pairs in CONTOURSEGMENTS.iteritems()]
+    masks += [
+        ((case==5) & center,  ['BR','LT']),
+        ((case==5) & ~center, ['BL','RT']),
+        ((case==10) & center, ['BL','RT']),
+        ((case==10) & ~center,['BR','LT']),
+    ]
+    starts = []
+    ends = []
+    for mask, pairs in masks:
+        for pair in pairs:
+            starts += [edges[pair[0]][mask]]
+            ends += [edges[pair[1]][mask]]
+    starts = np.concatenate(starts).tolist()
+    ends = np.concatenate(ends).tolist()
+
+    # every crossed edge is shared by at most two cells, follow the chains
+    neighbours = {}
+    for a, b in zip(starts,ends):
+        neighbours.setdefault(a,[]).append(b)
+        neighbours.setdefault(b,[]).append(a)
+    order = sorted([e for e in neighbours if len(neighbours[e])==1]) + sorted(neighbours)
+    seen = set()
+    lines = []
+    for start in order:
+        if start in seen: continue
+        line = [start]
+        seen.add(start)
+        curr = start
+        while True:
+            following = [e for e in neighbours[curr] if e not in seen]
+            if not following:
+                if len(line)>2 and start in neighbours[curr]: line += [start]
+                break
+            curr = following[0]
+            seen.add(curr)
+            line += [curr]
+        lines += [(px[line],py[line])]
+    return lines
+
 class LimitPlotter(PlotterBase):
     '''Basic limit plotter utilities'''
 
@@ -58,150 +302,51 @@ class LimitPlotter(PlotterBase):
         y = kwargs.pop('y',None)
         detailed = kwargs.pop('detailed',False)
 
-        n = len(xvals)
-        twoSigma = ROOT.TGraph(2*n)
-        oneSigma = ROOT.TGraph(2*n)
-        expected = ROOT.TGraph(n)
-        observed = ROOT.TGraph(n)
-        twoSigma_low = ROOT.TGraph(n)
-        twoSigma_high = ROOT.TGraph(n)
-        oneSigma_low = ROOT.TGraph(n)
-        oneSigma_high = ROOT.TGraph(n)
-        twoSigmaForSmoothing_low = ROOT.TGraph(n)
-        twoSigmaForSmoothing_high = ROOT.TGraph(n)
-        oneSigmaForSmoothing_low = ROOT.TGraph(n)
-        oneSigmaForSmoothing_high = ROOT.TGraph(n)
-        expectedForSmoothing = ROOT.TGraph(n)
-
-        if xVar:
-            w = ROOT.RooRealVar('w','w',0,10000)
-            twoSigmaDS_low  = ROOT.RooDataSet('twoSigmaLow', 'twoSigmaLow', ROOT.RooArgSet(xVar,w),w.GetName())
-            twoSigmaDS_high = ROOT.RooDataSet('twoSigmaHigh','twoSigmaHigh',ROOT.RooArgSet(xVar,w),w.GetName())
-            oneSigmaDS_low  = ROOT.RooDataSet('oneSigmaLow', 'oneSigmaLow', ROOT.RooArgSet(xVar,w),w.GetName())
-            oneSigmaDS_high = ROOT.RooDataSet('oneSigmaHigh','oneSigmaHigh',ROOT.RooArgSet(xVar,w),w.GetName())
-            expectedDS      = ROOT.RooDataSet('expected',    'expected',    ROOT.RooArgSet(xVar,w),w.GetName())
-
-        for i in range(len(xvals)):
-            if not all(limits[xvals[i]]):
-                print i, xvals[i], limits[xvals[i]]
-                continue
-            twoSigma.SetPoint(     i,   xvals[i],     limits[xvals[i]][0]) # 0.025
-            oneSigma.SetPoint(     i,   xvals[i],     limits[xvals[i]][1]) # 0.16
-            expected.SetPoint(     i,   xvals[i],     limits[xvals[i]][2]) # 0.5
-            oneSigma.SetPoint(2*n-i-1,  xvals[i],     limits[xvals[i]][3]) # 0.84
-            twoSigma.SetPoint(2*n-i-1,  xvals[i],     limits[xvals[i]][4]) # 0.975
-            observed.SetPoint(     i,   xvals[i],     limits[xvals[i]][5]) # obs
-            twoSigma_high.SetPoint(i,   xvals[i],     limits[xvals[i]][0]) # 0.025
-            oneSigma_high.SetPoint(i,   xvals[i],     limits[xvals[i]][1]) # 0.16
-            oneSigma_low.SetPoint(n-i-1,xvals[i],     limits[xvals[i]][3]) # 0.84
-            twoSigma_low.SetPoint(n-i-1,xvals[i],     limits[xvals[i]][4]) # 0.975
-            twoSigmaForSmoothing_high.SetPoint(i, xvals[i],     math.log(limits[xvals[i]][0])) # 0.025
-            oneSigmaForSmoothing_high.SetPoint(i, xvals[i],     math.log(limits[xvals[i]][1])) # 0.16
-            oneSigmaForSmoothing_low.SetPoint(n-i-1, xvals[i],  math.log(limits[xvals[i]][3])) # 0.84
-            twoSigmaForSmoothing_low.SetPoint(n-i-1, xvals[i],  math.log(limits[xvals[i]][4])) # 0.975
-            expectedForSmoothing.SetPoint(     i, xvals[i],     math.log(limits[xvals[i]][2])) # 0.5
-            if xVar:
-                xVar.setVal(xvals[i])
-                w.setVal(limits[xvals[i]][0])
-                twoSigmaDS_high.add(ROOT.RooArgSet(xVar,w))
-                w.setVal(limits[xvals[i]][1])
-                oneSigmaDS_high.add(ROOT.RooArgSet(xVar,w))
-                w.setVal(limits[xvals[i]][2])
-                expectedDS.add(ROOT.RooArgSet(xVar,w))
-                w.setVal(limits[xvals[i]][3])
-                oneSigmaDS_low.add(ROOT.RooArgSet(xVar,w))
-                w.setVal(limits[xvals[i]][4])
-                twoSigmaDS_low.add(ROOT.RooArgSet(xVar,w))
+        x, q, valid = getLimitBands(xvals,limits)
 
-        
-        def fit(savename,ds):
-            model.fitTo(ds,ROOT.RooFit.Save(),ROOT.RooFit.SumW2Error(True))
-            xFrame = xVar.frame()
-            ds.plotOn(xFrame)
-            model.plotOn(xFrame)
-            canvas = ROOT.TCanvas(savename,savename,800,800)
-            xFrame.Draw()
-            canvas.Print('{0}.png'.format(savename))
-            
         if model and xVar:
-            # smooth to a pdf
-            fit('twoSigma_low', twoSigmaDS_low)
-            fit('oneSigma_low', oneSigmaDS_low)
-            fit('expected',     expectedDS)
-            fit('oneSigma_high',oneSigmaDS_high)
-            fit('twoSigma_high',twoSigmaDS_high)
-
+            # smooth to a pdf, the datasets have no array fill so they are filled row by row
+            w = ROOT.RooRealVar('w','w',0,10000)
+            quantiles = [('twoSigma_low',4),('oneSigma_low',3),('expected',2),('oneSigma_high',1),('twoSigma_high',0)]
+            datasets = OrderedDict([(savename,ROOT.RooDataSet(savename,savename,ROOT.RooArgSet(xVar,w),w.GetName())) for savename,_ in quantiles])
+            for xi, row in zip(x[valid],q[valid]):
+                xVar.setVal(xi)
+                for savename, qi in quantiles:
+                    w.setVal(row[qi])
+                    datasets[savename].add(ROOT.RooArgSet(xVar,w))
+
+            for savename, ds in datasets.iteritems():
+                model.fitTo(ds,ROOT.RooFit.Save(),ROOT.RooFit.SumW2Error(True))
+                xFrame = xVar.frame()
+                ds.plotOn(xFrame)
+                model.plotOn(xFrame)
+                canvas = ROOT.TCanvas(savename,savename,800,800)
+                xFrame.Draw()
+                canvas.Print('{0}.png'.format(savename))
 
-        smoothlog = False
         if smooth: # smooth out the expected bands
+            q = smoothLimitBands(x,q,valid)
 
-            # smooth via function
-            twoSigmaSmoother_low  = ROOT.TGraphSmooth()
-            twoSigmaSmoother_high = ROOT.TGraphSmooth()
-            oneSigmaSmoother_low  = ROOT.TGraphSmooth()
-            oneSigmaSmoother_high = ROOT.TGraphSmooth()
-            expectedSmoother      = ROOT.TGraphSmooth()
-            # smooth log, good for exponentially changing
-            if smoothlog:
-                twoSigmaSmooth_low    = twoSigmaSmoother_low.SmoothKern( twoSigmaForSmoothing_low, 'normal',0.5,n)
-                twoSigmaSmooth_high   = twoSigmaSmoother_high.SmoothKern(twoSigmaForSmoothing_high,'normal',0.5,n)
-                oneSigmaSmooth_low    = oneSigmaSmoother_low.SmoothKern( oneSigmaForSmoothing_low, 'normal',0.5,n)
-                oneSigmaSmooth_high   = oneSigmaSmoother_high.SmoothKern(oneSigmaForSmoothing_high,'normal',0.5,n)
-                expectedSmooth        = expectedSmoother.SmoothKern(     expectedForSmoothing,     'normal',0.5,n)
-                for i in range(n-2):
-                    twoSigma_high.SetPoint(i+1,   twoSigmaSmooth_high.GetX()[i+1],    math.exp(twoSigmaSmooth_high.GetY()[i+1]))
-                    twoSigma_low.SetPoint( i+1,   twoSigmaSmooth_low.GetX()[i+1],     math.exp(twoSigmaSmooth_low.GetY()[i+1]))
-                    oneSigma_high.SetPoint(i+1,   oneSigmaSmooth_high.GetX()[i+1],    math.exp(oneSigmaSmooth_high.GetY()[i+1]))
-                    oneSigma_low.SetPoint( i+1,   oneSigmaSmooth_low.GetX()[i+1],     math.exp(oneSigmaSmooth_low.GetY()[i+1]))
-                    expected.SetPoint(     i+1,   expectedSmooth.GetX()[i+1],         math.exp(expectedSmooth.GetY()[i+1]))
-            # smooth linear
-            else:
-                twoSigmaSmooth_low    = twoSigmaSmoother_low.SmoothKern( twoSigma_low, 'normal',1.3,n) # originally 0.3, increased to smooth out highmass
-                twoSigmaSmooth_high   = twoSigmaSmoother_high.SmoothKern(twoSigma_high,'normal',1.3,n)
-                oneSigmaSmooth_low    = oneSigmaSmoother_low.SmoothKern( oneSigma_low, 'normal',1.3,n)
-                oneSigmaSmooth_high   = oneSigmaSmoother_high.SmoothKern(oneSigma_high,'normal',1.3,n)
-                expectedSmooth        = expectedSmoother.SmoothKern(     expected,     'normal',1.3,n)
-                #twoSigmaSmooth_low    = twoSigmaSmoother_low.SmoothLowess(twoSigma_low,  '',0.1)
-                #twoSigmaSmooth_high   = twoSigmaSmoother_high.SmoothLowess(twoSigma_high,'',0.1)
-                #oneSigmaSmooth_low    = oneSigmaSmoother_low.SmoothLowess(oneSigma_low,  '',0.1)
-                #oneSigmaSmooth_high   = oneSigmaSmoother_high.SmoothLowess(oneSigma_high,'',0.1)
-                #expectedSmooth        = expectedSmoother.SmoothLowess(expected,          '',0.1)
-                #twoSigmaSmooth_low    = twoSigmaSmoother_low.SmoothSuper(twoSigma_low,  '',0,0)
-                #twoSigmaSmooth_high   = twoSigmaSmoother_high.SmoothSuper(twoSigma_high,'',0,0)
-                #oneSigmaSmooth_low    = oneSigmaSmoother_low.SmoothSuper(oneSigma_low,  '',0,0)
-                #oneSigmaSmooth_high   = oneSigmaSmoother_high.SmoothSuper(oneSigma_high,'',0,0)
-                #expectedSmooth        = expectedSmoother.SmoothSuper(expected,          '',0,0)
-                for i in range(n-2):
-                    x = twoSigmaSmooth_high.GetX()[i+1]
-                    if x>3 and x<4: continue # jpsi
-                    if x>8.5 and x<11.5: continue # upsilon
-                    twoSigma_high.SetPoint(i+1,   twoSigmaSmooth_high.GetX()[i+1],    twoSigmaSmooth_high.GetY()[i+1])
-                    twoSigma_low.SetPoint( i+1,   twoSigmaSmooth_low.GetX()[i+1],     twoSigmaSmooth_low.GetY()[i+1])
-                    oneSigma_high.SetPoint(i+1,   oneSigmaSmooth_high.GetX()[i+1],    oneSigmaSmooth_high.GetY()[i+1])
-                    oneSigma_low.SetPoint( i+1,   oneSigmaSmooth_low.GetX()[i+1],     oneSigmaSmooth_low.GetY()[i+1])
-                    expected.SetPoint(     i+1,   expectedSmooth.GetX()[i+1],         expectedSmooth.GetY()[i+1])
-
-            for i in range(n-2):
-                twoSigma.SetPoint(     i+1,   twoSigma_high.GetX()[i+1],    twoSigma_high.GetY()[i+1])
-                twoSigma.SetPoint(     n+i+1, twoSigma_low.GetX()[n-1-i-1], twoSigma_low.GetY()[n-1-i-1])
-                oneSigma.SetPoint(     i+1,   oneSigma_high.GetX()[i+1],    oneSigma_high.GetY()[i+1])
-                oneSigma.SetPoint(     n+i+1, oneSigma_low.GetX()[n-1-i-1], oneSigma_low.GetY()[n-1-i-1])
+        x = x[valid]
+        q = q[valid]
+
+        # the single quantile graphs stay unscaled
+        twoSigma_high = getArrayGraph(x,      q[:,0])       # 0.025
+        oneSigma_high = getArrayGraph(x,      q[:,1])       # 0.16
+        oneSigma_low  = getArrayGraph(x[::-1],q[::-1,3])    # 0.84
+        twoSigma_low  = getArrayGraph(x[::-1],q[::-1,4])    # 0.975
 
         # now scale
-        for i in range(len(xvals)):
-            if not all(limits[xvals[i]]):
-                print i, xvals[i], limits[xvals[i]]
-                continue
-            scale = 1
-            if scales and modelkey:
-                scale = scales[xvals[i]][modelkey].Eval(y)
-                if scale<=0: scale = 1e-10
-            twoSigma.SetPoint(     i,   twoSigma.GetX()[i],    twoSigma.GetY()[i]*scale) # 0.025
-            oneSigma.SetPoint(     i,   oneSigma.GetX()[i],    oneSigma.GetY()[i]*scale) # 0.16
-            expected.SetPoint(     i,   expected.GetX()[i],    expected.GetY()[i]*scale) # 0.5
-            oneSigma.SetPoint(2*n-i-1,  oneSigma.GetX()[2*n-i-1],    oneSigma.GetY()[2*n-i-1]*scale) # 0.84
-            twoSigma.SetPoint(2*n-i-1,  twoSigma.GetX()[2*n-i-1],    twoSigma.GetY()[2*n-i-1]*scale) # 0.975
-            observed.SetPoint(     i,   observed.GetX()[i],    observed.GetY()[i]*scale) # obs
+        if scales and modelkey:
+            scale = np.array([scales[xv][modelkey].Eval(y) for xv, v in zip(xvals,valid) if v])
+            scale[scale<=0] = 1e-10
+            q = q*scale[:,np.newaxis]
+
+        bandx = np.concatenate([x,x[::-1]])
+        twoSigma = getArrayGraph(bandx,np.concatenate([q[:,0],q[::-1,4]]))
+        oneSigma = getArrayGraph(bandx,np.concatenate([q[:,1],q[::-1,3]]))
+        expected = getArrayGraph(x,q[:,2])
+        observed = getArrayGraph(x,q[:,5])
         
         twoSigma.SetFillColor(ROOT.kOrange)
         twoSigma.SetLineColor(ROOT.kOrange)
@@ -339,6 +484,7 @@ class LimitPlotter(PlotterBase):
         ymax = kwargs.pop('ymax',10)
         expectedBands = kwargs.pop('expectedBands', [])
         additionaltext = kwargs.pop('additionaltext','')
+        scaleBands = kwargs.pop('scaleBands',False) # also scale the +-1 and 2 sigma planes by the model
 
         logging.info('Plotting {0}'.format(savename))
 
@@ -364,26 +510,16 @@ class LimitPlotter(PlotterBase):
 
         limits = quartiles
 
-        expected, oneSigma, twoSigma, observed, oneSigma_low, oneSigma_high, twoSigma_low, twoSigma_high = self._getGraphs(xvals,limits,xVar=xVar,smooth=smooth,model=model,scales=scales,modelkey=modelkey,y=yval,detailed=True)
-
-        def cross(val,prev,curr):
-            if prev>=val and curr<=val: return True
-            if prev<=val and curr>=val: return True
-            return False
-
-        for xi in range(nx+1):
-            x = xmin + xi*dx
-            val = expected.Eval(x)
-            eb = expectedHist.GetBin(xi+1)
-            expectedHist.SetBinContent(eb,val)
+        expected, oneSigma, twoSigma, observed = self._getGraphs(xvals,limits,xVar=xVar,smooth=smooth,model=model,scales=scales,modelkey=modelkey,y=yval)
 
-            oneSigmaLowHist.SetBinContent( eb, oneSigma_low.Eval(x))
-            oneSigmaHighHist.SetBinContent(eb, oneSigma_high.Eval(x))
-            twoSigmaLowHist.SetBinContent( eb, twoSigma_low.Eval(x))
-            twoSigmaHighHist.SetBinContent(eb, twoSigma_high.Eval(x))
-
-            oval = observed.Eval(x)
-            observedHist.SetBinContent(eb, oval)
+        xgrid = xmin + np.arange(nx+1)*dx
+        grid = getLimitGrid(xvals,limits,xgrid,[yval],smooth=smooth,scales=scales,modelkey=modelkey,scaleBands=scaleBands)[0]
+        setHistContent(expectedHist,    grid[:,2])
+        setHistContent(oneSigmaLowHist, grid[:,3])
+        setHistContent(oneSigmaHighHist,grid[:,1])
+        setHistContent(twoSigmaLowHist, grid[:,4])
+        setHistContent(twoSigmaHighHist,grid[:,0])
+        setHistContent(observedHist,    grid[:,5])
 
 
         expectedHistCont = expectedHist.Clone()
@@ -509,6 +645,7 @@ class LimitPlotter(PlotterBase):
         ymax = kwargs.pop('ymax',10)
         expectedBands = kwargs.pop('expectedBands', [])
         additionaltext = kwargs.pop('additionaltext','')
+        scaleBands = kwargs.pop('scaleBands',False) # also scale the +-1 and 2 sigma planes by the model
 
         logging.info('Plotting {0}'.format(savename))
 
@@ -536,36 +673,20 @@ class LimitPlotter(PlotterBase):
         oneSigma = {}
         twoSigma = {}
         observed = {}
-        oneSigma_low = {}
-        oneSigma_high = {}
-        twoSigma_low = {}
-        twoSigma_high = {}
 
         for ilim, (xvals, quartiles,scales) in enumerate(zip(xvalsMulti, quartilesMulti,scalesMulti)):
             limits = quartiles
 
-            expected[ilim], oneSigma[ilim], twoSigma[ilim], observed[ilim], oneSigma_low[ilim], oneSigma_high[ilim], twoSigma_low[ilim], twoSigma_high[ilim] = self._getGraphs(xvals,limits,xVar=xVar,smooth=smooth,model=model,scales=scales,modelkey=modelkey,y=yval,detailed=True)
-
-        def cross(val,prev,curr):
-            if prev>=val and curr<=val: return True
-            if prev<=val and curr>=val: return True
-            return False
-
-        for xi in range(nx+1):
-            x = xmin + xi*dx
-            for ilim, xvals in enumerate(xvalsMulti):
-                if x>=xvals[0] and x<=xvals[-1]: break
-            val = expected[ilim].Eval(x)
-            eb = expectedHist.GetBin(xi+1)
-            expectedHist.SetBinContent(eb,val)
+            expected[ilim], oneSigma[ilim], twoSigma[ilim], observed[ilim] = self._getGraphs(xvals,limits,xVar=xVar,smooth=smooth,model=model,scales=scales,modelkey=modelkey,y=yval)
 
-            oneSigmaLowHist.SetBinContent( eb, oneSigma_low[ilim].Eval(x))
-            oneSigmaHighHist.SetBinContent(eb, oneSigma_high[ilim].Eval(x))
-            twoSigmaLowHist.SetBinContent( eb, twoSigma_low[ilim].Eval(x))
-            twoSigmaHighHist.SetBinContent(eb, twoSigma_high[ilim].Eval(x))
-
-            oval = observed[ilim].Eval(x)
-            observedHist.SetBinContent(eb, oval)
+        xgrid = xmin + np.arange(nx+1)*dx
+        grid = getLimitGridMulti(xvalsMulti,quartilesMulti,xgrid,[yval],smooth=smooth,scales=scalesMulti,modelkey=modelkey,scaleBands=scaleBands)[0]
+        setHistContent(expectedHist,    grid[:,2])
+        setHistContent(oneSigmaLowHist, grid[:,3])
+        setHistContent(oneSigmaHighHist,grid[:,1])
+        setHistContent(twoSigmaLowHist, grid[:,4])
+        setHistContent(twoSigmaHighHist,grid[:,0])
+        setHistContent(observedHist,    grid[:,5])
 
 
         expectedHistCont = expectedHist.Clone()
@@ -858,6 +979,7 @@ class LimitPlotter(PlotterBase):
         plotcolz = kwargs.pop('plotcolz',True)
         plotfill = kwargs.pop('plotfill',False)
         additionaltext = kwargs.pop('additionaltext','')
+        scaleBands = kwargs.pop('scaleBands',False) # also scale the +-1 and 2 sigma planes by the model
 
         logging.info('Plotting {0}'.format(savename))
 
@@ -889,70 +1011,17 @@ class LimitPlotter(PlotterBase):
 
         limits = quartiles
 
-
-        expected_vals = []
-        oneSigma_low_vals = []
-        oneSigma_high_vals = []
-        twoSigma_low_vals = []
-        twoSigma_high_vals = []
-
-
-        for yi in range(ny+1):
-            y = ymin + yi*dy
-            expected, oneSigma, twoSigma, observed, oneSigma_low, oneSigma_high, twoSigma_low, twoSigma_high = self._getGraphs(xvals,limits,xVar=xVar,smooth=smooth,model=model,scales=scales,modelkey=modelkey,y=y,detailed=True)
-
-
-            def cross(val,prev,curr):
-                if prev>=val and curr<=val: return True
-                if prev<=val and curr>=val: return True
-                return False
-
-            #expected_prev = 0
-            #oneSigma_low_prev = 0
-            #oneSigma_high_prev = 0
-            #twoSigma_low_prev = 0
-            #twoSigma_high_prev = 0
-            for xi in range(nx+1):
-                x = xmin + xi*dx
-                val = expected.Eval(x)
-                if val<zmin: val = zmin
-                eb = expectedHist.GetBin(xi+1,yi+1)
-                #eb = expectedHist.FindBin(x,y)
-                expectedHist.SetBinContent(eb,val)
-
-                oneSigmaLowHist.SetBinContent( eb, oneSigma_low.Eval(x))
-                oneSigmaHighHist.SetBinContent(eb, oneSigma_high.Eval(x))
-                twoSigmaLowHist.SetBinContent( eb, twoSigma_low.Eval(x))
-                twoSigmaHighHist.SetBinContent(eb, twoSigma_high.Eval(x))
-
-                oval = observed.Eval(x)
-                # TODO: try
-                if oval<zmin: oval = 0
-                if oval>zmax: oval = 999*zmax
-                observedHist.SetBinContent(eb, oval)
-
-                #expected_curr      = expected.Eval(x)
-                #oneSigma_low_curr  = oneSigma_low.Eval(x)
-                #oneSigma_high_curr = oneSigma_high.Eval(x)
-                #twoSigma_low_curr  = twoSigma_low.Eval(x)
-                #twoSigma_high_curr = twoSigma_high.Eval(x)
-
-                #if xi:
-                #    if cross(1,expected_prev,     expected_curr)     : expected_vals      += [(x,y)]
-                #    if cross(1,oneSigma_low_prev, oneSigma_low_curr) : oneSigma_low_vals  += [(x,y)]
-                #    if cross(1,oneSigma_high_prev,oneSigma_high_curr): oneSigma_high_vals += [(x,y)]
-                #    if cross(1,twoSigma_low_prev, twoSigma_low_curr) : twoSigma_low_vals  += [(x,y)]
-                #    if cross(1,twoSigma_high_prev,twoSigma_high_curr): twoSigma_high_vals += [(x,y)]
-
-                #expected_prev      = expected_curr
-                #oneSigma_low_prev  = oneSigma_low_curr
-                #oneSigma_high_prev = oneSigma_high_curr
-                #twoSigma_low_prev  = twoSigma_low_curr
-                #twoSigma_high_prev = twoSigma_high_curr
-
-        expectedHistCont = expectedHist.Clone()
-        observedHistCont = observedHist.Clone()
-
+        xgrid = xmin + np.arange(nx+1)*dx
+        ygrid = ymin + np.arange(ny+1)*dy
+        grid = getLimitGrid(xvals,limits,xgrid,ygrid,smooth=smooth,scales=scales,modelkey=modelkey,scaleBands=scaleBands)
+        expectedGrid = np.maximum(grid[:,:,2],zmin)
+        observedGrid = np.where(grid[:,:,5]<zmin,0.,np.where(grid[:,:,5]>zmax,999*zmax,grid[:,:,5]))
+        setHistContent(expectedHist,    expectedGrid)
+        setHistContent(oneSigmaLowHist, grid[:,:,3])
+        setHistContent(oneSigmaHighHist,grid[:,:,1])
+        setHistContent(twoSigmaLowHist, grid[:,:,4])
+        setHistContent(twoSigmaHighHist,grid[:,:,0])
+        setHistContent(observedHist,    observedGrid)
 
         def setHistStyle(hist):
             hist.GetXaxis().SetTitle(xaxis)
@@ -968,32 +1037,20 @@ class LimitPlotter(PlotterBase):
         setHistStyle(observedHist)
         setHistStyle(emptyHist)
 
-        def get_contours(hist,val=1.0):
-            contours = array('d',[val])
-            hist.SetContour(1,contours)
-            hist.Draw('cont z list')
-            canvas.Update()
-            graphs = []
-            conts = ROOT.gROOT.GetListOfSpecials().FindObject('contours')
-            i = 0 # why is this needed?!?!?
-            if i in range(conts.GetSize()):
-                contLevel = conts.At(i)
-                for j in range(contLevel.GetSize()):
-                    graphs += [contLevel.At(j).Clone()]
-                    
-            return graphs
+        def get_contours(z,val=1.0):
+            return [getArrayGraph(cx,cy) for cx,cy in getContours(xgrid,ygrid,z,val)]
 
         expected_graphs = {}
         oneSigma_graphs = {}
         twoSigma_graphs = {}
         observed_graphs = {}
         for eb in expectedBands:
-            expected_graphs[eb] =  get_contours(expectedHistCont,eb)
-            observed_graphs[eb] =  get_contours(observedHistCont,eb)
-            oneSigma_graphs[eb] =  get_contours(oneSigmaLowHist, eb)
-            oneSigma_graphs[eb] += get_contours(oneSigmaHighHist,eb)
-            twoSigma_graphs[eb] =  get_contours(twoSigmaLowHist, eb)
-            twoSigma_graphs[eb] += get_contours(twoSigmaHighHist,eb)
+            expected_graphs[eb] =  get_contours(expectedGrid,eb)
+            observed_graphs[eb] =  get_contours(observedGrid,eb)
+            oneSigma_graphs[eb] =  get_contours(grid[:,:,3],eb)
+            oneSigma_graphs[eb] += get_contours(grid[:,:,1],eb)
+            twoSigma_graphs[eb] =  get_contours(grid[:,:,4],eb)
+            twoSigma_graphs[eb] += get_contours(grid[:,:,0],eb)
 
         #print len(expected_graphs), len(oneSigma_graphs), len(twoSigma_graphs)
 
@@ -1245,6 +1302,7 @@ class LimitPlotter(PlotterBase):
         plotcolz = kwargs.pop('plotcolz',True)
         plotfill = kwargs.pop('plotfill',False)
         additionaltext = kwargs.pop('additionaltext','')
+        scaleBands = kwargs.pop('scaleBands',False) # also scale the +-1 and 2 sigma planes by the model
 
         logging.info('Plotting {0}'.format(savename))
 
@@ -1274,61 +1332,17 @@ class LimitPlotter(PlotterBase):
         twoSigmaLowHist  = ROOT.TH2D('twol','twol',nx+1,xmin-0.5*dx,xmax+0.5*dx,ny+1,ymin-0.5*dy,ymax+0.5*dy)
         twoSigmaHighHist = ROOT.TH2D('twoh','twoh',nx+1,xmin-0.5*dx,xmax+0.5*dx,ny+1,ymin-0.5*dy,ymax+0.5*dy)
 
-        expected_vals = []
-        oneSigma_low_vals = []
-        oneSigma_high_vals = []
-        twoSigma_low_vals = []
-        twoSigma_high_vals = []
-
-        expected = {}
-        oneSigma = {}
-        twoSigma = {}
-        observed = {}
-        oneSigma_low = {}
-        oneSigma_high = {}
-        twoSigma_low = {}
-        twoSigma_high = {}
-
-
-        for yi in range(ny+1):
-            y = ymin + yi*dy
-
-            for ilim, (xvals, quartiles, scales) in enumerate(zip(xvalsMulti, quartilesMulti, scalesMulti)):
-
-                limits = quartiles
-                expected[ilim], oneSigma[ilim], twoSigma[ilim], observed[ilim], oneSigma_low[ilim], oneSigma_high[ilim], twoSigma_low[ilim], twoSigma_high[ilim] = self._getGraphs(xvals,limits,xVar=xVar,smooth=smooth,model=model,scales=scales,modelkey=modelkey,y=y,detailed=True)
-
-
-                def cross(val,prev,curr):
-                    if prev>=val and curr<=val: return True
-                    if prev<=val and curr>=val: return True
-                    return False
-
-            for xi in range(nx+1):
-                x = xmin + xi*dx
-                for ilim, xvals in enumerate(xvalsMulti):
-                    if x>=xvals[0] and x<=xvals[-1]: break
-                val = expected[ilim].Eval(x)
-                if val<zmin: val = zmin
-                eb = expectedHist.GetBin(xi+1,yi+1)
-                #eb = expectedHist.FindBin(x,y)
-                expectedHist.SetBinContent(eb,val)
-
-                oneSigmaLowHist.SetBinContent( eb, oneSigma_low[ilim].Eval(x))
-                oneSigmaHighHist.SetBinContent(eb, oneSigma_high[ilim].Eval(x))
-                twoSigmaLowHist.SetBinContent( eb, twoSigma_low[ilim].Eval(x))
-                twoSigmaHighHist.SetBinContent(eb, twoSigma_high[ilim].Eval(x))
-
-                oval = observed[ilim].Eval(x)
-                # TODO: try
-                if oval<zmin: oval = 0
-                if oval>zmax: oval = 999*zmax
-                observedHist.SetBinContent(eb, oval)
-
-
-        expectedHistCont = expectedHist.Clone()
-        observedHistCont = observedHist.Clone()
-
+        xgrid = xmin + np.arange(nx+1)*dx
+        ygrid = ymin + np.arange(ny+1)*dy
+        grid = getLimitGridMulti(xvalsMulti,quartilesMulti,xgrid,ygrid,smooth=smooth,scales=scalesMulti,modelkey=modelkey,scaleBands=scaleBands)
+        expectedGrid = np.maximum(grid[:,:,2],zmin)
+        observedGrid = np.where(grid[:,:,5]<zmin,0.,np.where(grid[:,:,5]>zmax,999*zmax,grid[:,:,5]))
+        setHistContent(expectedHist,    expectedGrid)
+        setHistContent(oneSigmaLowHist, grid[:,:,3])
+        setHistContent(oneSigmaHighHist,grid[:,:,1])
+        setHistContent(twoSigmaLowHist, grid[:,:,4])
+        setHistContent(twoSigmaHighHist,grid[:,:,0])
+        setHistContent(observedHist,    observedGrid)
 
         def setHistStyle(hist):
             hist.GetXaxis().SetTitle(xaxis)
@@ -1344,32 +1358,20 @@ class LimitPlotter(PlotterBase):
         setHistStyle(observedHist)
         setHistStyle(emptyHist)
 
-        def get_contours(hist,val=1.0):
-            contours = array('d',[val])
-            hist.SetContour(1,contours)
-            hist.Draw('cont z list')
-            canvas.Update()
-            graphs = []
-            conts = ROOT.gROOT.GetListOfSpecials().FindObject('contours')
-            i = 0 # why is this needed?!?!?
-            if i in range(conts.GetSize()):
-                contLevel = conts.At(i)
-                for j in range(contLevel.GetSize()):
-                    graphs += [contLevel.At(j).Clone()]
-                    
-            return graphs
+        def get_contours(z,val=1.0):
+            return [getArrayGraph(cx,cy) for cx,cy in getContours(xgrid,ygrid,z,val)]
 
         expected_graphs = {}
         oneSigma_graphs = {}
         twoSigma_graphs = {}
         observed_graphs = {}
         for eb in expectedBands:
-            expected_graphs[eb] =  get_contours(expectedHistCont,eb)
-            observed_graphs[eb] =  get_contours(observedHistCont,eb)
-            oneSigma_graphs[eb] =  get_contours(oneSigmaLowHist, eb)
-            oneSigma_graphs[eb] += get_contours(oneSigmaHighHist,eb)
-            twoSigma_graphs[eb] =  get_contours(twoSigmaLowHist, eb)
-            twoSigma_graphs[eb] += get_contours(twoSigmaHighHist,eb)
+            expected_graphs[eb] =  get_contours(expectedGrid,eb)
+            observed_graphs[eb] =  get_contours(observedGrid,eb)
+            oneSigma_graphs[eb] =  get_contours(grid[:,:,3],eb)
+            oneSigma_graphs[eb] += get_contours(grid[:,:,1],eb)
+            twoSigma_graphs[eb] =  get_contours(grid[:,:,4],eb)
+            twoSigma_graphs[eb] += get_contours(grid[:,:,0],eb)
 
         #print len(expected_graphs), len(oneSigma_graphs), len(twoSigma_graphs)
 